@@ -0,0 +1,1157 @@
+# benchmark.py
+# flight_prices_trends
+
+# a script for timing the hot paths of
+# the pipeline, so we can check that
+# changes actually make things faster.
+
+# usage: python benchmark.py <benchmark> [args]
+
+############
+# IMPORTS
+############
+import sys
+import argparse
+import subprocess
+import datetime as dt
+from time import perf_counter
+
+############
+# CLI
+############
+parser = argparse.ArgumentParser(
+    description='benchmarks for flight_prices_trends')
+
+subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+# parse
+parse_parser = subparsers.add_parser(
+    'parse',
+    help='single-pass journey parser vs the original chunk helpers, on archived pages')
+
+parse_parser.add_argument(
+    '-f',
+    '--captured_from',
+    default=None,
+    help='only use snapshots captured on or after this date. format: YYYY-MM-DD')
+
+parse_parser.add_argument(
+    '-r',
+    '--repeats',
+    type=int,
+    default=5,
+    help='number of passes over the fixtures')
+
+# ingest
+ingest_parser = subparsers.add_parser(
+    'ingest',
+    help='validate-once ingest vs extract_journeys/legs/prices, on a batch of journeys')
+
+ingest_parser.add_argument(
+    '-n',
+    '--n_journeys',
+    type=int,
+    default=10000,
+    help='number of journeys in the batch')
+
+ingest_parser.add_argument(
+    '-r',
+    '--repeats',
+    type=int,
+    default=3,
+    help='number of runs over the batch')
+
+# startup
+startup_parser = subparsers.add_parser(
+    'startup',
+    help='import time of our modules and scripts, each in a fresh interpreter')
+
+startup_parser.add_argument(
+    '-r',
+    '--repeats',
+    type=int,
+    default=5,
+    help='number of fresh interpreters per module')
+
+# page-load
+page_load_parser = subparsers.add_parser(
+    'page-load',
+    help='load time and bytes per page, default chrome vs the `browser` config, against a local fixture server')
+
+page_load_parser.add_argument(
+    '-r',
+    '--repeats',
+    type=int,
+    default=5,
+    help='page loads per browser setup')
+
+page_load_parser.add_argument(
+    '-d',
+    '--delay',
+    type=float,
+    default=0.05,
+    help='seconds the fixture server waits before every response, standing in for the network')
+
+# pipeline
+pipeline_parser = subparsers.add_parser(
+    'pipeline',
+    help='scrape, then parse, then write vs the staged pipeline, on a city_options search served from a fixture archive')
+
+pipeline_parser.add_argument(
+    '-d',
+    '--delay',
+    type=float,
+    default=0.5,
+    help='seconds every page takes to fetch, standing in for the browser')
+
+pipeline_parser.add_argument(
+    '-n',
+    '--n_blocks',
+    type=int,
+    default=100,
+    help='result blocks per page')
+
+# storage
+storage_parser = subparsers.add_parser(
+    'storage',
+    help='db size of prices stored as rows vs as runs (written directly, and compacted by migration 0003)')
+
+storage_parser.add_argument(
+    '-u',
+    '--n_urls',
+    type=int,
+    default=10,
+    help='pages per run of the search')
+
+storage_parser.add_argument(
+    '-j',
+    '--n_journeys',
+    type=int,
+    default=100,
+    help='journeys per page')
+
+storage_parser.add_argument(
+    '-r',
+    '--n_runs',
+    type=int,
+    default=100,
+    help='runs of the search')
+
+storage_parser.add_argument(
+    '-c',
+    '--change_rate',
+    type=float,
+    default=0.02,
+    help='chance of a journey\'s price changing from one run to the next (and of it going missing)')
+
+# rollups
+rollups_parser = subparsers.add_parser(
+    'rollups',
+    help='cheapest price per route per day from the raw prices vs the daily price tables, and what keeping them costs per page written')
+
+rollups_parser.add_argument(
+    '-r',
+    '--n_routes',
+    type=int,
+    default=20,
+    help='routes in the db')
+
+rollups_parser.add_argument(
+    '-j',
+    '--n_journeys',
+    type=int,
+    default=100,
+    help='journeys per route')
+
+rollups_parser.add_argument(
+    '-d',
+    '--n_days',
+    type=int,
+    default=30,
+    help='days of history')
+
+rollups_parser.add_argument(
+    '-o',
+    '--n_observations',
+    type=int,
+    default=8,
+    help='times every journey is observed per day')
+
+# analytics
+analytics_parser = subparsers.add_parser(
+    'analytics',
+    help='price trends of many searches with analytics.TrendEngine vs a python loop over their prices')
+
+analytics_parser.add_argument(
+    '-s',
+    '--n_searches',
+    type=int,
+    default=100,
+    help='searches in the db')
+
+analytics_parser.add_argument(
+    '-j',
+    '--n_journeys',
+    type=int,
+    default=50,
+    help='journeys per search')
+
+analytics_parser.add_argument(
+    '-d',
+    '--n_days',
+    type=int,
+    default=365,
+    help='days of history')
+
+analytics_parser.add_argument(
+    '-o',
+    '--n_observations',
+    type=int,
+    default=4,
+    help='times every search is scraped per day')
+
+analytics_parser.add_argument(
+    '-c',
+    '--change_rate',
+    type=float,
+    default=0.05,
+    help='chance of a journey\'s price changing from one scrape to the next')
+
+analytics_parser.add_argument(
+    '-l',
+    '--n_loop_searches',
+    type=int,
+    default=3,
+    help='searches to time the python loop on (it\'s slow)')
+
+# export
+export_parser = subparsers.add_parser(
+    'export',
+    help='exporting journey options straight from memory vs writing them to the db and reading them back')
+
+export_parser.add_argument(
+    '-n',
+    '--n_journeys',
+    type=int,
+    default=5000,
+    help='journeys in the batch, each at two prices')
+
+############
+# FIXTURES
+############
+# what the non-scrape entry points import,
+# and the heavy dependencies to look out for
+STARTUP_MODULES = [
+    'src.settings',
+    'src.db_utils',
+    'src.archive',
+    'src.migrations',
+    'src.journey_parser',
+    'manage',
+    'src.scraper'
+]
+HEAVY_MODULES = ['selenium', 'pydantic', 'airportsdata', 'numpy']
+
+# run in the fresh interpreter: prints the
+# import time, then any heavy modules loaded
+STARTUP_SCRIPT = '''
+import sys
+from time import perf_counter
+start = perf_counter()
+import {module}
+print(perf_counter() - start)
+print(' '.join(m for m in {heavy} if m in sys.modules))
+'''
+
+# a recorded round trip result block, used
+# if there's nothing in the archive yet
+SAMPLE_BLOCK = '\n'.join([
+    'Best',
+    '20:30 – 06:55',
+    '+1',
+    'LHRLondon Heathrow',
+    '-',
+    'LAXLos Angeles Intl',
+    '1 stop',
+    'JFK',
+    '18h 25m',
+    '10:45 – 19:05',
+    'LAXLos Angeles Intl',
+    '-',
+    'LHRLondon Heathrow',
+    'direct',
+    '',
+    '10h 20m',
+    'British Airways, American Airlines',
+    '1',
+    '0',
+    '£612',
+    'Select',
+    'Economy'
+])
+SAMPLE_DATES = ['2024-02-08', '2024-02-25']
+
+
+# a results page with the kind of things
+# a real one comes with: images, a web font,
+# an ad iframe and a tracker script. the
+# paths look like the hosts we block.
+N_FIXTURE_RESULTS = 15
+FIXTURE_PAGE = '''<!DOCTYPE html>
+<html><head>
+<style>
+@font-face {{ font-family: 'Fixture'; src: url('/fonts/fixture.woff2'); }}
+body {{ font-family: 'Fixture', sans-serif; }}
+</style>
+<script src="/www.googletagmanager.com/gtm.js"></script>
+</head><body>
+<iframe src="/ad.doubleclick.net/ad.html"></iframe>
+{results}
+</body></html>
+'''
+FIXTURE_RESULT = '''<div class="nrc6-fixture"><img src="/img/logo_{i}.png"><pre>{block}</pre></div>'''
+FIXTURE_FILES = {
+    'fonts/fixture.woff2' : 200_000,
+    'www.googletagmanager.com/gtm.js' : 100_000,
+    'ad.doubleclick.net/ad.html' : 50_000,
+    **{f'img/logo_{i}.png' : 30_000 for i in range(N_FIXTURE_RESULTS)}
+}
+
+
+def write_page_fixture(directory: str):
+    '''
+    writes the fixture page and the
+    files it links to into directory.
+    '''
+    import os
+    import html
+
+    results = '\n'.join(
+        FIXTURE_RESULT.format(i=i, block=html.escape(SAMPLE_BLOCK))
+        for i in range(N_FIXTURE_RESULTS))
+    with open(os.path.join(directory, 'index.html'), 'w') as f:
+        f.write(FIXTURE_PAGE.format(results=results))
+
+    for path, size in FIXTURE_FILES.items():
+        os.makedirs(os.path.join(directory, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(directory, path), 'wb') as f:
+            # the js file needs to be valid js
+            f.write(b'//' + b'x' * (size-2) if path.endswith('.js') else b'\0' * size)
+
+
+def make_result_block(i: int,
+                      origin: str,
+                      destination: str) -> str:
+    '''
+    a variation on SAMPLE_BLOCK: different
+    airports, departure time and price.
+    '''
+    return (SAMPLE_BLOCK
+            .replace('LHRLondon', f'{origin}London')
+            .replace('LAXLos', f'{destination}Los')
+            .replace('20:30 – 06:55', f'{i // 60 % 24:02d}:{i % 60:02d} – 06:55')
+            .replace('£612', f'£{400 + i}'))
+
+
+def load_parse_fixtures(captured_from: str | None) -> list[tuple]:
+    '''
+    returns (chunks, dates) for every full
+    result in the archive. falls back to
+    SAMPLE_BLOCK if the archive is empty.
+    '''
+    from src.archive import iter_snapshots
+    from src.scraper import FlightsScaper, CONFIG, chunks_are_full_result
+    from src.journey_parser import split_chunks
+
+    fixtures = []
+    for snapshot in iter_snapshots(captured_from=captured_from):
+        journey_search = snapshot['journey_search']
+        dates = FlightsScaper.journey_dates(
+            journey_search['leave_date'],
+            journey_search.get('return_date'),
+            journey_search['journey_type'])
+        currency_symbol = CONFIG['country'][snapshot['country']]['currency_symbol']
+
+        for block in snapshot['blocks']:
+            chunks = split_chunks(block)
+            if chunks_are_full_result(chunks, len(dates), currency_symbol):
+                fixtures.append((chunks, dates))
+
+    if not fixtures:
+        print('no archived pages found, using the built-in sample block')
+        fixtures = [(split_chunks(SAMPLE_BLOCK), SAMPLE_DATES)] * 200
+
+    return fixtures
+
+
+def make_journey_batch(n_journeys: int) -> list[dict]:
+    '''
+    n distinct journey options, made by
+    shifting the times and prices of the
+    parsed SAMPLE_BLOCK.
+    '''
+    from src.scraper import FlightsScaper
+
+    template = FlightsScaper.parse_result_blocks(
+        [SAMPLE_BLOCK], SAMPLE_DATES, 'round_trip', 'uk')[0]
+
+    batch = []
+    for i in range(n_journeys):
+        shift = dt.timedelta(minutes=i)
+        batch.append({
+            'legs' : [
+                {**leg,
+                 'departure_timestamp' : leg['departure_timestamp'] + shift,
+                 'arrival_timestamp' : leg['arrival_timestamp'] + shift}
+                for leg in template['legs']],
+            'meta' : {**template['meta'], 'price' : template['meta']['price'] + i % 50}
+        })
+
+    return batch
+
+
+def legacy_parse_legs(raw_chunks: list[str],
+                      dates: list[str]) -> tuple[list[dict], list[str]]:
+    '''
+    the original multi-pass leg parsing,
+    built from the chunk helpers in scraper.py.
+    '''
+    from src.scraper import (
+        find_timing_chunks,
+        find_last_duration_chunk,
+        parse_duration,
+        is_airport_chunk,
+        parse_timings,
+        chunk_is_penalty,
+        find_parse_stops,
+        find_parse_stop_airports)
+
+    indexes = find_timing_chunks(raw_chunks)
+    legs = []
+    for i, index in enumerate(indexes):
+        if i+1 < len(indexes):
+            legs.append(raw_chunks[index:indexes[i+1]])
+        else:
+            duration_index = find_last_duration_chunk(raw_chunks)
+            legs.append(raw_chunks[index:duration_index+1])
+            prices_meta = raw_chunks[duration_index+1:]
+
+    if len(dates) != len(legs):
+        raise ValueError(
+            f'Number of dates ({len(dates)}) does not match number of legs ({len(legs)})')
+
+    legs_out = []
+    for i, leg in enumerate(legs):
+        for chunk in leg:
+            penalty = chunk_is_penalty(chunk)
+            if penalty:
+                break
+
+        dep, arr = parse_timings(leg[0], dates[i], penalty)
+        airports = [chunk[:3] for chunk in leg if is_airport_chunk(chunk)]
+
+        for chunk in leg:
+            stops = find_parse_stops(chunk)
+            if stops is not None:
+                break
+
+        stopovers = find_parse_stop_airports(leg) if stops > 0 else None
+        duration = parse_duration(leg[find_last_duration_chunk(leg)])
+
+        legs_out.append({
+            'departure_timestamp': dep,
+            'arrival_timestamp': arr,
+            'departure_airport': airports[0],
+            'arrival_airport': airports[1],
+            'duration': duration,
+            'n_stops': stops,
+            'stopover_airports': stopovers
+        })
+
+    return legs_out, prices_meta
+
+
+def time_passes(fn,
+                fixtures: list[tuple],
+                repeats: int) -> tuple[float, list]:
+    '''
+    runs fn over all fixtures `repeats` times.
+    returns the best time for one pass,
+    and the output of the last pass.
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        start = perf_counter()
+        out = [fn(chunks, dates) for chunks, dates in fixtures]
+        best = min(best, perf_counter() - start)
+    return best, out
+
+############
+# BENCHMARKS
+############
+def bench_parse(args: argparse.Namespace):
+    '''
+    times the leg parsing for every full
+    result in the archive, old vs new,
+    and checks they agree.
+    '''
+    import logging
+    from src.journey_parser import parse_legs
+
+    fixtures = load_parse_fixtures(args.captured_from)
+    # the legacy helpers log every chunk
+    logging.disable(logging.INFO)
+
+    legacy_time, legacy_out = time_passes(legacy_parse_legs, fixtures, args.repeats)
+    new_time, new_out = time_passes(parse_legs, fixtures, args.repeats)
+
+    n_mismatches = sum(old != new for old, new in zip(legacy_out, new_out))
+
+    print(f'{len(fixtures)} journeys, best of {args.repeats} passes')
+    print(f'legacy helpers: {legacy_time*1000:9.2f} ms ({len(fixtures)/legacy_time:10.0f} journeys/s)')
+    print(f'single pass:    {new_time*1000:9.2f} ms ({len(fixtures)/new_time:10.0f} journeys/s)')
+    print(f'speedup: {legacy_time/new_time:.2f}x, mismatching outputs: {n_mismatches}')
+
+
+def bench_ingest(args: argparse.Namespace):
+    '''
+    times turning a batch of journey options
+    into journeys, legs and prices rows: the
+    three separate extract_* calls vs one
+    ingest_journey_options call.
+    '''
+    import logging
+    import src.db_utils as db
+
+    batch = make_journey_batch(args.n_journeys)
+    logging.disable(logging.INFO)
+
+    def extract_all(data):
+        return (
+            db.extract_journeys(data=data, search_id='bench'),
+            db.extract_legs(data=data),
+            db.extract_prices(data))
+
+    def ingest(data):
+        return db.ingest_journey_options(data=data, search_id='bench')
+
+    results = {}
+    for name, fn in [('extract_*', extract_all), ('ingest', ingest)]:
+        best = float('inf')
+        for _ in range(args.repeats):
+            start = perf_counter()
+            out = fn(batch)
+            best = min(best, perf_counter() - start)
+        results[name] = (best, out)
+
+    print(f'{len(batch)} journeys, best of {args.repeats} runs')
+    for name, (best, _) in results.items():
+        print(f'{name:10} {best*1000:9.2f} ms ({len(batch)/best:10.0f} journeys/s)')
+    print(f'speedup: {results["extract_*"][0]/results["ingest"][0]:.2f}x, '
+          f'identical rows: {results["extract_*"][1] == results["ingest"][1]}')
+
+
+def bench_startup(args: argparse.Namespace):
+    '''
+    times importing each of STARTUP_MODULES
+    in a fresh interpreter (so nothing is
+    already loaded), and reports which heavy
+    dependencies each one drags in.
+    '''
+    print(f'best of {args.repeats} fresh interpreters')
+    for module in STARTUP_MODULES:
+        best = float('inf')
+        for _ in range(args.repeats):
+            out = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+                capture_output=True,
+                text=True,
+                check=True).stdout.split('\n')
+            best = min(best, float(out[0]))
+        print(f'{module:20} {best*1000:9.2f} ms  loads: {out[1] or "-"}')
+
+
+def bench_page_load(args: argparse.Namespace):
+    '''
+    serves a fixture results page locally
+    (with a small delay per response), and
+    loads it with chrome as it starts by
+    default vs as set up by the `browser`
+    config section. reports the time until
+    all results are on the page, and the
+    bytes the server sent, per page load.
+    '''
+    import os
+    import tempfile
+    import threading
+    from time import sleep
+    from functools import partial
+    from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+    from src.settings import get_settings
+    from src.browser import new_chrome_driver
+
+    settings = get_settings()
+    served = []
+
+    class FixtureHandler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            sleep(args.delay)
+            path = self.translate_path(self.path)
+            if os.path.isfile(path):
+                served.append(os.path.getsize(path))
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    setups = {
+        'default' : {'headless' : settings.browser.get('headless')},
+        'configured' : settings.browser
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_page_fixture(directory)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(FixtureHandler, directory=directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}/index.html'
+
+        results = {}
+        try:
+            for name, browser_config in setups.items():
+                driver = new_chrome_driver(settings.chromedriver, browser_config)
+                try:
+                    times = []
+                    n_bytes = []
+                    for _ in range(args.repeats):
+                        # a fresh page every time, not from the cache
+                        driver.execute_cdp_cmd('Network.setCacheDisabled', {'cacheDisabled' : True})
+                        served.clear()
+                        start = perf_counter()
+                        driver.get(url)
+                        while driver.execute_script(
+                                'return document.querySelectorAll(\'[class*="nrc6"]\').length') < N_FIXTURE_RESULTS:
+                            sleep(0.01)
+                        times.append(perf_counter() - start)
+                        # let anything still loading finish,
+                        # so it's counted for this page
+                        sleep(args.delay * 4)
+                        n_bytes.append(sum(served))
+                    results[name] = (min(times), sum(n_bytes) / len(n_bytes))
+                finally:
+                    driver.quit()
+        finally:
+            server.shutdown()
+
+    print(f'best of {args.repeats} page loads, {args.delay*1000:.0f} ms per response')
+    for name, (best, n_bytes) in results.items():
+        print(f'{name:12} {best*1000:9.2f} ms {n_bytes/1024:10.1f} KiB per page')
+    print(f'load time: {results["default"][0]/results["configured"][0]:.2f}x faster, '
+          f'bytes: {1 - results["configured"][1]/results["default"][1]:.0%} less')
+
+
+def bench_pipeline(args: argparse.Namespace):
+    '''
+    runs a 6x6 city_options search (36 urls)
+    with one session, from an archive of
+    fixture pages (each taking args.delay to
+    fetch), into a fresh db: once scraping
+    everything, then parsing and writing it,
+    and once through the staged pipeline.
+    '''
+    import os
+    import logging
+    import sqlite3
+    import tempfile
+    from time import sleep
+    import src.db_utils as db
+    from src.archive import save_snapshot
+    from src.backends import FetchBackend, ArchiveBackend
+    from src.scraper import FlightsScaper
+    from src.pipeline import ScrapePipeline
+    from src.migrations import migrate
+
+    logging.disable(logging.INFO)
+
+    class SlowArchiveBackend(ArchiveBackend):
+        def fetch(self, url, session=None):
+            sleep(args.delay)
+            return super().fetch(url, session)
+
+    origins = ['LHR', 'LGW', 'STN', 'LTN', 'LCY', 'SEN']
+    destinations = ['LAX', 'JFK', 'EWR', 'SFO', 'ORD', 'BOS']
+    search = {
+        'journey_type' : 'city_options-round_trip',
+        'origin' : origins,
+        'destination' : destinations,
+        'leave_date' : '2024-02-08',
+        'return_date' : '2024-02-25'
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        archive_path = os.path.join(directory, 'archive')
+        # new_journey_search builds the urls
+        # origin by origin
+        scraper = FlightsScaper(country='uk', backend=FetchBackend('uk'))
+        scraper.new_journey_search(**search)
+        pairs = [(o, d) for o in origins for d in destinations]
+        for url, (o, d) in zip(scraper.urls, pairs):
+            save_snapshot(
+                url, 'uk', search,
+                [make_result_block(i, o, d) for i in range(args.n_blocks)],
+                None, dt.datetime(2024, 1, 1), archive_path=archive_path)
+
+        results = {}
+        for name in ['sequential', 'pipeline']:
+            db_path = os.path.join(directory, f'{name}.sqlite')
+            with open('schema.sql') as f, sqlite3.connect(db_path) as conn:
+                conn.executescript(f.read())
+            migrate(db_path)
+
+            scraper = FlightsScaper(
+                country='uk', pool_size=1, backend=SlowArchiveBackend('uk', archive_path=archive_path))
+            scraper.new_journey_search(**search)
+
+            start = perf_counter()
+            # the sequential run writes all urls in one go,
+            # so store prices as rows for both
+            with db.DBWriter(db_path, price_storage='rows') as writer:
+                if name == 'sequential':
+                    scraper.get_all_flight_options()
+                    flight_search = db.parse_flight_search(scraper.get_journey_search())
+                    journeys, legs, prices = db.ingest_journey_options(
+                        data=scraper.journey_options, search_id=flight_search[0])
+                    writer.write_run(flight_search, journeys, legs, prices)
+                else:
+                    ScrapePipeline(scraper, writer).run()
+            elapsed = perf_counter() - start
+
+            with sqlite3.connect(db_path) as conn:
+                n_prices = conn.execute('SELECT COUNT(*) FROM prices').fetchone()[0]
+            results[name] = (elapsed, n_prices)
+
+    print(f'{len(origins) * len(destinations)} urls x {args.n_blocks} results, '
+          f'{args.delay*1000:.0f} ms per fetch, 1 session')
+    for name, (elapsed, n_prices) in results.items():
+        print(f'{name:12} {elapsed:8.2f} s  {n_prices} prices written')
+    print(f'fetching alone: {len(origins) * len(destinations) * args.delay:.2f} s')
+    print(f'speedup: {results["sequential"][0]/results["pipeline"][0]:.2f}x')
+
+
+def bench_storage(args: argparse.Namespace):
+    '''
+    writes the same simulated price history
+    (args.n_runs runs of a search over
+    args.n_urls pages) into a db storing
+    prices as rows and one storing them as
+    runs, then compacts the rows db with
+    migration 0003. compares the db sizes,
+    and checks all three give back the same
+    series for every journey. so does a
+    runs db with the same pages written in
+    a random order, as when reparsing
+    archived pages.
+    '''
+    import os
+    import random
+    import hashlib
+    import logging
+    import sqlite3
+    import tempfile
+    import src.db_utils as db
+    from src.migrations import migrate
+
+    logging.disable(logging.WARNING)
+    rng = random.Random(0)
+
+    def db_size(db_path):
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('VACUUM')
+            return conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+
+    def series(db_path, journey_ids):
+        with sqlite3.connect(db_path) as conn:
+            return {
+                journey_id : [(row['price'], row['created_at']) for row in db.get_prices_for_journey(journey_id, conn=conn)]
+                for journey_id in journey_ids}
+
+    urls = [f'https://example.com/flights/{i}' for i in range(args.n_urls)]
+    # as long as real (sha256) journey ids
+    journey_ids = {
+        url : [hashlib.sha256(f'{url} {j}'.encode()).hexdigest() for j in range(args.n_journeys)]
+        for url in urls}
+    current_prices = {journey_id : rng.randint(100, 900) for ids in journey_ids.values() for journey_id in ids}
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {name : os.path.join(directory, f'{name}.sqlite') for name in ['rows', 'runs', 'backfilled']}
+        for name, db_path in paths.items():
+            with open('schema.sql') as f, sqlite3.connect(db_path) as conn:
+                conn.executescript(f.read())
+            # the rows db stops short of migration 0003,
+            # which we run on it afterwards
+            migrate(db_path, target_version=2 if name == 'rows' else None)
+
+        writers = {
+            name : db.DBWriter(paths[name], price_storage=name, daily_rollups=False)
+            for name in ['rows', 'runs']}
+        write_seconds = dict.fromkeys(writers, 0.0)
+        n_prices = 0
+        pages = []
+        start_time = dt.datetime(2024, 1, 1)
+        for run in range(args.n_runs):
+            for i, url in enumerate(urls):
+                created_at = (start_time + dt.timedelta(hours=run, seconds=i)).isoformat()
+                prices = []
+                for journey_id in journey_ids[url]:
+                    if rng.random() < args.change_rate:
+                        current_prices[journey_id] += rng.randint(-50, 50)
+                    if rng.random() >= args.change_rate:
+                        prices.append((journey_id, current_prices[journey_id], 'GBP', created_at))
+                n_prices += len(prices)
+                pages.append((url, prices))
+
+                for name, writer in writers.items():
+                    start = perf_counter()
+                    with writer.transaction():
+                        writer.write_prices(prices, url)
+                    write_seconds[name] += perf_counter() - start
+
+        for writer in writers.values():
+            writer.close()
+
+        rng.shuffle(pages)
+        with db.DBWriter(paths['backfilled'], price_storage='runs', daily_rollups=False) as writer:
+            for url, prices in pages:
+                with writer.transaction():
+                    writer.write_prices(prices, url)
+
+        sample = [ids[0] for ids in journey_ids.values()]
+        # straight from the prices table, as the
+        # query layer needs migration 0003
+        with sqlite3.connect(paths['rows']) as conn:
+            expected = {
+                journey_id : conn.execute(
+                    'SELECT price, created_at FROM prices WHERE journey_id = ? ORDER BY created_at',
+                    (journey_id,)).fetchall()
+                for journey_id in sample}
+        sizes = {name : db_size(paths[name]) for name in writers}
+
+        start = perf_counter()
+        migrate(paths['rows'])
+        migrate_seconds = perf_counter() - start
+        sizes['compacted'] = db_size(paths['rows'])
+
+        same = {
+            'runs' : series(paths['runs'], sample) == expected,
+            'compacted' : series(paths['rows'], sample) == expected,
+            'backfilled' : series(paths['backfilled'], sample) == expected}
+        n_runs = {}
+        for name in ['runs', 'backfilled']:
+            with sqlite3.connect(paths[name]) as conn:
+                n_runs[name] = conn.execute('SELECT COUNT(*) FROM price_runs').fetchone()[0]
+
+    print(f'{args.n_runs} runs x {args.n_urls} urls x {args.n_journeys} journeys: '
+          f'{n_prices} prices, {n_runs["runs"]} price runs')
+    print(f'rows        {sizes["rows"]/1e6:8.2f} MB  written in {write_seconds["rows"]:.2f} s')
+    print(f'runs        {sizes["runs"]/1e6:8.2f} MB  written in {write_seconds["runs"]:.2f} s, same series: {same["runs"]}')
+    print(f'compacted   {sizes["compacted"]/1e6:8.2f} MB  migrated in {migrate_seconds:.2f} s, same series: {same["compacted"]}')
+    print(f'backfilled  {n_runs["backfilled"]} price runs from the pages in a random order, same series: {same["backfilled"]}')
+    print(f'rows / runs: {sizes["rows"]/sizes["runs"]:.1f}x')
+
+
+def bench_rollups(args: argparse.Namespace):
+    '''
+    fills a db with args.n_days of price
+    history (as rows) and builds the daily
+    price tables from it. then answers
+    'cheapest price per route per day' from
+    the raw prices and from daily_route_prices,
+    and times writing pages of prices with and
+    without keeping the daily tables up to date.
+    '''
+    import os
+    import random
+    import hashlib
+    import logging
+    import sqlite3
+    import tempfile
+    import src.db_utils as db
+    from src.migrations import migrate
+
+    logging.disable(logging.INFO)
+    rng = random.Random(0)
+
+    raw_q = '''
+        SELECT l.departure_airport, l.arrival_airport, substr(p.created_at, 1, 10) AS day, MIN(p.price)
+        FROM prices p
+        JOIN journeys j ON j.journey_id = p.journey_id
+        JOIN legs l ON l.journey_id = j.journey_id AND l.leg_number = 1
+        GROUP BY 1, 2, 3
+    '''
+    rollup_q = '''
+        SELECT origin, destination, day, MIN(min_price)
+        FROM daily_route_prices
+        GROUP BY 1, 2, 3
+    '''
+
+    routes = [(f'A{i:02d}', f'B{i:02d}') for i in range(args.n_routes)]
+    journeys = {
+        route : [hashlib.sha256(f'{route} {j}'.encode()).hexdigest() for j in range(args.n_journeys)]
+        for route in routes}
+    start_time = dt.datetime(2024, 1, 1)
+
+    def page_prices(route, observed_at):
+        return [(journey_id, float(rng.randint(100, 900)), 'GBP', observed_at.isoformat()) for journey_id in journeys[route]]
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'rollups.sqlite')
+        with open('schema.sql') as f, sqlite3.connect(db_path) as conn:
+            conn.executescript(f.read())
+        migrate(db_path)
+
+        with db.DBWriter(db_path, price_storage='rows', daily_rollups=False) as writer, writer.transaction():
+            for route, journey_ids in journeys.items():
+                writer.insert('journeys', [(journey_id, 'bench', 1, 0, 0, 'Economy', 'BA') for journey_id in journey_ids])
+                writer.insert('legs', [
+                    (f'{journey_id}_1', journey_id, 1, None, None, route[0], route[1], None, 0, None, None, None)
+                    for journey_id in journey_ids])
+            for day in range(args.n_days):
+                for k in range(args.n_observations):
+                    observed_at = start_time + dt.timedelta(days=day, hours=k * 24 / args.n_observations)
+                    for route in routes:
+                        writer.insert('prices', page_prices(route, observed_at))
+
+        with db.DBWriter(db_path) as writer:
+            start = perf_counter()
+            writer.rebuild_rollups()
+            rebuild_seconds = perf_counter() - start
+
+        with sqlite3.connect(db_path) as conn:
+            n_prices = conn.execute('SELECT COUNT(*) FROM prices').fetchone()[0]
+            n_rollup_rows = conn.execute('SELECT COUNT(*) FROM daily_route_prices').fetchone()[0]
+            results = {}
+            for name, q in [('raw prices', raw_q), ('rollup', rollup_q)]:
+                start = perf_counter()
+                rows = conn.execute(q).fetchall()
+                results[name] = (perf_counter() - start, sorted(rows))
+
+        # pages of new prices, the day after the history
+        write_seconds = {}
+        n_pages = args.n_observations * len(routes)
+        for daily_rollups in [False, True]:
+            with db.DBWriter(db_path, price_storage='rows', daily_rollups=daily_rollups) as writer:
+                elapsed = 0.0
+                for k in range(args.n_observations):
+                    observed_at = start_time + dt.timedelta(days=args.n_days + daily_rollups, hours=k)
+                    for route in routes:
+                        prices = page_prices(route, observed_at)
+                        start = perf_counter()
+                        with writer.transaction():
+                            writer.write_prices(prices)
+                        elapsed += perf_counter() - start
+                write_seconds[daily_rollups] = elapsed
+
+    print(f'{n_prices} prices over {args.n_days} days and {args.n_routes} routes, '
+          f'{n_rollup_rows} daily_route_prices rows (rebuilt in {rebuild_seconds:.2f} s)')
+    for name, (elapsed, _) in results.items():
+        print(f'{name:12} {elapsed*1000:9.2f} ms  cheapest per route per day')
+    print(f'speedup: {results["raw prices"][0]/results["rollup"][0]:.0f}x, '
+          f'same answer: {results["raw prices"][1] == results["rollup"][1]}')
+    print(f'writing {n_pages} pages of {args.n_journeys} prices: {write_seconds[False]*1000/n_pages:.2f} ms/page without, '
+          f'{write_seconds[True]*1000/n_pages:.2f} ms/page with daily tables')
+
+
+def bench_analytics(args: argparse.Namespace):
+    '''
+    fills a db with args.n_days of price
+    history for args.n_searches searches,
+    written straight in as price runs, then
+    works out the trends of every search with
+    a TrendEngine (cold, then again from its
+    cache), and the daily cheapest and median
+    prices of a few of them with a python loop
+    over get_prices_for_search, for comparison.
+    '''
+    import os
+    import logging
+    import sqlite3
+    import tempfile
+    import statistics
+    import numpy as np
+    import src.db_utils as db
+    import src.analytics as analytics
+    from src.migrations import migrate
+
+    logging.disable(logging.INFO)
+    rng = np.random.default_rng(0)
+
+    search_ids = [f'search_{i:03d}' for i in range(args.n_searches)]
+    n_scrapes = args.n_days * args.n_observations
+    start_time = np.datetime64('2024-01-01T00:00:00', 'us')
+    scraped_at = [
+        str(t) for t in start_time + (np.arange(n_scrapes) * (86400e6 / args.n_observations)).astype('timedelta64[us]')]
+
+    def loop_trends(search_id, conn):
+        # what we'd do without numpy
+        prices_by_day = {}
+        for row in db.get_prices_for_search(search_id, conn=conn):
+            prices_by_day.setdefault(row['created_at'][:10], []).append(row['price'])
+        return {day : (min(prices), statistics.median(prices)) for day, prices in sorted(prices_by_day.items())}
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'analytics.sqlite')
+        with open('schema.sql') as f, sqlite3.connect(db_path) as conn:
+            conn.executescript(f.read())
+        migrate(db_path)
+
+        # every search is one page, scraped n_scrapes times. a
+        # journey's run ends whenever its price changes
+        start = perf_counter()
+        with sqlite3.connect(db_path) as conn:
+            for source_id, search_id in enumerate(search_ids, start=1):
+                journey_ids = [f'{search_id}_{j:03d}' for j in range(args.n_journeys)]
+                conn.executemany(
+                    'INSERT INTO journeys (journey_id, search_id, n_legs) VALUES (?, ?, 1)',
+                    [(journey_id, search_id) for journey_id in journey_ids])
+                conn.execute('INSERT INTO price_sources (source_id, source) VALUES (?, ?)', (source_id, search_id))
+                conn.executemany(
+                    'INSERT INTO price_observations (source_id, observed_at) VALUES (?, ?)',
+                    [(source_id, t) for t in scraped_at])
+
+                changes = rng.random((args.n_journeys, n_scrapes)) < args.change_rate
+                changes[:, 0] = True
+                journeys, firsts = np.nonzero(changes)
+                lasts = np.append(firsts[1:] - 1, n_scrapes - 1)
+                lasts = np.where(np.append(journeys[1:] != journeys[:-1], True), n_scrapes - 1, lasts)
+                prices = rng.integers(100, 900, len(firsts))
+                conn.executemany(
+                    '''
+                    INSERT INTO price_runs (journey_id, source_id, price, currency, first_seen, last_seen, n_seen)
+                    VALUES (?, ?, ?, 'GBP', ?, ?, ?)
+                    ''',
+                    [(journey_ids[j], source_id, float(p), scraped_at[f], scraped_at[l], int(l - f + 1))
+                     for j, p, f, l in zip(journeys.tolist(), prices.tolist(), firsts.tolist(), lasts.tolist())])
+            n_runs = conn.execute('SELECT COUNT(*) FROM price_runs').fetchone()[0]
+        fill_seconds = perf_counter() - start
+
+        start = perf_counter()
+        with db.DBWriter(db_path) as writer:
+            writer.rebuild_rollups()
+        rebuild_seconds = perf_counter() - start
+
+        engine = analytics.TrendEngine(db_path)
+        start = perf_counter()
+        trends = engine.trends_for(search_ids)
+        cold_seconds = perf_counter() - start
+        start = perf_counter()
+        engine.trends_for(search_ids)
+        warm_seconds = perf_counter() - start
+
+        loop_searches = search_ids[:args.n_loop_searches]
+        with sqlite3.connect(db_path) as conn:
+            start = perf_counter()
+            looped = {search_id : loop_trends(search_id, conn) for search_id in loop_searches}
+            loop_seconds = perf_counter() - start
+        engine.close()
+
+    n_prices = sum(t.n_prices for t in trends.values())
+    same = all(
+        [(min_price, median) for min_price, median in looped[search_id].values()]
+        == list(zip(trends[search_id].daily_min.tolist(), trends[search_id].daily_median.tolist()))
+        for search_id in loop_searches)
+
+    print(f'{n_prices} prices ({n_runs} runs) over {args.n_days} days and {args.n_searches} searches '
+          f'(written in {fill_seconds:.1f} s, daily tables rebuilt in {rebuild_seconds:.1f} s)')
+    print(f'trend engine, cold   {cold_seconds:8.2f} s  ({cold_seconds*1000/args.n_searches:.1f} ms/search)')
+    print(f'trend engine, cached {warm_seconds:8.2f} s  ({warm_seconds*1000/args.n_searches:.2f} ms/search)')
+    if loop_searches:
+        per_search = loop_seconds / len(loop_searches)
+        print(f'python loop          {per_search*args.n_searches:8.2f} s  ({per_search*1000:.1f} ms/search, '
+              f'daily min and median only, timed on {len(loop_searches)} searches)')
+        print(f'speedup: {per_search/(cold_seconds/args.n_searches):.0f}x, same daily min and median: {same}')
+
+
+def bench_export(args: argparse.Namespace):
+    '''
+    turns a batch of journey options into
+    price history rows straight from memory
+    (export.journey_option_rows), and by
+    writing them to a db and reading them
+    back with get_price_history, for both
+    views. times both, and checks they give
+    the same rows. every journey comes up at
+    two prices (like economy and business),
+    which the db keeps one set of legs for.
+    '''
+    import os
+    import logging
+    import sqlite3
+    import tempfile
+    import src.db_utils as db
+    from src.export import journey_option_rows
+    from src.migrations import migrate
+
+    logging.disable(logging.WARNING)
+
+    batch = make_journey_batch(args.n_journeys)
+    batch += [{**option, 'meta' : {**option['meta'], 'price' : option['meta']['price'] + 200}} for option in batch]
+    flight_search = db.parse_flight_search({
+        'journey_type' : 'round_trip',
+        'origin' : 'LHR',
+        'destination' : 'LAX',
+        'leave_date' : dt.datetime(2024, 2, 8),
+        'return_date' : dt.datetime(2024, 2, 25),
+        'flex' : None})
+    search_id = flight_search[0]
+
+    def sort(rows):
+        return sorted(tuple(str(value) for value in row) for row in rows)
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'export.sqlite')
+        with open('schema.sql') as f, sqlite3.connect(db_path) as conn:
+            conn.executescript(f.read())
+        migrate(db_path)
+
+        start = perf_counter()
+        with db.DBWriter(db_path, price_storage='rows', daily_rollups=False) as writer:
+            writer.write_run(flight_search, *db.ingest_journey_options(data=batch, search_id=search_id))
+        write_seconds = perf_counter() - start
+
+        results = {}
+        with sqlite3.connect(db_path) as conn:
+            for view in ['journeys', 'legs']:
+                start = perf_counter()
+                memory = [tuple(row.values()) for row in journey_option_rows(batch, search_id, view=view)]
+                memory_seconds = perf_counter() - start
+
+                start = perf_counter()
+                from_db = [tuple(row.values()) for row in db.get_price_history(view, search_id, conn=conn)]
+                db_seconds = perf_counter() - start
+
+                results[view] = (memory_seconds, db_seconds, len(memory), sort(memory) == sort(from_db))
+
+    print(f'{len(batch)} journey options ({args.n_journeys} journeys at two prices), '
+          f'written to the db in {write_seconds:.2f} s')
+    for view, (memory_seconds, db_seconds, n_rows, same) in results.items():
+        print(f'{view:9} {n_rows:7} rows  from memory {memory_seconds:.2f} s, from the db {db_seconds:.2f} s, '
+              f'same rows: {same}')
+
+
+BENCHMARKS = {
+    'parse' : bench_parse,
+    'ingest' : bench_ingest,
+    'startup' : bench_startup,
+    'page-load' : bench_page_load,
+    'pipeline' : bench_pipeline,
+    'storage' : bench_storage,
+    'rollups' : bench_rollups,
+    'analytics' : bench_analytics,
+    'export' : bench_export
+}
+
+############
+# THE THING!
+############
+if __name__ == '__main__':
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -11,17 +11,18 @@
 ############
 # IMPORTS 
 ############
-import os
-from dotenv import load_dotenv
 import sys
 import logging
 import argparse
 from datetime import datetime
 
-from src.scraper import FlightsScaper, CONFIG
-import src.db_utils as db 
+# NOTE: the scraper (and with it selenium)
+# and db_utils are only imported once the
+# args are parsed, so --help and bad args
+# come back straight away.
+from src.settings import get_settings
 
-load_dotenv()
+SETTINGS = get_settings()
 
 ############
 # CLI
@@ -42,15 +43,15 @@ parser = argparse.ArgumentParser(
 parser.add_argument(
     '-j', 
     '--journey_type',
-    choices=CONFIG['permitted_journey_types'],
-    required=True,
+    choices=SETTINGS.permitted_journey_types,
+    required=False,
     help='journey type of search')
 
 parser.add_argument(
     '-d', 
     '--departure_airport',
     nargs='+',
-    required=True,
+    required=False,
     help='departure airport code',
     action=SingleOrListAction)
 
@@ -58,7 +59,7 @@ parser.add_argument(
     '-a', 
     '--arrival_airport',
     nargs='+',
-    required=True,
+    required=False,
     help='arrival airport code',
     action=SingleOrListAction)
 
@@ -66,7 +67,7 @@ parser.add_argument(
     '-f', 
     '--from_date',
     nargs='+',
-    required=True,
+    required=False,
     help='from; leave date for the journey. format: YYYY-MM-DD')
 
 parser.add_argument(
@@ -81,7 +82,7 @@ parser.add_argument(
     '-fl',
     '--flex',
     nargs='?',
-    choices=CONFIG['permitted_flex'].keys(),
+    choices=SETTINGS.permitted_flex.keys(),
     required=False,
     default=None,
     help='flexibility of dates')
@@ -89,10 +90,28 @@ parser.add_argument(
 parser.add_argument(
     '-c',
     '--country',
-    choices=CONFIG['permitted_countries'],
+    choices=SETTINGS.permitted_countries,
     default='uk',
     help='country/domain ending of flights site')
 
+parser.add_argument(
+    '-m',
+    '--manifest',
+    default=None,
+    help='yaml or jsonl file of searches to run in one go, instead of -j/-d/-a/-f. see searches_example.yaml')
+
+parser.add_argument(
+    '-b',
+    '--backend',
+    choices=['selenium', 'archive'],
+    default='selenium',
+    help='how to fetch pages: with chrome, or from the archive of previously scraped pages')
+
+parser.add_argument(
+    '--fresh',
+    action='store_true',
+    help='start a new run, rather than resuming an unfinished recent run of the same search')
+
 parser.add_argument(
     '-l', 
     '--log_to_stdout', 
@@ -101,11 +120,22 @@ parser.add_argument(
 
 args = parser.parse_args()
 
+if args.manifest is None:
+    missing = [
+        option for option, value in [
+            ('-j/--journey_type', args.journey_type),
+            ('-d/--departure_airport', args.departure_airport),
+            ('-a/--arrival_airport', args.arrival_airport),
+            ('-f/--from_date', args.from_date)]
+        if value is None]
+    if missing:
+        parser.error(f'the following arguments are required without --manifest: {", ".join(missing)}')
+
 ############
 # INIT
 ############
 todays_logfile = f'{datetime.now().strftime("%Y-%m-%d_%H-%M")}.log'
-file_handler = logging.FileHandler(filename=os.getenv('LOG_FILE_PATH')+todays_logfile)
+file_handler = logging.FileHandler(filename=SETTINGS.log_file_path+todays_logfile)
 stdout_handler = logging.StreamHandler(sys.stdout)
 
 if args.log_to_stdout:
@@ -115,14 +145,73 @@ else:
 
 logging.basicConfig(
     level=logging.INFO, # change to DEBUG for messages from all the dependencies 
-    format=os.getenv('LOG_FORMAT'),
+    format=SETTINGS.log_format,
     handlers=handlers)
 
 ############
 # THE THING!
 ############
+from src.scraper import FlightsScaper
+from src.backends import new_backend
+from src.pipeline import ScrapePipeline, RESUME_WITHIN
+import src.db_utils as db
+
+def run_manifest(manifest: str):
+    '''
+    runs every search in a manifest with one
+    scraper per country (so one set of browsers)
+    and one db connection, committing each search
+    as it's done. prints a summary at the end.
+    '''
+    from time import perf_counter
+    from src.runner import load_searches, run_search
+
+    searches = load_searches(manifest)
+    scrapers = {}
+    summaries = []
+    start = perf_counter()
+
+    try:
+        with db.DBWriter() as writer:
+            for i, search in enumerate(searches):
+                logging.info(f'running search {i+1} of {len(searches)}: {search["name"]}')
+                if search['country'] not in scrapers:
+                    logging.info(f'flights scraper init for {search["country"]}')
+                    scrapers[search['country']] = FlightsScaper(
+                        country=search['country'],
+                        backend=new_backend(args.backend, search['country']))
+
+                try:
+                    summaries.append(run_search(scrapers[search['country']], writer, search, resume=not args.fresh))
+                except Exception as e:
+                    logging.exception(f'search {search["name"]} failed: {e}')
+                    summaries.append({'name' : search['name'], 'error' : str(e)})
+    finally:
+        logging.info('shutting down browser drivers')
+        for scraper in scrapers.values():
+            scraper.quit()
+
+    print(f'{"search":30} {"urls":>5} {"options":>8} {"prices":>7} {"cheapest":>9} {"secs":>7}')
+    for summary in summaries:
+        if 'error' in summary:
+            print(f'{summary["name"]:30} FAILED: {summary["error"]}')
+        else:
+            print(f'{summary["name"]:30} {summary["n_urls"]:5} {summary["n_options"]:8} '
+                  f'{summary["n_prices"]:7} {str(summary["min_price"]):>9} {summary["seconds"]:7.1f}')
+
+    n_failed = sum('error' in summary for summary in summaries)
+    print(f'ran {len(summaries)} searches in {perf_counter()-start:.1f}s, {n_failed} failed')
+
+    if n_failed:
+        sys.exit(1)
+
+
+if args.manifest is not None:
+    run_manifest(args.manifest)
+    sys.exit(0)
+
 logging.info('flights scraper init')
-my_flight = FlightsScaper(country=args.country)
+my_flight = FlightsScaper(country=args.country, backend=new_backend(args.backend, args.country))
 
 logging.info('adding new flight search to my_flight')
 my_flight.new_journey_search(
@@ -133,21 +222,18 @@ my_flight.new_journey_search(
     return_date=args.to_date,
     flex=args.flex)
 
-logging.info('getting flight options')
-my_flight.get_all_flight_options()
-
-logging.info('shutting down browser driver')
-my_flight.driver.quit()
-
-logging.info('parsing & validating data for insert into db')
-flight_search = db.parse_flight_search(my_flight.get_journey_search())
-search_id = flight_search[0]
-journeys = db.extract_journeys(data=my_flight.journey_options, search_id=search_id)
-legs = db.extract_legs(data=my_flight.journey_options)
-prices = db.extract_prices(my_flight.journey_options)
-
-logging.info('inserting data into db')
-db.execute_insert_query(table='flight_searches', columns=db.INSERT_MAP['flight_searches'], data=flight_search)
-db.execute_insert_query(table='journeys', columns=db.INSERT_MAP['journeys'], data=journeys)
-db.execute_insert_query(table='legs', columns=db.INSERT_MAP['legs'], data=legs)
-db.execute_insert_query(table='prices', columns=db.INSERT_MAP['prices'], data=prices)
\ No newline at end of file
+# the browsers load the next url while the
+# last page is parsed and written to the db
+logging.info('getting flight options, parsing & inserting them into the db')
+try:
+    with db.DBWriter() as writer:
+        summary = ScrapePipeline(
+            my_flight,
+            writer,
+            resume_within=None if args.fresh else RESUME_WITHIN).run()
+finally:
+    logging.info('shutting down browser drivers')
+    my_flight.quit()
+
+logging.info(f'done: {summary["n_pages"]} pages ({summary["n_resumed_urls"]} done in an earlier run), {summary["n_options"]} journey options, '
+             f'{summary["n_prices"]} prices in {summary["seconds"]:.1f}s')
@@ -0,0 +1,469 @@
+# manage.py
+# flight_prices_trends
+
+# a script for the maintenance tasks
+# that don't involve scraping, e.g.
+# re-parsing archived pages into the db.
+
+# usage: python manage.py <command> [args]
+
+############
+# IMPORTS
+############
+import sys
+import logging
+import argparse
+import datetime as dt
+
+# NOTE: everything else is imported inside
+# the command that needs it, so e.g. `query`
+# never loads selenium.
+from src.settings import get_settings
+
+############
+# CLI
+############
+parser = argparse.ArgumentParser(
+    description='maintenance tasks for flight_prices_trends')
+
+parser.add_argument(
+    '-l',
+    '--log_to_stdout',
+    action='store_true',
+    help= 'print logging msgs to stdout')
+
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+# reparse
+reparse_parser = subparsers.add_parser(
+    'reparse',
+    help='re-run the parser over archived pages, and insert the results into the db')
+
+reparse_parser.add_argument(
+    '-u',
+    '--url',
+    default=None,
+    help='only reparse snapshots of this url')
+
+reparse_parser.add_argument(
+    '-f',
+    '--captured_from',
+    default=None,
+    help='only reparse snapshots captured on or after this date. format: YYYY-MM-DD')
+
+reparse_parser.add_argument(
+    '-t',
+    '--captured_to',
+    default=None,
+    help='only reparse snapshots captured on or before this date. format: YYYY-MM-DD')
+
+reparse_parser.add_argument(
+    '-n',
+    '--dry_run',
+    action='store_true',
+    help='parse, but don\'t write to the db')
+
+# migrate
+migrate_parser = subparsers.add_parser(
+    'migrate',
+    help='upgrade the db schema in place, and check the hot queries use their indexes')
+
+migrate_parser.add_argument(
+    '--target',
+    type=int,
+    default=None,
+    help='only migrate up to this version')
+
+migrate_parser.add_argument(
+    '--check',
+    action='store_true',
+    help='only check the query plans, don\'t migrate')
+
+# distances
+distances_parser = subparsers.add_parser(
+    'distances',
+    help='(re)calculate the nominal and absolute distances of all legs in the db')
+
+distances_parser.add_argument(
+    '-m',
+    '--missing_only',
+    action='store_true',
+    help='only fill in legs without distances')
+
+# query
+query_parser = subparsers.add_parser(
+    'query',
+    help='print the recorded prices of a search or a journey')
+
+query_target = query_parser.add_mutually_exclusive_group(required=True)
+
+query_target.add_argument(
+    '-s',
+    '--search_id',
+    default=None,
+    help='print the prices of every journey of this search')
+
+query_target.add_argument(
+    '-j',
+    '--journey_id',
+    default=None,
+    help='print the prices of this journey')
+
+query_parser.add_argument(
+    '-f',
+    '--date_from',
+    default=None,
+    help='only prices recorded on or after this date. format: YYYY-MM-DD')
+
+query_parser.add_argument(
+    '-t',
+    '--date_to',
+    default=None,
+    help='only prices recorded on or before this date. format: YYYY-MM-DD')
+
+query_parser.add_argument(
+    '-d',
+    '--daily',
+    action='store_true',
+    help='print the cheapest, dearest and mean price per day of the search, from the daily price tables')
+
+# rollups
+rollups_parser = subparsers.add_parser(
+    'rollups',
+    help='rebuild the daily price tables from the recorded prices')
+
+rollups_parser.add_argument(
+    '-f',
+    '--date_from',
+    default=None,
+    help='only rebuild days on or after this date. format: YYYY-MM-DD')
+
+rollups_parser.add_argument(
+    '-t',
+    '--date_to',
+    default=None,
+    help='only rebuild days on or before this date. format: YYYY-MM-DD')
+
+# trends
+trends_parser = subparsers.add_parser(
+    'trends',
+    help='print the price trends of searches: best price, rolling min / median, day-over-day drops')
+
+trends_parser.add_argument(
+    '-s',
+    '--search_id',
+    nargs='+',
+    required=True,
+    help='the searches to look at')
+
+trends_parser.add_argument(
+    '-w',
+    '--window',
+    type=int,
+    default=7,
+    help='days in the rolling min / median')
+
+trends_parser.add_argument(
+    '-d',
+    '--daily',
+    action='store_true',
+    help='print every day of each search, rather than a line per search')
+
+# export
+export_parser = subparsers.add_parser(
+    'export',
+    help='write the recorded prices, with their journeys (and legs), to a csv or parquet file')
+
+export_parser.add_argument(
+    'path',
+    help='file to write to. the format goes by the extension (.csv or .parquet), unless given')
+
+export_parser.add_argument(
+    '-v',
+    '--view',
+    choices=['journeys', 'legs'],
+    default='journeys',
+    help='a row per price observed of a journey, or per leg of it')
+
+export_parser.add_argument(
+    '-s',
+    '--search_id',
+    nargs='+',
+    default=None,
+    help='only the prices of these searches')
+
+export_parser.add_argument(
+    '-f',
+    '--date_from',
+    default=None,
+    help='only prices recorded on or after this date. format: YYYY-MM-DD')
+
+export_parser.add_argument(
+    '-t',
+    '--date_to',
+    default=None,
+    help='only prices recorded on or before this date. format: YYYY-MM-DD')
+
+export_parser.add_argument(
+    '--format',
+    choices=['csv', 'parquet'],
+    default=None,
+    help='export format, if not going by the extension')
+
+export_parser.add_argument(
+    '-b',
+    '--batch_size',
+    type=int,
+    default=10000,
+    help='rows per write (and per parquet row group)')
+
+############
+# COMMANDS
+############
+def reparse(args: argparse.Namespace):
+    '''
+    re-parses archived snapshots, and
+    inserts the results into the db,
+    exactly as if they had just been
+    scraped (the original scrape time
+    is kept as created_at).
+    '''
+    from src.archive import iter_snapshots
+    from src.scraper import FlightsScaper
+    import src.db_utils as db
+
+    n_snapshots = 0
+    n_options = 0
+    n_failed = 0
+    failed_blocks = []
+
+    writer = None if args.dry_run else db.DBWriter()
+
+    try:
+        for snapshot in iter_snapshots(
+                url=args.url,
+                captured_from=args.captured_from,
+                captured_to=args.captured_to):
+            n_snapshots += 1
+            journey_search = snapshot['journey_search']
+            logging.info(f'reparsing {snapshot["url"]} captured at {snapshot["captured_at"]}')
+
+            try:
+                journey_options = FlightsScaper.parse_result_blocks(
+                    snapshot['blocks'],
+                    FlightsScaper.journey_dates(
+                        journey_search['leave_date'],
+                        journey_search.get('return_date'),
+                        journey_search['journey_type']),
+                    journey_search['journey_type'],
+                    snapshot['country'],
+                    created_at=dt.datetime.fromisoformat(snapshot['captured_at']),
+                    failed_blocks=failed_blocks)
+            except ValueError as e:
+                logging.error(f'failed to parse snapshot {snapshot["digest"]}: {e}')
+                n_failed += 1
+                continue
+
+            n_options += len(journey_options)
+            if args.dry_run or not journey_options:
+                continue
+
+            flight_search = db.parse_flight_search(
+                FlightsScaper.journey_search_datetimes(journey_search))
+            search_id = flight_search[0]
+            journeys, legs, prices = db.ingest_journey_options(data=journey_options, search_id=search_id)
+            prices = db.drop_recorded_prices(prices, conn=writer.conn)
+
+            writer.write_run(flight_search, journeys, legs, prices, source=snapshot['url'])
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print(f'reparsed {n_snapshots} snapshots: {n_options} journey options, {n_failed} failed, '
+          f'{len(failed_blocks)} blocks skipped')
+
+
+def migrate(args: argparse.Namespace):
+    '''
+    brings the db up to the latest schema
+    version, then checks that the hot
+    queries are using their indexes.
+    '''
+    from src.migrations import migrate, check_query_plans
+
+    if not args.check:
+        version = migrate(target_version=args.target)
+        print(f'db is at version {version}')
+        if args.target is not None:
+            # not at the latest version, so
+            # there's nothing to check
+            return
+
+    try:
+        plans = check_query_plans()
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    n_failed = 0
+    for name, (ok, plan) in plans.items():
+        print(f'{"ok  " if ok else "FAIL"} {name}: {" / ".join(plan)}')
+        n_failed += not ok
+
+    if n_failed:
+        sys.exit(1)
+
+
+def distances(args: argparse.Namespace):
+    '''
+    backfills leg distances over
+    the whole legs table.
+    '''
+    from time import perf_counter
+    import src.db_utils as db
+
+    start = perf_counter()
+    n_updated = db.backfill_leg_distances(missing_only=args.missing_only)
+    print(f'updated distances for {n_updated} legs in {perf_counter()-start:.2f}s')
+
+
+def query(args: argparse.Namespace):
+    '''
+    prints recorded prices as tab-separated
+    rows, streamed straight from the db.
+    '''
+    import src.db_utils as db
+
+    if args.daily:
+        if not args.search_id:
+            parser.error('--daily needs a search_id (-s)')
+        print('day\tcurrency\tmin_price\tmax_price\tmean_price\tn_prices')
+        for row in db.get_daily_prices(
+                'search', search_date_from=args.date_from, search_date_to=args.date_to, search_id=args.search_id):
+            print(f'{row["day"]}\t{row["currency"]}\t{row["min_price"]}\t{row["max_price"]}\t'
+                  f'{row["mean_price"]:.2f}\t{row["n_prices"]}')
+        return
+
+    if args.journey_id:
+        rows = db.get_prices_for_journey(
+            args.journey_id, search_date_from=args.date_from, search_date_to=args.date_to)
+    else:
+        rows = db.get_prices_for_search(
+            args.search_id, search_date_from=args.date_from, search_date_to=args.date_to)
+
+    print('journey_id\tprice\tcurrency\tcreated_at')
+    for row in rows:
+        print(f'{row["journey_id"]}\t{row["price"]}\t{row["currency"]}\t{row["created_at"]}')
+
+
+def rollups(args: argparse.Namespace):
+    '''
+    recalculates the daily price tables,
+    e.g. after a backfill.
+    '''
+    from time import perf_counter
+    import src.db_utils as db
+
+    start = perf_counter()
+    with db.DBWriter() as writer:
+        n_rows = writer.rebuild_rollups(search_date_from=args.date_from, search_date_to=args.date_to)
+    print(f'rebuilt daily price tables in {perf_counter()-start:.2f}s: '
+          f'{", ".join(f"{n} {rollup} rows" for rollup, n in n_rows.items())}')
+
+
+def trends(args: argparse.Namespace):
+    '''
+    prints the price trends of searches as
+    tab-separated rows, a line per search
+    (or per day of each search).
+    '''
+    from src.analytics import TrendEngine
+
+    engine = TrendEngine(window=args.window)
+    try:
+        if args.daily:
+            print('search_id\tday\tn_prices\tmin_price\tmedian_price\tmax_price\t'
+                  'rolling_min\trolling_median\tchange\tjourney_drops')
+        else:
+            print('search_id\tcurrency\tn_prices\tbest_price\tbest_price_at\tbest_journey_id\t'
+                  'latest_min\trolling_median\tbiggest_drop\tbiggest_drop_day')
+
+        for search_id in args.search_id:
+            try:
+                trends = engine.trends(search_id)
+            except ValueError as e:
+                # e.g. prices in several currencies,
+                # the other searches are still fine
+                logging.error(e)
+                print(e, file=sys.stderr)
+                continue
+            if trends is None:
+                logging.warning(f'no prices for search {search_id}')
+                continue
+
+            if args.daily:
+                for i, day in enumerate(trends.days):
+                    print(f'{search_id}\t{day}\t{trends.n_prices_per_day[i]}\t{trends.daily_min[i]}\t'
+                          f'{trends.daily_median[i]}\t{trends.daily_max[i]}\t{trends.rolling_min[i]}\t'
+                          f'{trends.rolling_median[i]}\t{trends.daily_change[i]}\t{trends.journey_drops[i]}')
+                continue
+
+            drop_day, drop = trends.biggest_drop() or (None, None)
+            print(f'{search_id}\t{trends.currency}\t{trends.n_prices}\t{trends.best_price}\t'
+                  f'{trends.best_price_at.isoformat()}\t{trends.best_journey_id}\t{trends.daily_min[-1]}\t'
+                  f'{trends.rolling_median[-1]}\t{drop}\t{drop_day}')
+    finally:
+        engine.close()
+
+
+def export(args: argparse.Namespace):
+    '''
+    streams the price history (a journey
+    or a leg per row) from the db into a
+    csv or parquet file.
+    '''
+    from time import perf_counter
+    from src.export import export_price_history
+
+    start = perf_counter()
+    n_rows = export_price_history(
+        args.path,
+        view=args.view,
+        search_id=args.search_id,
+        search_date_from=args.date_from,
+        search_date_to=args.date_to,
+        fmt=args.format,
+        batch_size=args.batch_size)
+    print(f'exported {n_rows} rows to {args.path} in {perf_counter()-start:.2f}s')
+
+
+COMMANDS = {
+    'reparse' : reparse,
+    'migrate' : migrate,
+    'distances' : distances,
+    'query' : query,
+    'rollups' : rollups,
+    'trends' : trends,
+    'export' : export
+}
+
+############
+# THE THING!
+############
+if __name__ == '__main__':
+    args = parser.parse_args()
+    settings = get_settings()
+
+    handlers = []
+    if settings.log_file_path:
+        todays_logfile = f'{dt.datetime.now().strftime("%Y-%m-%d_%H-%M")}_{args.command}.log'
+        handlers.append(logging.FileHandler(filename=settings.log_file_path+todays_logfile))
+    if args.log_to_stdout:
+        handlers.append(logging.StreamHandler(sys.stdout))
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=settings.log_format,
+        handlers=handlers or [logging.NullHandler()])
+
+    COMMANDS[args.command](args)
@@ -0,0 +1,21 @@
+-- indexes for our hot queries.
+-- price history for a journey (optionally within a date range),
+-- covering, so sqlite never has to go back to the prices table
+CREATE INDEX IF NOT EXISTS idx_prices_journey_created
+    ON prices (journey_id, created_at, price, currency);
+
+-- everything observed within a date range
+CREATE INDEX IF NOT EXISTS idx_prices_created
+    ON prices (created_at);
+
+-- journeys of a search, covering for the join onto prices
+CREATE INDEX IF NOT EXISTS idx_journeys_search
+    ON journeys (search_id, journey_id);
+
+-- legs of a journey, in order
+CREATE INDEX IF NOT EXISTS idx_legs_journey
+    ON legs (journey_id, leg_number);
+
+-- looking up a search by its params, covering for search_id
+CREATE INDEX IF NOT EXISTS idx_flight_searches_params
+    ON flight_searches (origin, destination, leave_date, return_date, flex, search_id);
@@ -0,0 +1,29 @@
+-- checkpoints for runs of a search, so a run that
+-- fell over can pick up where it stopped.
+-- status is 'running', 'done', 'partial' (some urls
+-- failed) or 'failed'. only a run left 'running' (the
+-- process died) is resumed
+CREATE TABLE IF NOT EXISTS scrape_runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    search_id TEXT,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    n_urls INTEGER,
+    status TEXT,
+    FOREIGN KEY(search_id) REFERENCES flight_searches(search_id)
+);
+
+-- the latest unfinished run of a search
+CREATE INDEX IF NOT EXISTS idx_scrape_runs_search
+    ON scrape_runs (search_id, status, started_at);
+
+-- every url of a run that made it into the db,
+-- committed together with that url's results
+CREATE TABLE IF NOT EXISTS run_urls (
+    run_id INTEGER,
+    url TEXT,
+    completed_at TIMESTAMP,
+    n_prices INTEGER,
+    PRIMARY KEY(run_id, url),
+    FOREIGN KEY(run_id) REFERENCES scrape_runs(run_id)
+);
@@ -0,0 +1,69 @@
+-- change-only price storage: instead of a prices row for
+-- every observation, one row per run of observations of a
+-- journey at the same price (see DBWriter.extend_price_runs).
+
+-- a source is where prices are observed, i.e. a results
+-- page (by url), and its observations are the times we
+-- captured it. a run covers every observation of its
+-- source from first_seen to last_seen, which is how the
+-- full series is rebuilt (see get_prices_for_journey).
+CREATE TABLE IF NOT EXISTS price_sources (
+    source_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS price_observations (
+    source_id INTEGER,
+    observed_at TIMESTAMP,
+    PRIMARY KEY(source_id, observed_at),
+    FOREIGN KEY(source_id) REFERENCES price_sources(source_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS price_runs (
+    price_run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    journey_id TEXT,
+    source_id INTEGER,
+    price REAL,
+    currency TEXT,
+    first_seen TIMESTAMP,
+    last_seen TIMESTAMP,
+    n_seen INTEGER,
+    FOREIGN KEY(journey_id) REFERENCES journeys(journey_id),
+    FOREIGN KEY(source_id) REFERENCES price_sources(source_id)
+);
+
+-- price history for a journey, covering
+CREATE INDEX IF NOT EXISTS idx_price_runs_journey
+    ON price_runs (journey_id, first_seen, last_seen, source_id, price, currency);
+
+-- the runs still open on a source, i.e. seen at
+-- its latest observation
+CREATE INDEX IF NOT EXISTS idx_price_runs_open
+    ON price_runs (source_id, last_seen);
+
+-- compact the existing history. we don't know which page
+-- an old price came from, so every journey is its own
+-- source, observed whenever it has a price.
+INSERT OR IGNORE INTO price_sources (source)
+    SELECT DISTINCT 'journey:' || journey_id FROM prices;
+
+INSERT OR IGNORE INTO price_observations (source_id, observed_at)
+    SELECT s.source_id, p.created_at
+    FROM prices p
+    JOIN price_sources s ON s.source = 'journey:' || p.journey_id;
+
+-- consecutive observations of a journey at the same
+-- price (gaps and islands) make up one run
+INSERT INTO price_runs (journey_id, source_id, price, currency, first_seen, last_seen, n_seen)
+    SELECT i.journey_id, s.source_id, i.price, i.currency, MIN(i.created_at), MAX(i.created_at), COUNT(DISTINCT i.created_at)
+    FROM (
+        SELECT
+            journey_id, price, currency, created_at,
+            ROW_NUMBER() OVER (PARTITION BY journey_id ORDER BY created_at, price, currency)
+            - ROW_NUMBER() OVER (PARTITION BY journey_id, price, currency ORDER BY created_at) AS island
+        FROM prices
+    ) i
+    JOIN price_sources s ON s.source = 'journey:' || i.journey_id
+    GROUP BY i.journey_id, i.price, i.currency, i.island;
+
+DELETE FROM prices;
@@ -0,0 +1,78 @@
+-- the cheapest, dearest and mean price (as sum / count)
+-- per day, kept up to date by DBWriter as prices are
+-- written (see update_rollups), so reports don't have
+-- to go over every price. days and currencies are never
+-- mixed. `python manage.py rollups` rebuilds them.
+
+-- per search
+CREATE TABLE IF NOT EXISTS daily_search_prices (
+    search_id TEXT,
+    day TEXT,
+    currency TEXT,
+    min_price REAL,
+    max_price REAL,
+    sum_price REAL,
+    n_prices INTEGER,
+    PRIMARY KEY(search_id, day, currency)
+) WITHOUT ROWID;
+
+-- per route, i.e. the airports of a journey's first leg.
+-- one-way (n_legs 1) and return prices are kept apart
+CREATE TABLE IF NOT EXISTS daily_route_prices (
+    origin TEXT,
+    destination TEXT,
+    n_legs INTEGER,
+    day TEXT,
+    currency TEXT,
+    min_price REAL,
+    max_price REAL,
+    sum_price REAL,
+    n_prices INTEGER,
+    PRIMARY KEY(origin, destination, n_legs, day, currency)
+) WITHOUT ROWID;
+
+-- per airline (or combination of airlines)
+CREATE TABLE IF NOT EXISTS daily_airline_prices (
+    airline TEXT,
+    day TEXT,
+    currency TEXT,
+    min_price REAL,
+    max_price REAL,
+    sum_price REAL,
+    n_prices INTEGER,
+    PRIMARY KEY(airline, day, currency)
+) WITHOUT ROWID;
+
+-- backfill from the prices we already have, as
+-- rows and as runs (expanded into observations)
+CREATE TEMP VIEW observed_prices AS
+    SELECT journey_id, price, currency, created_at FROM prices
+    UNION ALL
+    SELECT r.journey_id, r.price, r.currency, o.observed_at
+    FROM price_runs r
+    JOIN price_observations o
+        ON o.source_id = r.source_id AND o.observed_at BETWEEN r.first_seen AND r.last_seen;
+
+INSERT INTO daily_search_prices
+    SELECT j.search_id, substr(p.created_at, 1, 10), p.currency,
+        MIN(p.price), MAX(p.price), SUM(p.price), COUNT(*)
+    FROM observed_prices p
+    JOIN journeys j ON j.journey_id = p.journey_id
+    GROUP BY 1, 2, 3;
+
+INSERT INTO daily_route_prices
+    SELECT l.departure_airport, l.arrival_airport, j.n_legs, substr(p.created_at, 1, 10), p.currency,
+        MIN(p.price), MAX(p.price), SUM(p.price), COUNT(*)
+    FROM observed_prices p
+    JOIN journeys j ON j.journey_id = p.journey_id
+    JOIN legs l ON l.journey_id = j.journey_id AND l.leg_number = 1
+    GROUP BY 1, 2, 3, 4, 5;
+
+INSERT INTO daily_airline_prices
+    SELECT COALESCE(j.airline, ''), substr(p.created_at, 1, 10), p.currency,
+        MIN(p.price), MAX(p.price), SUM(p.price), COUNT(*)
+    FROM observed_prices p
+    JOIN journeys j ON j.journey_id = p.journey_id
+    GROUP BY 1, 2, 3;
+
+DROP VIEW observed_prices;
@@ -0,0 +1,111 @@
+# scheduler.py
+# flight_prices_trends
+
+# a long-running alternative to one cron
+# entry per search: runs a set of saved
+# searches (see searches_example.yaml)
+# with warm browsers, scraping volatile
+# and soon-departing searches more often,
+# within an hourly budget of page loads.
+
+# usage: python scheduler.py -s searches.yaml
+
+############
+# IMPORTS
+############
+import sys
+import signal
+import logging
+import argparse
+from datetime import datetime
+
+from src.settings import get_settings
+
+SETTINGS = get_settings()
+
+############
+# CLI
+############
+parser = argparse.ArgumentParser(
+    description='run saved flight searches on an adaptive schedule')
+
+parser.add_argument(
+    '-s',
+    '--searches',
+    required=True,
+    help='yaml or jsonl file of saved searches')
+
+parser.add_argument(
+    '-b',
+    '--hourly_budget',
+    type=int,
+    default=SETTINGS.scheduler['hourly_budget'],
+    help='max page loads per hour, over all searches')
+
+parser.add_argument(
+    '-n',
+    '--dry_run',
+    action='store_true',
+    help='print when each search is due, and exit')
+
+parser.add_argument(
+    '-l',
+    '--log_to_stdout',
+    action='store_true',
+    help= 'print logging msgs to stdout')
+
+args = parser.parse_args()
+
+############
+# INIT
+############
+handlers = []
+if SETTINGS.log_file_path:
+    todays_logfile = f'{datetime.now().strftime("%Y-%m-%d_%H-%M")}_scheduler.log'
+    handlers.append(logging.FileHandler(filename=SETTINGS.log_file_path+todays_logfile))
+if args.log_to_stdout:
+    handlers.append(logging.StreamHandler(sys.stdout))
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=SETTINGS.log_format,
+    handlers=handlers or [logging.NullHandler()])
+
+############
+# THE THING!
+############
+from src.runner import load_searches
+from src.scheduler import SearchSchedule, Scheduler
+
+config = SETTINGS.scheduler
+schedule = SearchSchedule(
+    load_searches(args.searches),
+    base_interval=config['base_interval'],
+    min_interval=config['min_interval'],
+    max_interval=config['max_interval'],
+    hourly_budget=args.hourly_budget,
+    target_volatility=config['target_volatility'],
+    proximity_days=config['proximity_days'],
+    history_size=config['history_size'],
+    min_samples=config['min_samples'],
+    state_path=config['state_path'])
+
+if args.dry_run:
+    for name in schedule.active():
+        due = schedule.next_due(name)
+        due = 'now' if due == 0 else datetime.fromtimestamp(due).strftime('%Y-%m-%d %H:%M')
+        print(f'{name:30} every {schedule.interval(name):6.0f} min, next: {due}')
+    sys.exit(0)
+
+scheduler = Scheduler(schedule, recycle_after=config['recycle_after'])
+
+def handle_signal(signum, frame):
+    logging.info(f'received signal {signum}, stopping after the current run')
+    scheduler.stop()
+
+signal.signal(signal.SIGINT, handle_signal)
+signal.signal(signal.SIGTERM, handle_signal)
+
+logging.info(f'scheduler started with {len(schedule.searches)} searches')
+scheduler.run_forever()
+logging.info('scheduler stopped')
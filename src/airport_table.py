@@ -0,0 +1,163 @@
+# airport_table.py
+# flight_prices_trends
+
+# a compact, array-backed table of airport
+# coordinates. loading all of airportsdata
+# (~8k dicts) takes a while and a fair bit of
+# memory, and all we need most of the time is
+# lat/lon. so, the first time we need it, we
+# build a sorted structured array of
+# (code, lat, lon) and save it as a .npy file,
+# which later processes simply memory-map.
+
+############
+# IMPORTS
+############
+import os
+import logging
+import threading
+from importlib.metadata import version
+
+import numpy as np
+
+from src.settings import get_settings
+
+############
+# INIT
+############
+logging.getLogger('airport_table')
+
+############
+# PATHS & CONSTANTS
+############
+CACHE_PATH = get_settings().cache_path
+AIRPORT_DTYPE = np.dtype([('code', 'U3'), ('lat', 'f8'), ('lon', 'f8')])
+
+_table = None
+_table_lock = threading.Lock()
+
+############
+# CLASSES
+############
+class AirportTable:
+    '''
+    IATA code -> lat/lon, backed by a
+    structured array sorted by code, so
+    lookups are a binary search.
+    '''
+    def __init__(self, rows: np.ndarray):
+        self.rows = rows
+        self.codes = rows['code']
+        self.lat = rows['lat']
+        self.lon = rows['lon']
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def __contains__(self, code: str) -> bool:
+        return self.index(code) is not None
+
+
+    def index(self,
+              code: str) -> int | None:
+        '''
+        the row index of an airport code,
+        or None if we don't know it.
+        '''
+        i = int(np.searchsorted(self.codes, code))
+        if i < len(self.codes) and self.codes[i] == code:
+            return i
+        return None
+
+
+    def indexes(self,
+                codes: list[str]) -> np.ndarray:
+        '''
+        the row indexes for a whole array
+        of codes, -1 where we don't know
+        the code.
+        '''
+        # not U3, which would cut a longer
+        # code down to one we might know
+        codes = np.asarray(codes, dtype=str)
+        i = np.searchsorted(self.codes, codes)
+        i = np.minimum(i, len(self.codes)-1)
+        return np.where(self.codes[i] == codes, i, -1)
+
+
+    def lat_lon(self,
+                code: str) -> tuple[float, float] | None:
+        '''
+        the lat/lon of an airport, or
+        None if we don't know it.
+        '''
+        i = self.index(code)
+        if i is None:
+            return None
+        return float(self.lat[i]), float(self.lon[i])
+
+
+############
+# FUNCTIONS
+############
+def table_path(cache_path: str = CACHE_PATH) -> str:
+    '''
+    the cache file for the installed
+    version of airportsdata, so that
+    upgrading it rebuilds the table.
+    '''
+    return os.path.join(cache_path, f'airports_iata_{version("airportsdata")}.npy')
+
+
+def build_airport_rows() -> np.ndarray:
+    '''
+    builds the (sorted) structured
+    array from airportsdata.
+    '''
+    import airportsdata
+
+    airports = airportsdata.load('IATA')
+    rows = np.array(
+        [(code, airport['lat'], airport['lon']) for code, airport in airports.items()],
+        dtype=AIRPORT_DTYPE)
+    rows.sort(order='code')
+
+    return rows
+
+
+def get_airport_table(cache_path: str = CACHE_PATH) -> AirportTable:
+    '''
+    returns the airport table, memory-mapping
+    the cache file if it exists, and building
+    (and caching) it otherwise. only happens
+    once per process.
+    '''
+    global _table
+
+    if _table is not None:
+        return _table
+
+    with _table_lock:
+        if _table is not None:
+            return _table
+
+        path = table_path(cache_path)
+        try:
+            rows = np.load(path, mmap_mode='r')
+            logging.debug(f'memory-mapped airport table at {path}')
+        except (FileNotFoundError, ValueError):
+            logging.info(f'building airport table, caching it at {path}')
+            rows = build_airport_rows()
+            try:
+                os.makedirs(cache_path, exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+                np.save(tmp_path, rows)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.warning(f'could not cache airport table at {path}: {e}')
+
+        _table = AirportTable(rows)
+
+    return _table
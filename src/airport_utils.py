@@ -14,10 +14,14 @@
 ############
 import logging
 
-import airportsdata
 from typing import Literal
+from functools import lru_cache
 from math import radians, cos, sin, asin, sqrt
 
+import numpy as np
+
+from src.airport_table import get_airport_table
+
 # from src.db_utils import (
     # match_compound_airport)
     # get_flight_component_by_id)
@@ -27,7 +31,10 @@ from math import radians, cos, sin, asin, sqrt
 ############
 logging.getLogger('airport_utils')
 
-airports = airportsdata.load('IATA') 
+# the full airportsdata dicts, only loaded
+# if we need more than lat/lon. for lat/lon, 
+# see airport_table.py
+_airports = None
 
 ############
 # EXCEPTIONS 
@@ -45,6 +52,20 @@ class AirportCodeNotFoundError(Exception):
 ############
 # FUNCTIONS 
 ############
+def load_airports() -> dict:
+    '''
+    the full airportsdata metadata,
+    loaded on first use.
+    '''
+    global _airports
+
+    if _airports is None:
+        import airportsdata
+        _airports = airportsdata.load('IATA')
+
+    return _airports
+
+
 def validate_airport_code(code: str,
                           ignore_case: bool = False) -> bool:
     '''
@@ -54,8 +75,10 @@ def validate_airport_code(code: str,
     if ignore_case:
         code = code.upper()
 
+    airports = get_airport_table()
+
     if code not in airports:
-        logging.info('checking compound codes in db')
+        logging.debug('checking compound codes')
         # need to import dynamically to 
         # avoid circular import error
         from src.db_utils import match_compound_airport
@@ -75,21 +98,35 @@ def get_airport_metadata(code: str,
     type it gets returned as. 
     by default, it's a tuple of lat 
     and lon.
+
+    lat/lon come from the compact airport
+    table - the full airportsdata metadata
+    is only loaded for other fields.
     '''
     if ignore_case:
         code = code.upper()
 
-    if code not in airports:
-        logging.info('checking compound codes in db')
+    table = get_airport_table()
+
+    if code not in table:
+        logging.debug('checking compound codes')
         from src.db_utils import match_compound_airport
         code = match_compound_airport(code)
 
+    if set(fields) <= {'lat', 'lon'}:
+        lat_lon = table.lat_lon(code)
+        if lat_lon is None:
+            raise AirportCodeNotFoundError(f'airport code {code} not found')
+        airport = {'lat' : lat_lon[0], 'lon' : lat_lon[1]}
+    else:
+        airport = load_airports().get(code, {})
+
     try:
         if return_type == 'dict':
             # select the fields we want
-            return {field : airports[code][field] for field in fields}
+            return {field : airport[field] for field in fields}
         elif return_type == 'tuple':
-            return tuple([airports[code][field] for field in fields])
+            return tuple([airport[field] for field in fields])
     except KeyError:
         raise AirportCodeNotFoundError(f'airport code {code} not found')
 
@@ -128,12 +165,48 @@ def haversine(lon1: float,
     return c * r
 
 
+def haversine_np(lon1: np.ndarray, 
+                 lat1: np.ndarray, 
+                 lon2: np.ndarray, 
+                 lat2: np.ndarray) -> np.ndarray:
+    '''
+    the same as `haversine`, but for
+    whole arrays of points at once.
+    '''
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+
+    dlon = lon2 - lon1 
+    dlat = lat2 - lat1 
+
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a)) 
+    r = 6371
+
+    return c * r
+
+
 def calculate_distance(origin: str, 
                        destination: str) -> float:
     '''
     calculates the distance between
     two airports, given their codes.
     distance is returned in km.
+
+    a run only ever touches a few dozen
+    airport pairs, so we remember the
+    distance for every pair (in either
+    direction) once we've worked it out.
+    '''
+    if destination < origin:
+        origin, destination = destination, origin
+    return _pair_distance(origin, destination)
+
+
+@lru_cache(maxsize=4096)
+def _pair_distance(origin: str,
+                   destination: str) -> float:
+    '''
+    the cached part of calculate_distance.
     '''
     lat1, lon1 = get_airport_metadata(origin)
     lat2, lon2 = get_airport_metadata(destination)
@@ -206,4 +279,88 @@ def calculate_absolute_leg_distance(leg: dict | None = None,
         if i == len(stops)-1:
             total_distance += calculate_distance(next_origin, leg['arrival_airport'])
     
-    return total_distance
\ No newline at end of file
+    return total_distance
+
+
+def split_stopovers(stopovers: str | list[str] | None) -> list[str]:
+    '''
+    stopovers come either as a list
+    (fresh from the scraper), a string
+    as stored in the db ('JFK, ORD'), 
+    or None.
+    '''
+    if not stopovers:
+        return []
+    if isinstance(stopovers, str):
+        return stopovers.split(', ')
+    return list(stopovers)
+
+
+def batch_leg_distances(departure_airports: list[str],
+                        arrival_airports: list[str],
+                        stopover_airports: list[str | list[str] | None]) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    calculates the nominal and absolute
+    distance (see `calculate_absolute_leg_distance`)
+    of a whole batch of legs in one go. 
+
+    every distinct airport is looked up once,
+    every leg is broken down into the segments
+    actually flown (self-transfers, e.g. 'LGW-LHR',
+    mean we land at one airport and take off
+    from another), and all segments go through
+    one vectorised haversine.
+
+    returns two float arrays (km), in the 
+    order of the legs.
+    '''
+    n_legs = len(departure_airports)
+
+    codes = {}
+    def code_index(code: str) -> int:
+        if code not in codes:
+            codes[code] = len(codes)
+        return codes[code]
+
+    dep_idx = np.empty(n_legs, dtype=np.int64)
+    arr_idx = np.empty(n_legs, dtype=np.int64)
+    seg_from = []
+    seg_to = []
+    seg_leg = []
+
+    for i, (departure, arrival, stopovers) in enumerate(
+            zip(departure_airports, arrival_airports, stopover_airports)):
+        dep_idx[i] = code_index(departure)
+        arr_idx[i] = code_index(arrival)
+
+        current = departure
+        for stop in split_stopovers(stopovers):
+            landed, _, took_off = stop.partition('-')
+            seg_from.append(code_index(current))
+            seg_to.append(code_index(landed))
+            seg_leg.append(i)
+            current = took_off or landed
+
+        seg_from.append(code_index(current))
+        seg_to.append(code_index(arrival))
+        seg_leg.append(i)
+
+    # one table lookup for all distinct airports,
+    # and metadata lookups (incl compound codes)
+    # only for the ones that aren't in the table
+    table = get_airport_table()
+    rows = table.indexes(list(codes))
+    lat = np.where(rows >= 0, table.lat[rows], np.nan)
+    lon = np.where(rows >= 0, table.lon[rows], np.nan)
+    for code, index in codes.items():
+        if rows[index] < 0:
+            lat[index], lon[index] = get_airport_metadata(code)
+
+    nominal = haversine_np(lon[dep_idx], lat[dep_idx], lon[arr_idx], lat[arr_idx])
+
+    seg_from = np.asarray(seg_from, dtype=np.int64)
+    seg_to = np.asarray(seg_to, dtype=np.int64)
+    segments = haversine_np(lon[seg_from], lat[seg_from], lon[seg_to], lat[seg_to])
+    absolute = np.bincount(np.asarray(seg_leg, dtype=np.int64), weights=segments, minlength=n_legs)
+
+    return nominal, absolute
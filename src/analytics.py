@@ -0,0 +1,413 @@
+# analytics.py
+# flight_prices_trends
+
+# price trends for a search, worked out with
+# numpy over its whole price history at once
+# rather than price by price in python:
+
+# - the cheapest, median and dearest price of
+#   each day, plus percentile bands
+# - a rolling min / median of the cheapest
+#   price, over the last WINDOW days
+# - day-over-day changes of the cheapest
+#   price, and how many journeys got cheaper
+#   than the day before
+# - the best price we've ever seen, when,
+#   and for which journey
+
+# a search's history is loaded in its stored
+# form (price runs, see migration 0003) and
+# expanded into observations here, which is
+# what makes a year of prices quick to load.
+
+# TrendEngine keeps the trends of the searches
+# it's been asked about, until new prices are
+# written for them.
+
+############
+# IMPORTS
+############
+import logging
+import sqlite3
+import warnings
+import datetime as dt
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import src.db_utils as db
+
+############
+# INIT
+############
+logging.getLogger('analytics')
+
+############
+# PATHS & CONSTANTS
+############
+WINDOW = 7 # days in the rolling min / median
+PERCENTILES = (10, 25, 75, 90) # bands of each day's prices
+CACHE_SIZE = 256 # searches a TrendEngine keeps trends for
+
+############
+# CLASSES
+############
+@dataclass
+class PriceHistory:
+    '''
+    every price observed for a search, as
+    arrays in time order: which journey it
+    was for (an index into journey_ids), the
+    price and when it was observed.
+    '''
+    search_id: str
+    currency: str | None
+    journey_ids: np.ndarray
+    journeys: np.ndarray
+    prices: np.ndarray
+    times: np.ndarray
+
+    def __len__(self):
+        return len(self.prices)
+
+
+@dataclass
+class PriceTrends:
+    '''
+    the trends of a search's prices. the daily
+    arrays have a value for every day from the
+    first price to the last, NaN on days we
+    have no prices for.
+
+    daily_change is the change of the cheapest
+    price from the day before, journey_drops
+    the number of journeys which got cheaper
+    than the day before.
+    '''
+    search_id: str
+    currency: str | None
+    n_prices: int
+    n_journeys: int
+    best_price: float
+    best_price_at: dt.datetime
+    best_journey_id: str
+    days: np.ndarray
+    n_prices_per_day: np.ndarray
+    daily_min: np.ndarray
+    daily_median: np.ndarray
+    daily_max: np.ndarray
+    bands: dict[float, np.ndarray]
+    window: int
+    rolling_min: np.ndarray
+    rolling_median: np.ndarray
+    daily_change: np.ndarray
+    journey_drops: np.ndarray
+    watermark: tuple = field(default=None, compare=False)
+
+
+    def biggest_drop(self) -> tuple[dt.date, float] | None:
+        '''
+        the day the cheapest price fell
+        the most from the day before, and by
+        how much (None if it never fell).
+        '''
+        changes = np.where(np.isnan(self.daily_change), 0, self.daily_change)
+        i = int(np.argmin(changes))
+        if changes[i] >= 0:
+            return None
+        return self.days[i].item(), float(-changes[i])
+
+
+class TrendEngine:
+    '''
+    works out (and keeps) the price trends of
+    searches, over the db at db_path.
+
+    trends are kept per search along with its
+    watermark (see db.get_search_watermark),
+    which moves whenever a price is written for
+    the search, so asking again costs one
+    indexed query over its prices and runs
+    until there are new prices. up to
+    cache_size searches are kept, the least
+    recently asked about go first.
+
+    holds one db connection, so use one engine
+    per thread.
+    '''
+    def __init__(self,
+                 db_path: str = db.DB_PATH,
+                 window: int = WINDOW,
+                 percentiles: tuple = PERCENTILES,
+                 cache_size: int = CACHE_SIZE):
+        self.window = window
+        self.percentiles = tuple(percentiles)
+        self.cache_size = cache_size
+        self.conn = sqlite3.connect(db_path)
+        # search_id -> PriceTrends (or None, no prices)
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def trends(self,
+               search_id: str) -> PriceTrends | None:
+        '''
+        the price trends of a search, from
+        the cache if no prices have been
+        written for it since. None if the
+        search has no prices.
+        '''
+        watermark = db.get_search_watermark(search_id, conn=self.conn)
+
+        if search_id in self._cache:
+            cached_watermark, trends = self._cache[search_id]
+            if cached_watermark == watermark:
+                self._cache.move_to_end(search_id)
+                self.hits += 1
+                return trends
+
+        self.misses += 1
+        history = load_price_history(search_id, conn=self.conn)
+        trends = None
+        if len(history):
+            trends = price_trends(history, window=self.window, percentiles=self.percentiles)
+            trends.watermark = watermark
+
+        self._cache[search_id] = (watermark, trends)
+        self._cache.move_to_end(search_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return trends
+
+
+    def trends_for(self,
+                   search_ids: list[str]) -> dict:
+        '''
+        search_id -> price trends (or None)
+        for several searches.
+        '''
+        return {search_id : self.trends(search_id) for search_id in search_ids}
+
+
+    def invalidate(self,
+                   search_id: str | None = None):
+        '''
+        forgets the trends of a search
+        (all searches if None).
+        '''
+        if search_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(search_id, None)
+
+
+    def close(self):
+        self.conn.close()
+
+############
+# FUNCTIONS
+############
+# loading
+def expand_runs(search_id: str,
+                runs: list[tuple],
+                observations: list[tuple]) -> PriceHistory:
+    '''
+    turns price runs (and their sources'
+    observations), as from
+    db.get_price_runs_for_search, into a
+    PriceHistory: one price for every
+    observation of a run's source from its
+    first_seen to its last_seen.
+
+    done for all runs at once: observations
+    get a key, ordered by source then time,
+    so a run's observations are the slice
+    between the keys of its first and last
+    time (found by binary search), and the
+    slices are stitched together with
+    np.repeat.
+    '''
+    if not runs:
+        return PriceHistory(
+            search_id=search_id,
+            currency=None,
+            journey_ids=np.array([], dtype=str),
+            journeys=np.array([], dtype=np.int64),
+            prices=np.array([], dtype=np.float64),
+            times=np.array([], dtype='datetime64[us]'))
+
+    journey_col, price_col, currency_col, first_col, last_col, source_col = zip(*runs)
+
+    currencies = set(currency_col)
+    if len(currencies) > 1:
+        raise ValueError(f'search {search_id} has prices in {sorted(currencies, key=str)}, can\'t compare them')
+
+    journey_ids, run_journeys = np.unique(np.array(journey_col), return_inverse=True)
+    run_prices = np.array(price_col, dtype=np.float64)
+    first_seen = np.array(first_col, dtype='datetime64[us]')
+    last_seen = np.array(last_col, dtype='datetime64[us]')
+    # NaN where a run is a single prices row
+    run_sources = np.array(source_col, dtype=np.float64)
+    is_row = np.isnan(run_sources)
+
+    counts = np.where(is_row, 1, 0)
+    starts = np.arange(len(runs))
+    times = first_seen
+
+    if observations:
+        observed_source_col, observed_col = zip(*observations)
+        observed_at = np.array(observed_col, dtype='datetime64[us]')
+        sources, source_ranks = np.unique(np.array(observed_source_col, dtype=np.int64), return_inverse=True)
+        distinct_times, time_ranks = np.unique(observed_at, return_inverse=True)
+        n_times = len(distinct_times)
+        # sorted, as observations come by source then time
+        keys = source_ranks.astype(np.int64) * n_times + time_ranks
+
+        run_sources = np.where(is_row, -1, run_sources).astype(np.int64)
+        run_ranks = np.searchsorted(sources, run_sources)
+        found = ~is_row & (sources[np.minimum(run_ranks, len(sources) - 1)] == run_sources)
+        lo = np.searchsorted(keys, run_ranks * n_times + np.searchsorted(distinct_times, first_seen, 'left'))
+        hi = np.searchsorted(keys, run_ranks * n_times + np.searchsorted(distinct_times, last_seen, 'right'))
+
+        counts = np.where(found, hi - lo, counts)
+        starts = np.where(found, lo, 0)
+        # runs' observations after the rows' own times
+        times = np.concatenate([observed_at, first_seen])
+        starts = np.where(is_row, len(observed_at) + np.arange(len(runs)), starts)
+
+    owners = np.repeat(np.arange(len(runs)), counts)
+    offsets = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts)
+    times = times[np.repeat(starts, counts) + offsets]
+
+    order = np.argsort(times, kind='stable')
+
+    return PriceHistory(
+        search_id=search_id,
+        currency=currency_col[0],
+        journey_ids=journey_ids,
+        journeys=run_journeys[owners][order],
+        prices=run_prices[owners][order],
+        times=times[order])
+
+
+def load_price_history(search_id: str,
+                       search_date_from: str | None = None,
+                       search_date_to: str | None = None,
+                       conn: sqlite3.Connection | None = None) -> PriceHistory:
+    '''
+    every price observed for a search as a
+    PriceHistory, optionally only between
+    two dates (YYYY-MM-DD, inclusive).
+    '''
+    runs, observations = db.get_price_runs_for_search(
+        search_id,
+        search_date_from=search_date_from,
+        search_date_to=search_date_to,
+        conn=conn)
+    history = expand_runs(search_id, runs, observations)
+    logging.debug(f'loaded {len(history)} prices for search {search_id} from {len(runs)} runs')
+
+    return history
+
+
+# trends
+def group_percentiles(values: np.ndarray,
+                      starts: np.ndarray,
+                      counts: np.ndarray,
+                      percentiles) -> np.ndarray:
+    '''
+    percentiles (0-100) of groups of values,
+    where values are sorted within each group
+    and group i is values[starts[i]:starts[i]+counts[i]].
+    interpolates linearly, like np.percentile.
+
+    returns an array of (percentile, group),
+    NaN for empty groups.
+    '''
+    q = np.asarray(percentiles, dtype=np.float64)[:, None] / 100
+    positions = starts + q * (counts - 1)
+    lo = np.clip(np.floor(positions).astype(np.int64), 0, len(values) - 1)
+    hi = np.clip(np.ceil(positions).astype(np.int64), 0, len(values) - 1)
+    result = values[lo] + (values[hi] - values[lo]) * (positions - np.floor(positions))
+
+    return np.where(counts > 0, result, np.nan)
+
+
+def rolling(values: np.ndarray,
+            window: int):
+    '''
+    the rolling min and median of values
+    over the last `window` values, ignoring
+    NaNs (NaN if a window is all NaN).
+    '''
+    padded = np.concatenate([np.full(window - 1, np.nan), values])
+    windows = sliding_window_view(padded, window)
+
+    with warnings.catch_warnings():
+        # all-NaN windows are expected
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.fmin.reduce(windows, axis=1), np.nanmedian(windows, axis=1)
+
+
+def price_trends(history: PriceHistory,
+                 window: int = WINDOW,
+                 percentiles: tuple = PERCENTILES) -> PriceTrends:
+    '''
+    works out the price trends of a
+    search from its price history.
+    '''
+    n_prices = len(history)
+    if not n_prices:
+        raise ValueError(f'no prices for search {history.search_id}')
+
+    prices = history.prices
+    journeys = history.journeys
+
+    # days, counted from the first. times
+    # are sorted, so days are too
+    days_observed = history.times.astype('datetime64[D]')
+    first_day = days_observed[0]
+    day_index = (days_observed - first_day).astype(np.int64)
+    n_days = int(day_index[-1]) + 1
+
+    # each day's prices, cheapest first
+    sorted_prices = prices[np.lexsort((prices, day_index))]
+    starts = np.searchsorted(day_index, np.arange(n_days))
+    counts = np.diff(np.append(starts, n_prices))
+
+    daily = group_percentiles(sorted_prices, starts, counts, (0, 50, 100) + tuple(percentiles))
+    daily_min, daily_median, daily_max = daily[:3]
+    rolling_min, rolling_median = rolling(daily_min, window)
+
+    # the cheapest price per journey and day
+    n_journeys = len(history.journey_ids)
+    journey_days = np.full(n_journeys * n_days, np.nan)
+    np.fmin.at(journey_days, journeys * n_days + day_index, prices)
+    journey_drops = (np.diff(journey_days.reshape(n_journeys, n_days), axis=1) < 0).sum(axis=0)
+
+    # the first time we saw the cheapest price
+    best = int(np.argmin(prices))
+
+    return PriceTrends(
+        search_id=history.search_id,
+        currency=history.currency,
+        n_prices=n_prices,
+        n_journeys=n_journeys,
+        best_price=float(prices[best]),
+        best_price_at=history.times[best].item(),
+        best_journey_id=str(history.journey_ids[journeys[best]]),
+        days=first_day + np.arange(n_days),
+        n_prices_per_day=counts,
+        daily_min=daily_min,
+        daily_median=daily_median,
+        daily_max=daily_max,
+        bands={q : daily[3+i] for i, q in enumerate(percentiles)},
+        window=window,
+        rolling_min=rolling_min,
+        rolling_median=rolling_median,
+        daily_change=np.diff(daily_min, prepend=np.nan),
+        journey_drops=np.concatenate([[0], journey_drops]))
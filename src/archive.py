@@ -0,0 +1,173 @@
+# archive.py
+# flight_prices_trends
+
+# module for archiving the raw pages we scrape.
+# for every url we load, we keep the raw text of
+# the result blocks and the page html, so that
+# we can re-run the parser over old pages (e.g.
+# after fixing a parsing bug) without going
+# back to the site.
+
+# layout of the archive:
+#   <ARCHIVE_PATH>/index.jsonl
+#       one line per scraped page: url, timestamp,
+#       the journey search, and the digest of the
+#       snapshot
+#   <ARCHIVE_PATH>/objects/ab/abcdef....json.gz
+#       the gzipped snapshot itself, named after
+#       the sha256 of its contents, so identical
+#       pages are only stored once
+
+############
+# IMPORTS
+############
+import os
+import json
+import gzip
+import hashlib
+import logging
+import threading
+import datetime as dt
+
+from src.settings import get_settings
+
+############
+# INIT
+############
+logging.getLogger('archive')
+
+############
+# PATHS & CONSTANTS
+############
+ARCHIVE_PATH = get_settings().archive_path
+INDEX_FILE = 'index.jsonl'
+OBJECTS_DIR = 'objects'
+
+# several browsers may archive at once
+_index_lock = threading.Lock()
+
+############
+# FUNCTIONS
+############
+def snapshot_digest(blocks: list[str],
+                    html: str | None) -> str:
+    '''
+    the address of a snapshot is the
+    sha256 of its contents.
+    '''
+    content = json.dumps({'blocks' : blocks, 'html' : html}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def object_path(digest: str,
+                archive_path: str = ARCHIVE_PATH) -> str:
+    '''
+    where a snapshot with a given
+    digest lives in the archive.
+    '''
+    return os.path.join(archive_path, OBJECTS_DIR, digest[:2], digest + '.json.gz')
+
+
+def save_snapshot(url: str,
+                  country: str,
+                  journey_search: dict,
+                  blocks: list[str],
+                  html: str | None,
+                  captured_at: dt.datetime,
+                  archive_path: str = ARCHIVE_PATH) -> str:
+    '''
+    writes a snapshot of a scraped page
+    to the archive, and adds it to the
+    index. journey_search should be the
+    search params as plain strings
+    (i.e. `get_journey_search(convert_datetimes=False)`).
+
+    returns the digest of the snapshot.
+    '''
+    digest = snapshot_digest(blocks, html)
+    path = object_path(digest, archive_path)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({'blocks' : blocks, 'html' : html}, f)
+        os.replace(tmp_path, path)
+        logging.info(f'archived snapshot {digest} for {url}')
+    else:
+        logging.info(f'snapshot {digest} already archived')
+
+    entry = {
+        'url' : url,
+        'captured_at' : captured_at.isoformat(),
+        'country' : country,
+        'journey_search' : journey_search,
+        'digest' : digest
+    }
+
+    with _index_lock:
+        os.makedirs(archive_path, exist_ok=True)
+        with open(os.path.join(archive_path, INDEX_FILE), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    return digest
+
+
+def load_snapshot(digest: str,
+                  archive_path: str = ARCHIVE_PATH) -> dict:
+    '''
+    returns the blocks and html
+    of an archived snapshot.
+    '''
+    with gzip.open(object_path(digest, archive_path), 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def iter_index(url: str | None = None,
+               captured_from: str | None = None,
+               captured_to: str | None = None,
+               archive_path: str = ARCHIVE_PATH):
+    '''
+    yields the index entries of the archive,
+    optionally only for a given url and/or
+    captured within a date range
+    (YYYY-MM-DD, inclusive).
+    '''
+    index_path = os.path.join(archive_path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        logging.warning(f'no archive index at {index_path}')
+        return
+
+    with open(index_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+
+            if url is not None and entry['url'] != url:
+                continue
+            if captured_from is not None and entry['captured_at'][:10] < captured_from:
+                continue
+            if captured_to is not None and entry['captured_at'][:10] > captured_to:
+                continue
+
+            yield entry
+
+
+def iter_snapshots(url: str | None = None,
+                   captured_from: str | None = None,
+                   captured_to: str | None = None,
+                   archive_path: str = ARCHIVE_PATH):
+    '''
+    like iter_index, but each entry also
+    comes with the blocks and html of
+    its snapshot.
+    '''
+    for entry in iter_index(url, captured_from, captured_to, archive_path):
+        try:
+            snapshot = load_snapshot(entry['digest'], archive_path)
+        except FileNotFoundError:
+            logging.error(f'snapshot {entry["digest"]} for {entry["url"]} missing from archive')
+            continue
+
+        yield {**entry, **snapshot}
@@ -0,0 +1,347 @@
+# backends.py
+# flight_prices_trends
+
+# the ways FlightsScaper can fetch a results
+# page. a backend takes a url and returns the
+# raw text of every result block on it (plus
+# the html, for the archive); parsing, ids and
+# the db don't care where that came from.
+
+# - SeleniumBackend: the real thing, a pool of
+#   chrome browsers (see browser.py, page_ready.py)
+# - ArchiveBackend: serves pages we've archived
+#   before (see archive.py), no browser needed.
+#   good for running the whole pipeline offline,
+#   e.g. in CI or for benchmarks.
+
+# a new backend (e.g. plain http requests, for
+# sites that don't need javascript) subclasses
+# FetchBackend, implements `fetch`, and gets
+# an entry in BACKENDS.
+
+############
+# IMPORTS
+############
+import logging
+import datetime as dt
+from time import sleep
+from dataclasses import dataclass
+
+from src.settings import get_settings
+from src.browser import new_chrome_driver
+from src.page_ready import LoadTimeHistory, wait_for_page_ready
+from src.archive import iter_index, load_snapshot
+from src.errors import TransientError, PageError, backoff_delay
+
+############
+# INIT
+############
+logging.getLogger('backends')
+
+############
+# PATHS & CONSTANTS
+############
+SETTINGS = get_settings()
+CONFIG = SETTINGS.config
+PAGE_READY = SETTINGS.page_ready
+# attempts at pulling the results off a loaded
+# page, before we give up and reload it
+EXTRACT_ATTEMPTS = 3
+
+# returns the text of every result block in
+# one go, so we only talk to the driver once
+RESULT_TEXTS_SCRIPT = '''
+return Array.from(
+    document.querySelectorAll(arguments[0]),
+    block => block.innerText);
+'''
+
+############
+# CLASSES
+############
+@dataclass
+class FetchedPage:
+    '''
+    what a backend got from a url: the text
+    of every result block, the page html
+    (None if the backend doesn't have it),
+    and when it was captured.
+    '''
+    url: str
+    blocks: list[str]
+    html: str | None
+    captured_at: dt.datetime
+
+
+class FetchBackend:
+    '''
+    the interface every backend implements.
+
+    a backend hands out up to n `sessions`
+    (e.g. one browser each), and fetch is
+    called with one of them, from one thread
+    per session. backends without any per-
+    session state just hand out None.
+    '''
+    name = None
+    # whether pages from this backend
+    # should go into the archive
+    archive_pages = False
+    # exceptions (besides TransientError) after
+    # which a fetch is worth retrying, see
+    # errors.fetch_with_retry
+    retry_exceptions = ()
+
+    def __init__(self,
+                 country: str):
+        self.country = country
+
+
+    def sessions(self,
+                 n_sessions: int) -> list:
+        return [None] * n_sessions
+
+
+    def fetch(self,
+              url: str,
+              session = None) -> FetchedPage:
+        '''
+        raises TransientError if it's worth
+        another go, PageError if it isn't.
+        '''
+        raise NotImplementedError
+
+
+    def close(self):
+        pass
+
+
+class SeleniumBackend(FetchBackend):
+    '''
+    loads pages in a pool of chrome browsers,
+    waits for the results to settle and pulls
+    out the result blocks with one script call.
+
+    the first browser is started straight
+    away, more only when a search has enough
+    urls to keep them busy.
+    '''
+    name = 'selenium'
+    archive_pages = True
+
+    def __init__(self,
+                 country: str,
+                 browser_driver: str | None = SETTINGS.chromedriver,
+                 browser_config: dict = SETTINGS.browser):
+        super().__init__(country)
+        self.browser_driver = browser_driver
+        self.browser_config = browser_config
+        self.selectors = CONFIG['country'][country]['css_selectors']
+        self.cookie_button_xpath = CONFIG['country'][country]['xpaths'].get('cookie_decline_button')
+
+        self.load_times = LoadTimeHistory(
+            path=PAGE_READY['history_path'],
+            history_size=PAGE_READY['history_size'],
+            min_samples=PAGE_READY['min_samples'],
+            timeout_percentile=PAGE_READY['timeout_percentile'],
+            timeout_margin=PAGE_READY['timeout_margin'],
+            min_timeout=PAGE_READY['min_timeout'],
+            max_timeout=PAGE_READY['max_timeout'])
+
+        self.drivers = [self._new_driver()]
+
+
+    @property
+    def retry_exceptions(self):
+        from selenium.common.exceptions import StaleElementReferenceException, TimeoutException
+        return (StaleElementReferenceException, TimeoutException)
+
+
+    def _new_driver(self):
+        '''
+        starts a new browser instance, set up
+        as per the `browser` section of the
+        config (headless, page load strategy,
+        blocked resources).
+        '''
+        return new_chrome_driver(self.browser_driver, self.browser_config)
+
+
+    def sessions(self,
+                 n_sessions: int) -> list:
+        '''
+        makes sure we have at least n_sessions
+        browsers running, and returns them.
+        '''
+        while len(self.drivers) < n_sessions:
+            logging.info(f'starting browser {len(self.drivers)+1} of {n_sessions}')
+            self.drivers.append(self._new_driver())
+
+        return self.drivers[:n_sessions]
+
+
+    def fetch(self,
+              url: str,
+              session = None) -> FetchedPage:
+        '''
+        loads the url in a browser (the first
+        one if none is given) and returns the
+        result blocks once the page is ready.
+        '''
+        driver = session if session is not None else self.drivers[0]
+
+        # load url
+        logging.info(f'loading url: {url}')
+        driver.get(url)
+
+        # wait for results to load. we poll the
+        # progress bar and the number of results,
+        # and move on as soon as the page is stable
+        # (dismissing the cookie button on the way).
+        timeout = self.load_times.timeout(self.country)
+        logging.info(f'waiting up to {timeout:.2f}s for page to be ready...')
+        ready, load_time = wait_for_page_ready(
+            driver,
+            progress_bar_selector=self.selectors['progress_bar'],
+            result_selector=self.selectors['result_blocks'],
+            timeout=timeout,
+            cookie_button_xpath=self.cookie_button_xpath,
+            poll_interval=PAGE_READY['poll_interval'],
+            settle_polls=PAGE_READY['settle_polls'])
+        # a page that timed out took at least the
+        # timeout, which we need to know too
+        self.load_times.record(self.country, load_time, timeout=None if ready else timeout)
+
+        blocks = self._extract_blocks(driver)
+        if not ready and not blocks:
+            raise TransientError(f'no results after {timeout:.2f}s')
+
+        return FetchedPage(
+            url=url,
+            blocks=blocks,
+            html=driver.page_source,
+            captured_at=dt.datetime.now())
+
+
+    def _extract_blocks(self,
+                        driver) -> list[str]:
+        '''
+        expands the results and pulls out the
+        text of every result block. if the page
+        shifts under us (a stale element), we
+        have another go on the same page, and
+        only reload it (see fetch_with_retry)
+        if that keeps happening.
+        '''
+        from selenium.webdriver.common.by import By
+        from selenium.common.exceptions import StaleElementReferenceException
+
+        for attempt in range(EXTRACT_ATTEMPTS):
+            try:
+                # the page is loaded by now, so the more_results
+                # button is either there or it isn't
+                more_results_buttons = driver.find_elements(By.CSS_SELECTOR, self.selectors['show_more_button'])
+                if more_results_buttons:
+                    more_results_buttons[0].click()
+                else:
+                    logging.warning(f'unable to find more_results button. continuing.')
+
+                logging.info(f'attempting to find results using css selector: {self.selectors["result_blocks"]}')
+                blocks = driver.execute_script(RESULT_TEXTS_SCRIPT, self.selectors['result_blocks'])
+                logging.info(f'retrieved {len(blocks)} results')
+                return blocks
+            except StaleElementReferenceException as e:
+                if attempt + 1 == EXTRACT_ATTEMPTS:
+                    raise
+                delay = backoff_delay(attempt, PAGE_READY['poll_interval'], 2)
+                logging.warning(f'stale element while extracting results, trying again in {delay:.2f}s')
+                sleep(delay)
+
+
+    def close(self):
+        '''
+        shuts down all browsers in the pool.
+        '''
+        for driver in self.drivers:
+            driver.quit()
+        self.drivers = []
+
+
+class ArchiveBackend(FetchBackend):
+    '''
+    serves the latest archived snapshot of
+    every url (optionally only from snapshots
+    captured within a date range), without
+    going anywhere near a browser.
+
+    by default, pages keep the time they
+    were originally captured at, like
+    `manage.py reparse`; with recapture=True
+    they're stamped with the current time,
+    as if they'd just been scraped.
+    '''
+    name = 'archive'
+
+    def __init__(self,
+                 country: str,
+                 captured_from: str | None = None,
+                 captured_to: str | None = None,
+                 recapture: bool = False,
+                 archive_path: str = SETTINGS.archive_path):
+        super().__init__(country)
+        self.recapture = recapture
+        self.archive_path = archive_path
+
+        # url -> latest index entry
+        self.entries = {}
+        for entry in iter_index(
+                captured_from=captured_from,
+                captured_to=captured_to,
+                archive_path=archive_path):
+            if entry['country'] != country:
+                continue
+            latest = self.entries.get(entry['url'])
+            if latest is None or entry['captured_at'] >= latest['captured_at']:
+                self.entries[entry['url']] = entry
+
+        logging.info(f'serving {len(self.entries)} archived urls from {archive_path}')
+
+
+    def fetch(self,
+              url: str,
+              session = None) -> FetchedPage:
+        '''
+        returns the archived result
+        blocks of the url.
+        '''
+        entry = self.entries.get(url)
+        if entry is None:
+            raise PageError(f'no archived snapshot of {url}')
+
+        snapshot = load_snapshot(entry['digest'], self.archive_path)
+
+        return FetchedPage(
+            url=url,
+            blocks=snapshot['blocks'],
+            html=snapshot.get('html'),
+            captured_at=dt.datetime.now() if self.recapture else dt.datetime.fromisoformat(entry['captured_at']))
+
+
+BACKENDS = {
+    'selenium' : SeleniumBackend,
+    'archive' : ArchiveBackend
+}
+
+############
+# FUNCTIONS
+############
+def new_backend(name: str,
+                country: str,
+                **kwargs) -> FetchBackend:
+    '''
+    starts a backend by name.
+    '''
+    if name not in BACKENDS:
+        raise ValueError(f'{name} not a fetch backend, pick from {list(BACKENDS)}')
+
+    return BACKENDS[name](country, **kwargs)
@@ -0,0 +1,131 @@
+# browser.py
+# flight_prices_trends
+
+# module for starting the chrome driver the
+# way the `browser` section of config.yaml
+# says: optionally headless, with the 'eager'
+# page load strategy (don't wait for every
+# image and iframe, we've got our own check
+# for when the results are in - see
+# page_ready.py), and not requesting urls
+# the parser never needs anything from:
+# images, fonts and media by their file
+# extension, plus the ad/tracker url patterns
+# listed in the config. `python benchmark.py
+# page-load` measures what that changes.
+
+# NOTE: stylesheets are never blocked. without
+# them, hidden elements show up in innerText
+# and the result blocks no longer parse.
+
+############
+# IMPORTS
+############
+import logging
+
+############
+# INIT
+############
+logging.getLogger('browser')
+
+############
+# PATHS & CONSTANTS
+############
+# the file extensions we block for each of
+# the `blocked_resource_types`. this is url
+# matching, not chrome's resource types: a
+# font or video served without its extension
+# still loads (images are also blocked in the
+# profile, which catches those too)
+RESOURCE_TYPE_PATTERNS = {
+    'image' : ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.avif', '*.svg', '*.ico'],
+    'font' : ['*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot'],
+    'media' : ['*.mp4', '*.webm', '*.mp3', '*.m4a', '*.ogg']
+}
+
+# chrome's content setting for 'block'
+CONTENT_SETTING_BLOCK = 2
+
+############
+# FUNCTIONS
+############
+def blocked_url_patterns(browser_config: dict) -> list[str]:
+    '''
+    all url patterns to block: the ones for
+    every blocked resource type, plus the
+    ones listed in `blocked_url_patterns`.
+    '''
+    patterns = []
+    for resource_type in browser_config.get('blocked_resource_types') or []:
+        if resource_type not in RESOURCE_TYPE_PATTERNS:
+            raise ValueError(
+                f'{resource_type} not a blockable resource type, '
+                f'pick from {list(RESOURCE_TYPE_PATTERNS)}')
+        patterns.extend(RESOURCE_TYPE_PATTERNS[resource_type])
+
+    patterns.extend(browser_config.get('blocked_url_patterns') or [])
+
+    return patterns
+
+
+def chrome_options(browser_config: dict):
+    '''
+    builds the ChromeOptions for a
+    `browser` config section.
+    '''
+    from selenium.webdriver.chrome.options import Options
+
+    options = Options()
+    options.page_load_strategy = browser_config.get('page_load_strategy', 'normal')
+
+    if browser_config.get('headless'):
+        options.add_argument('--headless=new')
+    if browser_config.get('window_size'):
+        options.add_argument(f'--window-size={browser_config["window_size"]}')
+    if browser_config.get('user_agent'):
+        options.add_argument(f'--user-agent={browser_config["user_agent"]}')
+
+    # blocking images in the profile as well
+    # catches the urls without an extension
+    prefs = {}
+    blocked_types = browser_config.get('blocked_resource_types') or []
+    if 'image' in blocked_types:
+        prefs['profile.managed_default_content_settings.images'] = CONTENT_SETTING_BLOCK
+    if prefs:
+        options.add_experimental_option('prefs', prefs)
+
+    return options
+
+
+def block_urls(driver,
+               patterns: list[str]):
+    '''
+    tells the browser (through the devtools
+    protocol) not to load anything matching
+    the patterns. lasts for the lifetime
+    of the driver.
+    '''
+    if not patterns:
+        return
+
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls' : patterns})
+    logging.info(f'blocking {len(patterns)} url patterns')
+
+
+def new_chrome_driver(chromedriver: str | None,
+                      browser_config: dict):
+    '''
+    starts a chrome instance set up
+    according to browser_config.
+    '''
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+
+    driver = webdriver.Chrome(
+        service=Service(executable_path=chromedriver),
+        options=chrome_options(browser_config))
+
+    block_urls(driver, blocked_url_patterns(browser_config))
+
+    return driver
@@ -15,34 +15,164 @@
 ############
 # IMPORTS 
 ############
-import os
-from dotenv import load_dotenv
-import yaml
 import logging
+import datetime as dt
+import threading
 from typing import Literal
+from contextlib import contextmanager
 
 import sqlite3
-from src.id_factory import Journey, FlightSearch
-from src.airport_utils import calculate_distance, calculate_absolute_leg_distance
+from src.settings import get_settings
+
+# NOTE: id_factory (pydantic) and airport_utils
+# (numpy, airport data) are imported in the
+# functions which need them, so that reading
+# from the db stays quick to start up.
 
 ############
 # INIT
 ############
 logging.getLogger('db_utils')
 
-load_dotenv()
-
 ############
 # PATHS & CONSTANTS 
 ############
-DB_PATH = os.getenv('DB_PATH')
-
-INSERT_MAP = yaml.load(open('config.yaml'), Loader=yaml.FullLoader)['insert_map']
+DB_PATH = get_settings().db_path
+
+INSERT_MAP = get_settings().insert_map
+# how prices are written: a row per observation
+# ('rows'), or a row per run of observations at
+# the same price ('runs', see migration 0003)
+PRICE_STORAGE = get_settings().price_storage
+PRICE_STORAGE_MODES = ['rows', 'runs']
+DAILY_ROLLUPS = get_settings().daily_rollups
+FETCH_SIZE = 1000 # rows per fetchmany when streaming query results
+
+# the daily price tables (see migration 0004):
+# rollup -> (table, key columns), and how
+# each key is found for a price
+ROLLUPS = {
+    'search' : ('daily_search_prices', ['search_id']),
+    'route' : ('daily_route_prices', ['origin', 'destination', 'n_legs']),
+    'airline' : ('daily_airline_prices', ['airline'])
+}
+ROLLUP_KEYS = {
+    'search_id' : 'j.search_id',
+    'origin' : 'l.departure_airport',
+    'destination' : 'l.arrival_airport',
+    'n_legs' : 'j.n_legs',
+    'airline' : "COALESCE(j.airline, '')"
+}
+
+# the columns of get_price_history, for a
+# journey per row, and for a leg per row
+HISTORY_JOURNEY_COLUMNS = [
+    'search_id', 'journey_id', 'price', 'currency', 'created_at',
+    'n_legs', 'airline', 'class', 'cabin_baggage', 'checked_baggage']
+HISTORY_LEG_COLUMNS = HISTORY_JOURNEY_COLUMNS + [
+    'leg_number', 'departure_time', 'arrival_time', 'departure_airport', 'arrival_airport',
+    'duration', 'n_stops', 'stopover_airports', 'distance_nominal', 'distance_absolute']
+
+# expands every price run r back into one
+# row per observation o of its source
+RUN_OBSERVATIONS_JOIN = '''
+    JOIN price_observations o
+        ON o.source_id = r.source_id AND o.observed_at BETWEEN r.first_seen AND r.last_seen
+'''
+
+# the unfinished run of a search, if there's
+# one recent enough to resume (DBWriter.start_run).
+# only a run that never got to finish_run (the
+# process was killed, or crashed) is unfinished
+UNFINISHED_RUN_QUERY = '''
+    SELECT run_id FROM scrape_runs
+    WHERE search_id = ? AND status = 'running' AND started_at >= ?
+    ORDER BY started_at DESC LIMIT 1
+'''
+
+# the runs of a source seen at one of its
+# observations, e.g. its latest, which are the
+# runs still open (DBWriter.extend_price_runs)
+OPEN_PRICE_RUNS_QUERY = '''
+    SELECT price_run_id, journey_id, price, currency FROM price_runs
+    WHERE source_id = ? AND last_seen = ?
+'''
+
+# how many prices we've recorded for a search,
+# the last time we saw one, and the latest row
+# they're in: first for prices rows, then for
+# price runs (get_search_watermark)
+SEARCH_WATERMARK_QUERY = '''
+    SELECT COUNT(*), MAX(p.created_at), MAX(p.price_id)
+    FROM journeys j
+    JOIN prices p ON p.journey_id = j.journey_id
+    WHERE j.search_id = ?
+    UNION ALL
+    SELECT COALESCE(SUM(r.n_seen), 0), MAX(r.last_seen), MAX(r.price_run_id)
+    FROM journeys j
+    JOIN price_runs r ON r.journey_id = j.journey_id
+    WHERE j.search_id = ?
+'''
+
+# compound airport codes, loaded from
+# the db on first use
+_compound_airports = None
+_compound_airports_lock = threading.Lock()
 
 ############
 # FUNCTIONS 
 ############
 # helpers
+@contextmanager
+def _connection(conn: sqlite3.Connection | None = None):
+    '''
+    yields conn if we've been given an 
+    open connection, otherwise opens one
+    to DB_PATH (and closes it afterwards).
+    '''
+    if conn is not None:
+        yield conn
+        return
+
+    conn = sqlite3.connect(DB_PATH)
+    logging.debug(f'connected to db at {DB_PATH}')
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def _rollup_query(rollup: str,
+                  prices: str) -> str:
+    '''
+    the query adding the prices in the table
+    (or subquery) `prices` to a daily price
+    table, merging them into the rows which
+    are already there.
+    '''
+    table, keys = ROLLUPS[rollup]
+    key_expressions = [ROLLUP_KEYS[key] for key in keys]
+    legs_join = 'JOIN legs l ON l.journey_id = j.journey_id AND l.leg_number = 1' if rollup == 'route' else ''
+    group_by = ', '.join(key_expressions + ['substr(p.created_at, 1, 10)', 'p.currency'])
+
+    # `WHERE true` keeps sqlite from reading the
+    # ON CONFLICT as part of the join
+    return f'''
+        INSERT INTO {table} ({', '.join(keys)}, day, currency, min_price, max_price, sum_price, n_prices)
+        SELECT {group_by}, MIN(p.price), MAX(p.price), SUM(p.price), COUNT(*)
+        FROM {prices} p
+        JOIN journeys j ON j.journey_id = p.journey_id
+        {legs_join}
+        WHERE true
+        GROUP BY {group_by}
+        ON CONFLICT ({', '.join(keys)}, day, currency) DO UPDATE SET
+            min_price = MIN(min_price, excluded.min_price),
+            max_price = MAX(max_price, excluded.max_price),
+            sum_price = sum_price + excluded.sum_price,
+            n_prices = n_prices + excluded.n_prices
+    '''
+
+
 def flatten_list(l: list) -> str:
     '''
     flattens a list of strings
@@ -70,6 +200,140 @@ def flatten_list(l: list) -> str:
 
 # extracting data
 # for sql tables
+def _journey_row(journey: 'Journey',
+                 journey_id: str,
+                 search_id: str) -> tuple:
+    '''
+    the journeys row for a 
+    validated journey.
+    '''
+    return (
+        journey_id, 
+        search_id, 
+        len(journey.legs), 
+        journey.meta.cabin_baggage, 
+        journey.meta.checked_baggage, 
+        journey.meta.class_[0],
+        ', '.join(journey.meta.airline))
+
+
+def _leg_rows(journey: 'Journey',
+              journey_id: str) -> list[tuple]:
+    '''
+    the legs rows for a validated journey,
+    without the distances yet - these get
+    added for a whole batch of legs at once
+    by `_add_leg_distances`.
+    '''
+    legs = []
+
+    for i, leg in enumerate(journey.legs):
+        if isinstance(leg.stopover_airports, list):
+            stopover_airports = flatten_list(leg.stopover_airports)
+        else:
+            stopover_airports = leg.stopover_airports
+
+        legs.append((
+            journey_id + f'_{i+1}', 
+            journey_id, 
+            i+1, 
+            leg.departure_timestamp.isoformat(), 
+            leg.arrival_timestamp.isoformat(), 
+            leg.departure_airport, 
+            leg.arrival_airport, 
+            leg.duration.total_seconds(),
+            leg.n_stops,
+            stopover_airports))
+
+    return legs
+
+
+def _add_leg_distances(legs: list[tuple]) -> list[tuple]:
+    '''
+    calculates the nominal distance 
+    (origin-destination) and the absolute 
+    distance (origin-destination, incl stops) 
+    for each leg in km, for all legs in one
+    go, and appends them to the leg rows.
+    '''
+    from src.airport_utils import batch_leg_distances
+
+    if not legs:
+        return []
+
+    nominal, absolute = batch_leg_distances(
+        [leg[5] for leg in legs],
+        [leg[6] for leg in legs],
+        [leg[9] for leg in legs])
+
+    return [
+        leg + (int(distance_nominal), int(distance_absolute))
+        for leg, distance_nominal, distance_absolute 
+        in zip(legs, nominal.tolist(), absolute.tolist())]
+
+
+def _price_row(journey: 'Journey',
+               journey_id: str) -> tuple:
+    '''
+    the prices row for a 
+    validated journey.
+    '''
+    return (
+        journey_id, 
+        journey.meta.price, 
+        journey.meta.currency, 
+        journey.meta.created_at.isoformat())
+
+
+def ingest_journey_options(data: list[dict],
+                           search_id: str) -> tuple[list[tuple], list[tuple], list[tuple]]:
+    '''
+    validates all journey_options in one
+    go, creates every journey_id once, and
+    returns the journeys, legs and prices
+    rows, ready to be inserted into the db.
+
+    this replaces calling extract_journeys,
+    extract_legs and extract_prices one after
+    the other, which validates and hashes
+    every journey three times.
+
+    a journey that comes up more than once
+    (e.g. at an economy and a business price,
+    as cabin class isn't part of its id) gets
+    one journeys row and one set of legs, the
+    same as ends up in the db.
+    '''
+    from src.id_factory import JourneyList
+
+    journeys = []
+    legs = []
+    prices = []
+    seen_journeys = set()
+    seen_prices = set()
+
+    for journey in JourneyList.validate_python(data):
+        journey_id = journey.create_id()
+
+        if journey_id not in seen_journeys:
+            seen_journeys.add(journey_id)
+            journeys.append(_journey_row(journey, journey_id, search_id))
+            legs.extend(_leg_rows(journey, journey_id))
+
+        price = _price_row(journey, journey_id)
+        if price[:3] in seen_prices:
+            logging.info(f'found duplicate price: {price}')
+            continue
+        seen_prices.add(price[:3])
+        prices.append(price)
+
+    legs = _add_leg_distances(legs)
+
+    logging.info(f'ingested {len(journeys)} journeys, {len(legs)} legs, {len(prices)} prices')
+
+    return journeys, legs, prices
+
+
 def extract_journeys(data: list[dict],
                      search_id: str) -> list[tuple]:
     '''
@@ -79,26 +343,11 @@ def extract_journeys(data: list[dict],
     which can be inserted into the
     db.
     '''
-    journeys = []
+    from src.id_factory import JourneyList
 
-    for record in data:
-        journey_id = Journey(**record).create_id()
-        n_legs = len(record['legs'])
-        cabin_baggage = record['meta']['cabin_baggage']
-        checked_baggage = record['meta']['checked_baggage']
-        class_ = record['meta']['class'][0]
-        airline = ', '.join(record['meta']['airline'])
-
-        journeys.append(
-            (journey_id, 
-             search_id, 
-             n_legs, 
-             cabin_baggage, 
-             checked_baggage, 
-             class_,
-             airline))
-    
-    return journeys
+    return [
+        _journey_row(journey, journey.create_id(), search_id)
+        for journey in JourneyList.validate_python(data)]
 
 
 def extract_legs(data: list[dict]) -> list[tuple]:
@@ -111,50 +360,14 @@ def extract_legs(data: list[dict]) -> list[tuple]:
     and the absolute distance (origin-destination, 
     incl stops) for each leg in km. 
     '''
+    from src.id_factory import JourneyList
+
     legs = []
 
-    for record in data:
-        journey_id = Journey(**record).create_id()
-
-        for i, leg in enumerate(record['legs']):
-            leg_id = journey_id + f'_{i+1}'
-            leg_number = i+1
-
-            departure_time = leg['departure_timestamp'].isoformat()
-            arrival_time = leg['arrival_timestamp'].isoformat()
-            departure_airport = leg['departure_airport']
-            arrival_airport = leg['arrival_airport']
-            duration = leg['duration'].total_seconds()
-            n_stops = leg['n_stops']
-            if 'stopover_airports' not in leg.keys():
-                stopover_airports = None
-            if isinstance(leg['stopover_airports'], list):
-                stopover_airports = flatten_list(leg['stopover_airports'])
-            else:
-                stopover_airports = leg['stopover_airports']
-
-            distance_nominal = int(calculate_distance(
-                departure_airport, 
-                arrival_airport))
-
-            distance_absolute = int(calculate_absolute_leg_distance(
-                leg=leg))
-
-            legs.append((
-                leg_id, 
-                journey_id, 
-                leg_number, 
-                departure_time, 
-                arrival_time, 
-                departure_airport, 
-                arrival_airport, 
-                duration,
-                n_stops,
-                stopover_airports,
-                distance_nominal,
-                distance_absolute))
+    for journey in JourneyList.validate_python(data):
+        legs.extend(_leg_rows(journey, journey.create_id()))
     
-    return legs
+    return _add_leg_distances(legs)
 
 
 def extract_prices(data: list[dict]) -> list[tuple]:
@@ -171,28 +384,23 @@ def extract_prices(data: list[dict]) -> list[tuple]:
     so, before we add to the list,
     we check if the combo of journey_id,
     price and currency already exists 
-    IN OUR LIST, not the db.
+    IN OUR LIST, not the db (using a set,
+    so this stays linear for big runs).
     '''
-    prices = []
+    from src.id_factory import JourneyList
 
-    for record in data:
-        journey_id = Journey(**record).create_id()
+    prices = []
+    seen = set()
 
-        price = record['meta']['price']
-        currency = record['meta']['currency']
-        created_at = record['meta']['created_at'].isoformat()
+    for journey in JourneyList.validate_python(data):
+        price = _price_row(journey, journey.create_id())
 
-        dupe = False
-        for p in prices:
-            if journey_id == p[0] and price == p[1] and currency == p[2]:
-                logging.info(f'found duplicate price: {p}')
-                dupe = True
-                break
-        
-        if dupe:
+        if price[:3] in seen:
+            logging.info(f'found duplicate price: {price}')
             continue
-
-        prices.append((journey_id, price, currency, created_at))
+        
+        seen.add(price[:3])
+        prices.append(price)
     
     return prices
 
@@ -205,6 +413,8 @@ def parse_flight_search(data: dict) -> tuple:
     ready for insertion into
     the db.
     '''
+    from src.id_factory import FlightSearch
+
     search_id = FlightSearch(**data).create_id()
 
     journey_type = data['journey_type']
@@ -246,19 +456,13 @@ def parse_flight_search(data: dict) -> tuple:
 
 
 # inserting data
-def execute_insert_query(table: str, 
+def validate_insert_data(table: str,
                          columns: list[str],
                          data: list[tuple] | tuple):
     '''
-    using our INSERT_MAP dict, 
-    we can dynamically create
-    our queries for inserting 
-    data into the db.
-
-    the data generated from 
-    the functions in this module
-    should match the order of
-    the columns in the INSERT_MAP.
+    checks that the table and columns
+    are in our INSERT_MAP, and that the
+    data has the right shape for them.
     '''
     if table not in INSERT_MAP.keys():
         raise ValueError(f'table {table} not in INSERT_MAP')
@@ -274,13 +478,43 @@ def execute_insert_query(table: str,
     else:
         raise ValueError(f'data {data} is not a list or tuple')
 
+
+def build_insert_query(table: str,
+                       columns: list[str]) -> str:
+    '''
+    builds the INSERT OR IGNORE
+    query for a table.
+    '''
     columns_fmtd = f'({", ".join(columns)})'
     values_fmtd = f'({", ".join(["?" for _ in columns])})'
 
-    q = f'''
+    return f'''
         INSERT OR IGNORE INTO {table} {columns_fmtd}
         VALUES {values_fmtd}
         '''
+
+
+def execute_insert_query(table: str, 
+                         columns: list[str],
+                         data: list[tuple] | tuple):
+    '''
+    using our INSERT_MAP dict, 
+    we can dynamically create
+    our queries for inserting 
+    data into the db.
+
+    the data generated from 
+    the functions in this module
+    should match the order of
+    the columns in the INSERT_MAP.
+
+    NOTE: this opens (and commits) its own
+    connection. to write a whole run in one
+    go, use DBWriter instead.
+    '''
+    validate_insert_data(table, columns, data)
+
+    q = build_insert_query(table, columns)
     
     logging.info(f'built query: {q}')
 
@@ -305,6 +539,613 @@ def execute_insert_query(table: str,
     return True
 
 
+class DBWriter:
+    '''
+    a unit of work for writing to the db.
+    holds one connection (in WAL mode, with
+    some pragmas tuned for our bulk inserts)
+    and writes all tables for a run in a
+    single transaction, so we either get the
+    whole run or none of it.
+
+    the insert queries are built once, so
+    sqlite's statement cache hands us the
+    same prepared statements every time.
+
+    use as a context manager:
+
+    with DBWriter() as writer:
+        writer.write_run(flight_search, journeys, legs, prices)
+
+    with price_storage='runs', prices are
+    stored as runs of unchanged prices per
+    source (the url they were observed on),
+    see extend_price_runs. with daily_rollups,
+    the daily price tables are updated in the
+    same transaction, see update_rollups.
+    '''
+    PRAGMAS = {
+        'journal_mode' : 'WAL',
+        'synchronous' : 'NORMAL', # safe with WAL, one fsync per checkpoint
+        'temp_store' : 'MEMORY',
+        'cache_size' : -20000 # in KiB, i.e. ~20MB
+    }
+
+    def __init__(self,
+                 db_path: str = DB_PATH,
+                 price_storage: str = PRICE_STORAGE,
+                 daily_rollups: bool = DAILY_ROLLUPS):
+        if price_storage not in PRICE_STORAGE_MODES:
+            raise ValueError(f'{price_storage} not a price storage mode, pick from {PRICE_STORAGE_MODES}')
+
+        self.db_path = db_path
+        self.price_storage = price_storage
+        self.daily_rollups = daily_rollups
+        # autocommit mode - we start and end
+        # our transactions ourselves. the writer
+        # may be handed to another thread (e.g. the
+        # pipeline's writer stage), as long as only
+        # one thread uses it at a time.
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        logging.debug(f'connected to db at {db_path}')
+
+        for pragma, value in self.PRAGMAS.items():
+            self.conn.execute(f'PRAGMA {pragma} = {value}')
+        logging.debug(f'set pragmas: {self.PRAGMAS}')
+
+        self.queries = {
+            table : build_insert_query(table, columns) 
+            for table, columns in INSERT_MAP.items()}
+        self.rollup_queries = {
+            rollup : _rollup_query(rollup, 'temp.new_prices')
+            for rollup in ROLLUPS}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            logging.debug(f'closed connection to {self.db_path}')
+
+
+    def insert(self,
+               table: str,
+               data: list[tuple] | tuple):
+        '''
+        inserts rows into a table using the
+        prepared query for that table. doesn't
+        commit by itself - call this inside
+        `transaction()` (or use write_run).
+        '''
+        validate_insert_data(table, INSERT_MAP[table], data)
+
+        if isinstance(data, tuple):
+            data = [data]
+
+        self.conn.executemany(self.queries[table], data)
+        logging.debug(f'inserted {len(data)} rows into {table}')
+
+
+    def transaction(self):
+        '''
+        returns a context manager for a
+        transaction, which is committed on
+        exit, or rolled back if anything
+        goes wrong.
+        '''
+        return _Transaction(self.conn)
+
+
+    def write_run(self,
+                  flight_search: tuple,
+                  journeys: list[tuple],
+                  legs: list[tuple],
+                  prices: list[tuple],
+                  source: str | None = None):
+        '''
+        writes everything we got out of
+        one run of a flight search, in
+        one transaction.
+
+        source is the url the prices were
+        observed on, needed to store them
+        as runs.
+        '''
+        with self.transaction():
+            self.insert('flight_searches', flight_search)
+            self.insert('journeys', journeys)
+            self.insert('legs', legs)
+            self.write_prices(prices, source)
+
+        logging.info(f'wrote run for search {flight_search[0]}: '
+                     f'{len(journeys)} journeys, {len(legs)} legs, {len(prices)} prices')
+
+
+    def start_run(self,
+                  search_id: str,
+                  n_urls: int,
+                  resume_within: dt.timedelta | None = None) -> tuple[int, set[str]]:
+        '''
+        records the start of a run of a search,
+        and returns its run_id plus the urls it
+        has already completed.
+
+        if resume_within is given, and there's an
+        unfinished run of the same search (still
+        'running', i.e. the process running it
+        died) that started within it, we carry on with that
+        run (and skip its completed urls) rather
+        than starting a new one. an older run
+        isn't resumed, as its prices would be
+        too stale to go with the new ones.
+
+        needs the scrape_runs table, from
+        migration 0002.
+        '''
+        now = dt.datetime.now()
+        run_id = None
+
+        try:
+            with self.transaction():
+                if resume_within is not None:
+                    row = self.conn.execute(
+                        UNFINISHED_RUN_QUERY, (search_id, (now - resume_within).isoformat())).fetchone()
+                    if row is not None:
+                        run_id = row[0]
+                        self.conn.execute('''
+                            UPDATE scrape_runs SET status = 'running', n_urls = ?
+                            WHERE run_id = ?
+                            ''', (n_urls, run_id))
+
+                if run_id is None:
+                    run_id = self.conn.execute('''
+                        INSERT INTO scrape_runs (search_id, started_at, n_urls, status)
+                        VALUES (?, ?, ?, 'running')
+                        ''', (search_id, now.isoformat(), n_urls)).lastrowid
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                raise ValueError(f'{e} - run `python manage.py migrate` first') from e
+            raise
+
+        completed_urls = {
+            row[0] for row in self.conn.execute(
+                'SELECT url FROM run_urls WHERE run_id = ?', (run_id,))}
+
+        if completed_urls:
+            logging.info(f'resuming run {run_id} of search {search_id}, '
+                         f'{len(completed_urls)} urls already done')
+        else:
+            logging.info(f'started run {run_id} of search {search_id}')
+
+        return run_id, completed_urls
+
+
+    def write_url(self,
+                  run_id: int,
+                  url: str,
+                  flight_search: tuple,
+                  journeys: list[tuple],
+                  legs: list[tuple],
+                  prices: list[tuple]):
+        '''
+        writes the results of one url of a run,
+        and checks the url off, in one transaction.
+        so either both make it into the db, or
+        neither does and the url is done again
+        when the run is resumed.
+        '''
+        with self.transaction():
+            self.insert('flight_searches', flight_search)
+            self.insert('journeys', journeys)
+            self.insert('legs', legs)
+            self.write_prices(prices, url)
+            self.conn.execute('''
+                INSERT OR REPLACE INTO run_urls (run_id, url, completed_at, n_prices)
+                VALUES (?, ?, ?, ?)
+                ''', (run_id, url, dt.datetime.now().isoformat(), len(prices)))
+
+        logging.info(f'wrote url for run {run_id}: '
+                     f'{len(journeys)} journeys, {len(legs)} legs, {len(prices)} prices')
+
+
+    def write_prices(self,
+                     prices: list[tuple],
+                     source: str | None = None):
+        '''
+        writes prices rows the way our
+        price_storage says, and adds them to
+        the daily price tables. doesn't commit
+        by itself, like insert.
+        '''
+        if self.price_storage == 'rows' or not prices:
+            self.insert('prices', prices)
+            recorded = prices
+        else:
+            if source is None:
+                raise ValueError('need the source (url) of the prices to store them as runs')
+            recorded = self.extend_price_runs(source, prices)
+
+        if self.daily_rollups and recorded:
+            self.update_rollups(recorded)
+
+
+    def extend_price_runs(self,
+                          source: str,
+                          prices: list[tuple]) -> list[tuple]:
+        '''
+        records prices rows observed on a
+        source (e.g. a url) as runs: a price
+        that's unchanged since the source's
+        previous observation extends its run,
+        and anything else starts a new one.
+
+        every observation of the source is
+        recorded (one row per page, rather than
+        per price), so a run stands for all of
+        them between first_seen and last_seen,
+        and a journey that goes missing from a
+        page ends its run.
+
+        observations older than the source's
+        latest (e.g. when reparsing archived
+        pages) are slotted in between their
+        neighbours: runs they don't continue
+        are split around them, and a price
+        matching both neighbours' joins their
+        runs up. ones we already have are
+        skipped. doesn't commit by itself.
+
+        returns the prices which were recorded.
+        '''
+        validate_insert_data('prices', INSERT_MAP['prices'], prices)
+
+        try:
+            self.conn.execute('INSERT OR IGNORE INTO price_sources (source) VALUES (?)', (source,))
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                raise ValueError(f'{e} - run `python manage.py migrate` first') from e
+            raise
+        source_id = self.conn.execute(
+            'SELECT source_id FROM price_sources WHERE source = ?', (source,)).fetchone()[0]
+
+        # prices from one page share their created_at,
+        # but a batch could hold several observations
+        observations = {}
+        for price in prices:
+            observations.setdefault(price[3], []).append(price)
+
+        recorded = []
+        counts = dict.fromkeys(['extended', 'started', 'split', 'joined'], 0)
+        for observed_at in sorted(observations):
+            previous, following, seen = self.conn.execute('''
+                SELECT
+                    (SELECT MAX(observed_at) FROM price_observations WHERE source_id = :source_id AND observed_at < :t),
+                    (SELECT MIN(observed_at) FROM price_observations WHERE source_id = :source_id AND observed_at > :t),
+                    EXISTS (SELECT 1 FROM price_observations WHERE source_id = :source_id AND observed_at = :t)
+                ''', {'source_id' : source_id, 't' : observed_at}).fetchone()
+            if seen:
+                logging.warning(f'{source} already observed at {observed_at}, '
+                                f'skipping {len(observations[observed_at])} prices')
+                continue
+
+            self.conn.execute(
+                'INSERT INTO price_observations (source_id, observed_at) VALUES (?, ?)',
+                (source_id, observed_at))
+
+            # runs seen at the previous observation
+            ending = {}
+            if previous is not None:
+                ending = {
+                    (journey_id, price, currency) : price_run_id
+                    for price_run_id, journey_id, price, currency
+                    in self.conn.execute(OPEN_PRICE_RUNS_QUERY, (source_id, previous))}
+
+            # when backfilling, the runs seen at the
+            # next observation: the ones starting there,
+            # and the ones spanning this observation
+            starting = {}
+            spanning = {}
+            if following is not None:
+                for price_run_id, journey_id, price, currency, first_seen, last_seen, n_seen in self.conn.execute('''
+                        SELECT price_run_id, journey_id, price, currency, first_seen, last_seen, n_seen
+                        FROM price_runs
+                        WHERE source_id = ? AND last_seen >= ? AND first_seen <= ?
+                        ''', (source_id, following, following)):
+                    runs = starting if first_seen == following else spanning
+                    runs[(journey_id, price, currency)] = (price_run_id, first_seen, last_seen, n_seen)
+
+            extended = []
+            started = []
+            for journey_id, price, currency, _ in observations[observed_at]:
+                key = (journey_id, price, currency)
+                run = spanning.pop(key, None)
+                if run is not None:
+                    # already spans this observation,
+                    # which now counts towards it
+                    self.conn.execute(
+                        'UPDATE price_runs SET n_seen = n_seen + 1 WHERE price_run_id = ?', (run[0],))
+                    counts['extended'] += 1
+                    continue
+
+                price_run_id = ending.pop(key, None)
+                next_run = starting.pop(key, None)
+                if price_run_id is not None and next_run is not None:
+                    # this observation joins them into one
+                    next_run_id, _, last_seen, n_seen = next_run
+                    self.conn.execute('''
+                        UPDATE price_runs SET last_seen = ?, n_seen = n_seen + ?
+                        WHERE price_run_id = ?
+                        ''', (last_seen, n_seen + 1, price_run_id))
+                    self.conn.execute('DELETE FROM price_runs WHERE price_run_id = ?', (next_run_id,))
+                    counts['joined'] += 1
+                elif price_run_id is not None:
+                    extended.append((observed_at, price_run_id))
+                elif next_run is not None:
+                    self.conn.execute('''
+                        UPDATE price_runs SET first_seen = ?, n_seen = n_seen + 1
+                        WHERE price_run_id = ?
+                        ''', (observed_at, next_run[0]))
+                    counts['extended'] += 1
+                else:
+                    started.append((journey_id, source_id, price, currency, observed_at, observed_at))
+
+            self.conn.executemany('''
+                UPDATE price_runs SET last_seen = ?, n_seen = n_seen + 1
+                WHERE price_run_id = ?
+                ''', extended)
+            self.conn.executemany('''
+                INSERT INTO price_runs (journey_id, source_id, price, currency, first_seen, last_seen, n_seen)
+                VALUES (?, ?, ?, ?, ?, ?, 1)
+                ''', started)
+
+            # runs spanning this observation without
+            # its price in it end before it, and
+            # carry on after it
+            for (journey_id, price, currency), (price_run_id, first_seen, last_seen, n_seen) in spanning.items():
+                n_before = self.conn.execute('''
+                    SELECT COUNT(*) FROM price_observations
+                    WHERE source_id = ? AND observed_at BETWEEN ? AND ?
+                    ''', (source_id, first_seen, previous)).fetchone()[0]
+                self.conn.execute('''
+                    UPDATE price_runs SET last_seen = ?, n_seen = ?
+                    WHERE price_run_id = ?
+                    ''', (previous, n_before, price_run_id))
+                self.conn.execute('''
+                    INSERT INTO price_runs (journey_id, source_id, price, currency, first_seen, last_seen, n_seen)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''', (journey_id, source_id, price, currency, following, last_seen, n_seen - n_before))
+
+            recorded += observations[observed_at]
+            counts['extended'] += len(extended)
+            counts['started'] += len(started)
+            counts['split'] += len(spanning)
+
+        logging.debug(f'{source}: {counts["extended"]} price runs extended, {counts["started"]} started, '
+                      f'{counts["split"]} split, {counts["joined"]} joined')
+
+        return recorded
+
+
+    def update_rollups(self,
+                       prices: list[tuple]):
+        '''
+        adds prices rows (whose journeys are
+        already in the db) to the daily price
+        tables. doesn't commit by itself, so
+        this goes in with the prices or not at
+        all.
+
+        needs the tables from migration 0004.
+        '''
+        try:
+            self.conn.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS new_prices (
+                    journey_id TEXT, price REAL, currency TEXT, created_at TIMESTAMP)
+                ''')
+            self.conn.execute('DELETE FROM temp.new_prices')
+            self.conn.executemany('INSERT INTO temp.new_prices VALUES (?, ?, ?, ?)', prices)
+
+            for query in self.rollup_queries.values():
+                self.conn.execute(query)
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                raise ValueError(f'{e} - run `python manage.py migrate` first') from e
+            raise
+
+        logging.debug(f'added {len(prices)} prices to the daily price tables')
+
+
+    def rebuild_rollups(self,
+                        search_date_from: str | None = None,
+                        search_date_to: str | None = None) -> dict:
+        '''
+        recalculates the daily price tables
+        from every price we have (as rows or
+        runs), or only for the days between
+        two dates (YYYY-MM-DD, inclusive), in
+        one transaction. e.g. after a backfill,
+        or writing with daily_rollups off.
+
+        returns the number of rows in each
+        table for those days.
+        '''
+        day_conditions, day_params = _day_conditions(search_date_from, search_date_to)
+        where = f'WHERE {" AND ".join(day_conditions)}' if day_conditions else ''
+
+        prices, params = _observed_prices_query(search_date_from, search_date_to)
+
+        n_rows = {}
+        with self.transaction():
+            for rollup, (table, _) in ROLLUPS.items():
+                self.conn.execute(f'DELETE FROM {table} {where}', day_params)
+                self.conn.execute(_rollup_query(rollup, f'({prices})'), params)
+                n_rows[rollup] = self.conn.execute(
+                    f'SELECT COUNT(*) FROM {table} {where}', day_params).fetchone()[0]
+
+        logging.info(f'rebuilt daily price tables: {n_rows}')
+
+        return n_rows
+
+
+    def finish_run(self,
+                   run_id: int,
+                   status: str = 'done'):
+        '''
+        marks a run as 'done', 'partial' (some
+        urls or pages failed) or 'failed' (the
+        run was stopped). none of these are
+        resumed, the next run starts afresh.
+        '''
+        with self.transaction():
+            self.conn.execute('''
+                UPDATE scrape_runs SET status = ?, finished_at = ?
+                WHERE run_id = ?
+                ''', (status, dt.datetime.now().isoformat(), run_id))
+
+        logging.info(f'run {run_id} {status}')
+
+
+class _Transaction:
+    '''
+    BEGIN IMMEDIATE on enter, then COMMIT,
+    or ROLLBACK if there was an exception.
+    '''
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            logging.error(f'rolling back transaction: {exc_value}')
+            self.conn.execute('ROLLBACK')
+        return False
+
+
+def backfill_leg_distances(missing_only: bool = False,
+                           batch_size: int = 10000,
+                           db_path: str = DB_PATH) -> int:
+    '''
+    (re)calculates distance_nominal and 
+    distance_absolute for the legs in the db,
+    batch_size legs at a time, using the 
+    vectorised `batch_leg_distances`. 
+    
+    legs with an airport we can't find are
+    logged and skipped. returns the number 
+    of legs updated.
+    '''
+    from src.airport_utils import batch_leg_distances, AirportCodeNotFoundError
+
+    select_q = f'''
+        SELECT rowid, departure_airport, arrival_airport, stopover_airports
+        FROM legs
+        WHERE rowid > ? {'AND (distance_nominal IS NULL OR distance_absolute IS NULL)' if missing_only else ''}
+        ORDER BY rowid
+        LIMIT ?
+    '''
+    update_q = '''
+        UPDATE legs
+        SET distance_nominal = ?, distance_absolute = ?
+        WHERE rowid = ?
+    '''
+
+    n_updated = 0
+    last_rowid = 0
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        while True:
+            rows = conn.execute(select_q, (last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+
+            try:
+                nominal, absolute = batch_leg_distances(
+                    [row[1] for row in rows],
+                    [row[2] for row in rows],
+                    [row[3] for row in rows])
+                updates = [
+                    (int(n), int(a), row[0]) 
+                    for row, n, a in zip(rows, nominal.tolist(), absolute.tolist())]
+            except AirportCodeNotFoundError:
+                # find the culprits leg by leg
+                updates = []
+                for row in rows:
+                    try:
+                        nominal, absolute = batch_leg_distances([row[1]], [row[2]], [row[3]])
+                        updates.append((int(nominal[0]), int(absolute[0]), row[0]))
+                    except AirportCodeNotFoundError as e:
+                        logging.warning(f'skipping leg at rowid {row[0]}: {e}')
+
+            with _Transaction(conn):
+                conn.executemany(update_q, updates)
+            n_updated += len(updates)
+            logging.info(f'updated distances for {n_updated} legs')
+    finally:
+        conn.close()
+
+    return n_updated
+
+
+def drop_recorded_prices(prices: list[tuple],
+                         conn: sqlite3.Connection | None = None) -> list[tuple]:
+    '''
+    drops prices which are already in
+    the db, i.e. where we have a row (or
+    a price run) for the same journey_id
+    observed at the same created_at. 
+    
+    used when re-parsing archived pages,
+    which would otherwise insert a second 
+    copy of every price that parsed fine
+    the first time round.
+
+    pass conn to reuse an open connection
+    (e.g. DBWriter.conn).
+    '''
+    q = f'''
+        SELECT 1 FROM prices
+        WHERE journey_id = ? AND created_at = ?
+        UNION ALL
+        SELECT 1 FROM price_runs r
+        {RUN_OBSERVATIONS_JOIN}
+        WHERE r.journey_id = ? AND r.first_seen <= ? AND r.last_seen >= ? AND o.observed_at = ?
+        LIMIT 1
+    '''
+
+    new_prices = []
+
+    with _connection(conn) as conn:
+        cursor = conn.cursor()
+        logging.debug(f'created cursor')
+
+        for price in prices:
+            journey_id, created_at = price[0], price[3]
+            cursor.execute(q, (journey_id, created_at, journey_id, created_at, created_at, created_at))
+            if cursor.fetchone() is None:
+                new_prices.append(price)
+
+    logging.info(f'{len(prices)-len(new_prices)} of {len(prices)} prices already recorded')
+
+    return new_prices
+
+
 # compound airports
 # add compound airport
 def insert_compound_airport(new_compound_code: str,
@@ -333,7 +1174,23 @@ def insert_compound_airport(new_compound_code: str,
         
         conn.commit()
         logging.debug(f'committed changes')
-        
+
+    # make sure lookups see the new code (and
+    # whatever else was added in the meantime)
+    invalidate_compound_airports()
+
+
+def invalidate_compound_airports():
+    '''
+    drops the cached compound airport codes,
+    so the next lookup reloads them from
+    the db.
+    '''
+    global _compound_airports
+
+    with _compound_airports_lock:
+        _compound_airports = None
+
 
 # retrieving data
 def get_flight_component_by_id(
@@ -374,78 +1231,725 @@ def get_flight_component_by_id(
     return {k : v for k, v in zip(columns, result)}
 
 
+def _stream_query(q: str,
+                  params: tuple | list,
+                  conn: sqlite3.Connection | None = None,
+                  batch_size: int = FETCH_SIZE):
+    '''
+    runs a query and yields its rows
+    as dicts, fetching batch_size rows 
+    at a time, so we never hold the whole
+    result in memory. 
+    
+    if we opened the connection ourselves,
+    it gets closed once the generator is
+    exhausted (or discarded).
+    '''
+    with _connection(conn) as conn:
+        cursor = conn.execute(q, params)
+        logging.debug(f'executed query')
+
+        columns = [x[0] for x in cursor.description]
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(columns, row))
+
+
+def _created_at_conditions(search_date_from: str | None,
+                           search_date_to: str | None,
+                           column: str = 'created_at') -> tuple[list[str], list[str]]:
+    '''
+    the conditions (and params) restricting
+    a query to prices observed between two
+    dates (YYYY-MM-DD, both inclusive). kept
+    as a range on the raw column, so it can
+    use our created_at indexes.
+    '''
+    conditions = []
+    params = []
+
+    if search_date_from is not None:
+        conditions.append(f'{column} >= ?')
+        params.append(search_date_from)
+    if search_date_to is not None:
+        day_after = dt.date.fromisoformat(search_date_to) + dt.timedelta(days=1)
+        conditions.append(f'{column} < ?')
+        params.append(day_after.isoformat())
+
+    return conditions, params
+
+
+def _price_runs_conditions(search_date_from: str | None,
+                           search_date_to: str | None) -> tuple[list[str], list[str]]:
+    '''
+    like _created_at_conditions, for prices
+    rebuilt from price runs (r) and their
+    observations (o). also rules out whole
+    runs outside the dates, so we don't have
+    to expand them first.
+    '''
+    conditions, params = _created_at_conditions(search_date_from, search_date_to, column='o.observed_at')
+    ends, ends_params = _created_at_conditions(search_date_from, None, column='r.last_seen')
+    starts, starts_params = _created_at_conditions(None, search_date_to, column='r.first_seen')
+
+    return conditions + ends + starts, params + ends_params + starts_params
+
+
+def _day_conditions(search_date_from: str | None,
+                    search_date_to: str | None) -> tuple[list[str], list[str]]:
+    '''
+    the conditions (and params) restricting
+    a daily price table to the days between
+    two dates (YYYY-MM-DD, both inclusive).
+    '''
+    conditions = []
+    params = []
+
+    if search_date_from is not None:
+        conditions.append('day >= ?')
+        params.append(search_date_from)
+    if search_date_to is not None:
+        conditions.append('day <= ?')
+        params.append(search_date_to)
+
+    return conditions, params
+
+
+def _observed_prices_query(search_date_from: str | None = None,
+                           search_date_to: str | None = None) -> tuple[str, list[str]]:
+    '''
+    a query (and its params) for every price
+    observed, from the prices table and price
+    runs, as journey_id, price, currency and
+    created_at. optionally only between two
+    dates (YYYY-MM-DD, inclusive).
+    '''
+    conditions, params = _created_at_conditions(search_date_from, search_date_to)
+    run_conditions, run_params = _price_runs_conditions(search_date_from, search_date_to)
+
+    def where(conditions: list[str]) -> str:
+        return f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    q = f'''
+        SELECT journey_id, price, currency, created_at
+        FROM prices
+        {where(conditions)}
+        UNION ALL
+        SELECT r.journey_id, r.price, r.currency, o.observed_at AS created_at
+        FROM price_runs r
+        {RUN_OBSERVATIONS_JOIN}
+        {where(run_conditions)}
+    '''
+
+    return q, params + run_params
+
+
+def _search_param_conditions(origin: str | list[str] | None = None,
+                             destination: str | list[str] | None = None,
+                             leave_date: str | list[str] | None = None,
+                             return_date: str | None = None,
+                             flex: str | int | None = None,
+                             journey_type: str | None = None,
+                             table: str = 'flight_searches') -> tuple[list[str], list]:
+    '''
+    the conditions (and params) matching 
+    flight_searches rows on their params,
+    formatted the way `parse_flight_search`
+    stores them. params which are None are
+    left out.
+    '''
+    conditions = []
+    params = []
+
+    def to_db_date(date: str) -> str:
+        return dt.datetime.strptime(date, '%Y-%m-%d').isoformat()
+
+    if origin is not None:
+        conditions.append(f'{table}.origin = ?')
+        params.append(flatten_list(origin) if isinstance(origin, list) else origin)
+    if destination is not None:
+        conditions.append(f'{table}.destination = ?')
+        params.append(flatten_list(destination) if isinstance(destination, list) else destination)
+    if leave_date is not None:
+        conditions.append(f'{table}.leave_date = ?')
+        if isinstance(leave_date, list):
+            params.append(flatten_list([to_db_date(x) for x in leave_date]))
+        else:
+            params.append(to_db_date(leave_date))
+    if return_date is not None:
+        conditions.append(f'{table}.return_date = ?')
+        params.append(to_db_date(return_date))
+    if flex is not None:
+        conditions.append(f'{table}.flex = ?')
+        params.append(int(flex))
+    if journey_type is not None:
+        conditions.append(f'{table}.journey_type = ?')
+        params.append(journey_type)
+
+    return conditions, params
+
+
+# queries. the read functions below each build
+# their sql (and params) with one of these, which
+# is also what `manage.py migrate --check` runs
+# EXPLAIN QUERY PLAN on (see migrations.HOT_QUERIES)
+def prices_for_journey_query(journey_id: str,
+                             search_date_from: str | None = None,
+                             search_date_to: str | None = None) -> tuple[str, list]:
+    '''
+    the query (and params) of
+    get_prices_for_journey.
+    '''
+    conditions, params = _created_at_conditions(search_date_from, search_date_to)
+    run_conditions, run_params = _price_runs_conditions(search_date_from, search_date_to)
+
+    q = f'''
+        SELECT journey_id, price, currency, created_at 
+        FROM prices
+        WHERE {' AND '.join(['journey_id = ?'] + conditions)}
+        UNION ALL
+        SELECT r.journey_id, r.price, r.currency, o.observed_at AS created_at
+        FROM price_runs r
+        {RUN_OBSERVATIONS_JOIN}
+        WHERE {' AND '.join(['r.journey_id = ?'] + run_conditions)}
+        ORDER BY created_at
+    '''
+
+    return q, [journey_id] + params + [journey_id] + run_params
+
+
+def prices_for_search_query(search_id: str,
+                            search_date_from: str | None = None,
+                            search_date_to: str | None = None) -> tuple[str, list]:
+    '''
+    the query (and params) of
+    get_prices_for_search.
+    '''
+    conditions, params = _created_at_conditions(search_date_from, search_date_to, column='p.created_at')
+    run_conditions, run_params = _price_runs_conditions(search_date_from, search_date_to)
+
+    q = f'''
+        SELECT p.journey_id, p.price, p.currency, p.created_at
+        FROM journeys j
+        JOIN prices p ON p.journey_id = j.journey_id
+        WHERE {' AND '.join(['j.search_id = ?'] + conditions)}
+        UNION ALL
+        SELECT r.journey_id, r.price, r.currency, o.observed_at AS created_at
+        FROM journeys j
+        JOIN price_runs r ON r.journey_id = j.journey_id
+        {RUN_OBSERVATIONS_JOIN}
+        WHERE {' AND '.join(['j.search_id = ?'] + run_conditions)}
+    '''
+
+    return q, [search_id] + params + [search_id] + run_params
+
+
+def price_runs_for_search_query(search_id: str,
+                                search_date_from: str | None = None,
+                                search_date_to: str | None = None) -> tuple[str, list]:
+    '''
+    the query (and params) for the runs
+    of get_price_runs_for_search.
+    '''
+    conditions, params = _created_at_conditions(search_date_from, search_date_to, column='p.created_at')
+    ends, ends_params = _created_at_conditions(search_date_from, None, column='r.last_seen')
+    starts, starts_params = _created_at_conditions(None, search_date_to, column='r.first_seen')
+
+    q = f'''
+        SELECT r.journey_id, r.price, r.currency, r.first_seen, r.last_seen, r.source_id
+        FROM journeys j
+        JOIN price_runs r ON r.journey_id = j.journey_id
+        WHERE {' AND '.join(['j.search_id = ?'] + ends + starts)}
+        UNION ALL
+        SELECT p.journey_id, p.price, p.currency, p.created_at, p.created_at, NULL
+        FROM journeys j
+        JOIN prices p ON p.journey_id = j.journey_id
+        WHERE {' AND '.join(['j.search_id = ?'] + conditions)}
+    '''
+
+    return q, [search_id] + ends_params + starts_params + [search_id] + params
+
+
+def search_observations_query(search_id: str,
+                              search_date_from: str | None = None,
+                              search_date_to: str | None = None) -> tuple[str, list]:
+    '''
+    the query (and params) for the
+    observations of get_price_runs_for_search.
+    '''
+    observed, observed_params = _created_at_conditions(search_date_from, search_date_to, column='o.observed_at')
+
+    q = f'''
+        SELECT o.source_id, o.observed_at
+        FROM price_observations o
+        WHERE o.source_id IN (
+                SELECT r.source_id
+                FROM journeys j
+                JOIN price_runs r ON r.journey_id = j.journey_id
+                WHERE j.search_id = ?)
+            {''.join(f' AND {c}' for c in observed)}
+        ORDER BY o.source_id, o.observed_at
+    '''
+
+    return q, [search_id] + observed_params
+
+
+def price_history_query(view: Literal['journeys', 'legs'] = 'journeys',
+                        search_id: str | list[str] | None = None,
+                        search_date_from: str | None = None,
+                        search_date_to: str | None = None) -> tuple[str, list]:
+    '''
+    the query (and params) of
+    get_price_history.
+    '''
+    if view == 'journeys':
+        columns = HISTORY_JOURNEY_COLUMNS
+        legs_join = ''
+    elif view == 'legs':
+        columns = HISTORY_LEG_COLUMNS
+        legs_join = 'JOIN legs l ON l.journey_id = j.journey_id'
+    else:
+        raise ValueError(f'{view} not a view, pick from journeys or legs')
+
+    def select(price_table: str, created_at: str) -> str:
+        selected = []
+        for c in columns:
+            if c in ['price', 'currency']:
+                selected.append(f'{price_table}.{c}')
+            elif c == 'created_at':
+                selected.append(created_at)
+            elif c in HISTORY_JOURNEY_COLUMNS:
+                selected.append(f'j.{c}')
+            else:
+                selected.append(f'l.{c}')
+        return ', '.join(selected)
+
+    search_conditions = []
+    search_params = []
+    if search_id is not None:
+        search_ids = search_id if isinstance(search_id, list) else [search_id]
+        search_conditions.append(f'j.search_id IN ({", ".join("?" * len(search_ids))})')
+        search_params += search_ids
+
+    conditions, params = _created_at_conditions(search_date_from, search_date_to, column='p.created_at')
+    run_conditions, run_params = _price_runs_conditions(search_date_from, search_date_to)
+
+    def where(conditions: list[str]) -> str:
+        return f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    q = f'''
+        SELECT {select('p', 'p.created_at')}
+        FROM journeys j
+        JOIN prices p ON p.journey_id = j.journey_id
+        {legs_join}
+        {where(search_conditions + conditions)}
+        UNION ALL
+        SELECT {select('r', 'o.observed_at AS created_at')}
+        FROM journeys j
+        JOIN price_runs r ON r.journey_id = j.journey_id
+        {RUN_OBSERVATIONS_JOIN}
+        {legs_join}
+        {where(search_conditions + run_conditions)}
+    '''
+
+    return q, search_params + params + search_params + run_params
+
+
+def daily_prices_query(by: Literal['search', 'route', 'airline'] = 'search',
+                       search_date_from: str | None = None,
+                       search_date_to: str | None = None,
+                       **keys) -> tuple[str, list]:
+    '''
+    the query (and params) of
+    get_daily_prices.
+    '''
+    if by not in ROLLUPS:
+        raise ValueError(f'{by} not a rollup, pick from {list(ROLLUPS)}')
+
+    table, key_columns = ROLLUPS[by]
+    unknown = [key for key in keys if key not in key_columns]
+    if unknown:
+        raise ValueError(f'{unknown} not keys of the {by} rollup, pick from {key_columns}')
+
+    conditions = [f'{key} = ?' for key in keys]
+    params = list(keys.values())
+    day_conditions, day_params = _day_conditions(search_date_from, search_date_to)
+    conditions += day_conditions
+    params += day_params
+
+    q = f'''
+        SELECT {', '.join(key_columns)}, day, currency,
+            min_price, max_price, sum_price / n_prices AS mean_price, n_prices
+        FROM {table}
+        {f'WHERE {" AND ".join(conditions)}' if conditions else ''}
+        ORDER BY {', '.join(key_columns)}, day, currency
+    '''
+
+    return q, params
+
+
+def search_id_query(origin: str | list[str],
+                    destination: str | list[str],
+                    leave_date: str | list[str],
+                    return_date: str | None = None,
+                    flex: int | None = None,
+                    journey_type: str | None = None) -> tuple[str, list]:
+    '''
+    the query (and params) of
+    search_to_search_id.
+    '''
+    conditions, params = _search_param_conditions(
+        origin, destination, leave_date, journey_type=journey_type)
+    conditions.append('return_date IS ?')
+    params.append(None if return_date is None else dt.datetime.strptime(return_date, '%Y-%m-%d').isoformat())
+    conditions.append('flex IS ?')
+    params.append(None if flex is None else int(flex))
+
+    q = f'''
+        SELECT search_id 
+        FROM flight_searches
+        WHERE {' AND '.join(conditions)}
+    '''
+
+    return q, params
+
+
+def find_journeys_query(search_id: str | None = None,
+                        origin: str | list[str] | None = None,
+                        destination: str | list[str] | None = None,
+                        leave_date: str | list[str] | None = None,
+                        return_date: str | None = None,
+                        flex: int | None = None) -> tuple[str, list]:
+    '''
+    the query (and params) of
+    find_journeys.
+    '''
+    conditions, params = _search_param_conditions(
+        origin, destination, leave_date, return_date, flex, table='s')
+    if search_id is not None:
+        conditions.append('j.search_id = ?')
+        params.append(search_id)
+    if not conditions:
+        raise ValueError('need a search_id or at least one search param')
+
+    q = f'''
+        SELECT j.journey_id
+        FROM flight_searches s
+        JOIN journeys j ON j.search_id = s.search_id
+        WHERE {' AND '.join(conditions)}
+    '''
+
+    return q, params
+
+
+def journey_query(journey_id: str) -> tuple[str, list]:
+    '''
+    the query (and params) of
+    get_journey.
+    '''
+    journey_columns = [f'j.{c}' for c in INSERT_MAP['journeys']]
+    leg_columns = [f'l.{c} AS leg__{c}' for c in INSERT_MAP['legs']]
+    price_columns = [f'p.{c} AS price__{c}' for c in ['price', 'currency', 'created_at']]
+
+    q = f'''
+        SELECT {', '.join(journey_columns + leg_columns + price_columns)}
+        FROM journeys j
+        LEFT JOIN legs l ON l.journey_id = j.journey_id
+        LEFT JOIN (
+            SELECT price, currency, created_at
+            FROM prices
+            WHERE journey_id = ?
+            UNION ALL
+            SELECT price, currency, last_seen AS created_at
+            FROM price_runs
+            WHERE journey_id = ?
+            ORDER BY created_at DESC
+            LIMIT 1
+        ) p
+        WHERE j.journey_id = ?
+        ORDER BY l.leg_number
+    '''
+
+    return q, [journey_id, journey_id, journey_id]
+
+
+# reading
 def get_prices_for_journey(journey_id: str,
-                           search_date_from: str,
-                           search_date_to: str) -> list[dict]:
+                           search_date_from: str | None = None,
+                           search_date_to: str | None = None,
+                           conn: sqlite3.Connection | None = None):
     '''
+    yields every price observed for a
+    journey, oldest first, optionally only
+    between two dates (YYYY-MM-DD, inclusive).
+
+    prices stored as runs are expanded
+    back into one row per observation, so
+    this is the same series either way.
+    served from the covering indexes on
+    prices and price_runs.
     '''
-    pass
+    q, params = prices_for_journey_query(journey_id, search_date_from, search_date_to)
+
+    return _stream_query(q, params, conn=conn)
 
 
 def get_prices_for_search(search_id: str,
                           search_date_from: str | None = None,
-                          search_date_to: str | None = None) -> list[dict]:
+                          search_date_to: str | None = None,
+                          conn: sqlite3.Connection | None = None):
+    '''
+    yields every price observed for all 
+    journeys of a search, optionally only
+    between two dates (YYYY-MM-DD, inclusive).
+
+    the rows aren't sorted, so they can be
+    streamed straight from the db (sorting
+    them would go through the whole history
+    before the first row).
     '''
+    q, params = prices_for_search_query(search_id, search_date_from, search_date_to)
+
+    return _stream_query(q, params, conn=conn)
+
+
+def get_price_runs_for_search(search_id: str,
+                              search_date_from: str | None = None,
+                              search_date_to: str | None = None,
+                              conn: sqlite3.Connection | None = None) -> tuple[list[tuple], list[tuple]]:
     '''
-    pass
+    the prices of a search as they're
+    stored, without expanding them into
+    observations here: for bulk analysis
+    (see analytics.py), where expanding
+    them outside of python is a lot quicker.
+
+    returns
+    - runs: (journey_id, price, currency,
+      first_seen, last_seen, source_id), with
+      every prices row as a run of its own
+      (source_id None)
+    - observations: (source_id, observed_at)
+      of the sources of those runs, in order
+
+    optionally only between two dates
+    (YYYY-MM-DD, inclusive).
+    '''
+    runs_q, runs_params = price_runs_for_search_query(search_id, search_date_from, search_date_to)
+    observations_q, observations_params = search_observations_query(search_id, search_date_from, search_date_to)
+
+    with _connection(conn) as conn:
+        runs = conn.execute(runs_q, runs_params).fetchall()
+        observations = []
+        if any(run[5] is not None for run in runs):
+            observations = conn.execute(observations_q, observations_params).fetchall()
+
+    return runs, observations
+
+
+def get_search_watermark(search_id: str,
+                         conn: sqlite3.Connection | None = None) -> tuple:
+    '''
+    how many prices we've recorded for a
+    search, the last time we saw one, and the
+    latest prices row and price run they're
+    in. read from the price tables themselves
+    (whether or not we keep daily rollups), it
+    changes whenever a price is written, so it
+    tells us if anything worked out from a
+    search's prices is out of date.
+    '''
+    with _connection(conn) as conn:
+        try:
+            (n_rows, rows_seen, price_id), (n_runs, runs_seen, price_run_id) = conn.execute(
+                SEARCH_WATERMARK_QUERY, (search_id, search_id)).fetchall()
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                raise ValueError(f'{e} - run `python manage.py migrate` first') from e
+            raise
+
+    last_seen = max((seen for seen in [rows_seen, runs_seen] if seen is not None), default=None)
+
+    return n_rows + n_runs, last_seen, price_id, price_run_id
+
+
+def get_price_history(view: Literal['journeys', 'legs'] = 'journeys',
+                      search_id: str | list[str] | None = None,
+                      search_date_from: str | None = None,
+                      search_date_to: str | None = None,
+                      conn: sqlite3.Connection | None = None,
+                      batch_size: int = FETCH_SIZE):
+    '''
+    yields every price observed, with the
+    details of its journey (view='journeys',
+    see HISTORY_JOURNEY_COLUMNS), or once for
+    every leg of the journey (view='legs',
+    HISTORY_LEG_COLUMNS). optionally only for
+    some searches, and between two dates
+    (YYYY-MM-DD, inclusive).
+
+    the rows aren't sorted, so they can be
+    streamed straight from the db however
+    long the history is.
+    '''
+    q, params = price_history_query(view, search_id, search_date_from, search_date_to)
+
+    return _stream_query(q, params, conn=conn, batch_size=batch_size)
+
+
+def get_daily_prices(by: Literal['search', 'route', 'airline'] = 'search',
+                     search_date_from: str | None = None,
+                     search_date_to: str | None = None,
+                     conn: sqlite3.Connection | None = None,
+                     **keys):
+    '''
+    yields the cheapest, dearest and mean
+    price per day, and how many prices they
+    are from, per search, route or airline
+    (see ROLLUPS). pass the keys to look at,
+    e.g.
+
+    get_daily_prices('search', search_id=search_id)
+    get_daily_prices('route', origin='LHR', destination='LAX')
+
+    optionally only between two dates
+    (YYYY-MM-DD, inclusive). rows come in
+    the order of the table's key, then day.
+
+    reads the daily price tables only, so
+    they need to be up to date (see
+    DBWriter.update_rollups).
+    '''
+    q, params = daily_prices_query(by, search_date_from, search_date_to, **keys)
+
+    return _stream_query(q, params, conn=conn)
 
 
 def search_to_search_id(origin: str | list[str],
-                        departure: str | list[str],
+                        destination: str | list[str],
                         leave_date: str | list[str],
                         return_date: str | None = None,
-                        flex: int | None = None) -> str:
+                        flex: int | None = None,
+                        journey_type: str | None = None,
+                        conn: sqlite3.Connection | None = None) -> str | None:
     '''
+    looks up the search_id of a flight 
+    search by its params (dates as 
+    YYYY-MM-DD). returns None if we've
+    never run that search. 
+    
+    if the same params were searched with
+    several journey types, pass journey_type
+    to pick one - otherwise we return the
+    first match.
     '''
-    pass
+    q, params = search_id_query(origin, destination, leave_date, return_date, flex, journey_type)
+
+    search_ids = [row['search_id'] for row in _stream_query(q, params, conn=conn)]
+
+    if not search_ids:
+        return None
+    if len(search_ids) > 1:
+        logging.warning(f'{len(search_ids)} searches match, returning the first: {search_ids}')
+
+    return search_ids[0]
 
 
 def find_journeys(search_id: str | None = None,
                   origin: str | list[str] | None = None,
-                  departure: str | list[str] | None = None,
+                  destination: str | list[str] | None = None,
                   leave_date: str | list[str] | None = None,
                   return_date: str | None = None,
-                  flex: int | None = None) -> list[str]:
+                  flex: int | None = None,
+                  conn: sqlite3.Connection | None = None):
     '''
+    yields the journey_ids of all journeys 
+    found for a search - either given by its
+    search_id, or matching any combination of
+    search params (dates as YYYY-MM-DD).
     '''
-    pass
+    q, params = find_journeys_query(search_id, origin, destination, leave_date, return_date, flex)
 
+    for row in _stream_query(q, params, conn=conn):
+        yield row['journey_id']
 
-def get_journey(journey_id: str) -> dict:
+
+def get_journey(journey_id: str,
+                conn: sqlite3.Connection | None = None) -> dict | None:
+    '''
+    returns a journey, with its legs (in 
+    order) and the latest price we have for
+    it, from a single joined query:
+
+    {**journey, 'legs' : [leg, ...], 'latest_price' : price | None}
+
+    returns None if there's no such journey.
+    '''
+    q, params = journey_query(journey_id)
+
+    journey = None
+    for row in _stream_query(q, params, conn=conn):
+        if journey is None:
+            journey = {c : row[c] for c in INSERT_MAP['journeys']}
+            journey['legs'] = []
+            if row['price__created_at'] is None:
+                journey['latest_price'] = None
+            else:
+                journey['latest_price'] = {
+                    c : row[f'price__{c}'] for c in ['price', 'currency', 'created_at']}
+
+        if row['leg__leg_id'] is not None:
+            journey['legs'].append({c : row[f'leg__{c}'] for c in INSERT_MAP['legs']})
+
+    return journey
+
+
+def load_compound_airports(conn: sqlite3.Connection | None = None) -> dict:
+    '''
+    (re)loads the whole compound_airport_codes
+    table into our in-process cache, and
+    returns it as compound code -> included 
+    airport code.
     '''
+    global _compound_airports
+
+    q = '''
+        SELECT compound_code, included_airport_code
+        FROM compound_airport_codes
     '''
-    pass
 
+    with _connection(conn) as conn:
+        compound_airports = dict(conn.execute(q).fetchall())
+
+    with _compound_airports_lock:
+        _compound_airports = compound_airports
+    logging.info(f'loaded {len(compound_airports)} compound airport codes')
+
+    return compound_airports
 
-def match_compound_airport(code: str) -> str:
+
+def match_compound_airport(code: str,
+                           conn: sqlite3.Connection | None = None) -> str:
     '''
     checks if the code is
     a compound airport code.
     if so, returns the included
     airport code.
+
+    the compound codes are loaded from the
+    db once, on the first lookup (using conn,
+    if given), and kept in memory after that,
+    so repeated lookups don't touch the db.
     '''
     if not (len(code) == 3 and code.isalpha()):
             raise ValueError(f'invalid airport code: {code}')
     
-    q = '''
-        SELECT included_airport_code
-        FROM compound_airport_codes
-        WHERE compound_code = ?
-    '''
+    compound_airports = _compound_airports
+    if compound_airports is None:
+        compound_airports = load_compound_airports(conn)
 
-    with sqlite3.connect(DB_PATH) as conn:
-        logging.debug(f'connected to db at {DB_PATH}')
-        
-        cursor = conn.cursor()
-        logging.debug(f'created cursor')
-
-        cursor.execute(q, (code,))
-        logging.debug(f'executed query')
-        
-        result = cursor.fetchone()
-        logging.debug(f'fetched result: {result}')
-
-    if result is None:
-        return code
-    else:
-        return result[0]
\ No newline at end of file
+    return compound_airports.get(code, code)
@@ -0,0 +1,112 @@
+# errors.py
+# flight_prices_trends
+
+# the ways a scrape can go wrong, by how
+# much of it we have to give up on:
+
+# - TransientError: the page didn't load or
+#   changed under our feet (timeouts, stale
+#   elements). worth another go, after a
+#   backoff.
+# - PageError: this page is no good (e.g. we
+#   have no snapshot of it), and trying again
+#   won't help. skip the url, keep going.
+# - BlockError: one result block on an
+#   otherwise good page won't parse. skip the
+#   block, keep the rest of the page.
+
+# anything else (e.g. the browser crashing)
+# stops the run.
+
+############
+# IMPORTS
+############
+import logging
+import random
+from time import sleep
+
+############
+# INIT
+############
+logging.getLogger('errors')
+
+############
+# CLASSES
+############
+class ScrapeError(Exception):
+    pass
+
+
+class TransientError(ScrapeError):
+    pass
+
+
+class PageError(ScrapeError):
+    pass
+
+
+class BlockError(ScrapeError, ValueError):
+    '''
+    a result block we couldn't parse,
+    with its index on the page.
+    '''
+    def __init__(self,
+                 index: int,
+                 message: str):
+        super().__init__(f'block {index}: {message}')
+        self.index = index
+
+
+############
+# FUNCTIONS
+############
+def backoff_delay(attempt: int,
+                  base_delay: float,
+                  max_delay: float) -> float:
+    '''
+    exponential backoff with full jitter: a
+    random wait between 0 and base_delay * 2^attempt
+    (capped at max_delay), so retries from
+    several browsers don't all hit the site
+    at the same moment.
+    '''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def fetch_with_retry(backend,
+                     url: str,
+                     session = None,
+                     retry_count: int = 3,
+                     base_delay: float = 2,
+                     max_delay: float = 60,
+                     wait = sleep):
+    '''
+    fetches a url with a backend, retrying
+    transient errors (TransientError, plus the
+    backend's own `retry_exceptions`) with
+    exponential backoff, up to retry_count
+    attempts in all.
+
+    raises PageError once the attempts are
+    used up, or straight away for a PageError.
+    returns the page and the number of retries.
+    `wait` can be swapped for e.g. an Event's
+    wait, so a stopped run doesn't sit out
+    the backoff.
+    '''
+    transient = (TransientError,) + tuple(backend.retry_exceptions)
+
+    for attempt in range(retry_count):
+        try:
+            return backend.fetch(url, session), attempt
+        except transient as e:
+            if attempt + 1 == retry_count:
+                raise PageError(
+                    f'giving up on {url} after {retry_count} attempts: {type(e).__name__}: {e}') from e
+
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            logging.warning(f'{type(e).__name__} fetching {url} (attempt {attempt+1} of {retry_count}), '
+                            f'retrying in {delay:.1f}s')
+            wait(delay)
+
+    raise PageError(f'no attempts made at {url}, retry_count is {retry_count}')
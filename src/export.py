@@ -0,0 +1,290 @@
+# export.py
+# flight_prices_trends
+
+# module for getting journeys and their price
+# history out of the db (or straight out of a
+# scraper's journey_options) into csv or
+# parquet files, to analyse elsewhere.
+
+# rows are written in batches of BATCH_SIZE
+# as they come out of the db, so an export
+# takes the same memory however long the
+# history is.
+
+# NOTE: parquet needs pyarrow (pip install
+# pyarrow), which is only imported when we
+# actually write parquet.
+
+############
+# IMPORTS
+############
+import os
+import csv
+import logging
+import datetime as dt
+from itertools import islice
+from typing import Iterable, Literal
+
+import src.db_utils as db
+
+############
+# INIT
+############
+logging.getLogger('export')
+
+############
+# PATHS & CONSTANTS
+############
+BATCH_SIZE = 10000 # rows per write, and per parquet row group
+FORMATS = ['csv', 'parquet']
+
+# types of the columns of db.get_price_history
+# (timestamps are iso strings in the db)
+COLUMN_TYPES = {
+    'search_id' : 'string',
+    'journey_id' : 'string',
+    'price' : 'float64',
+    'currency' : 'string',
+    'created_at' : 'timestamp',
+    'n_legs' : 'int64',
+    'airline' : 'string',
+    'class' : 'string',
+    'cabin_baggage' : 'int64',
+    'checked_baggage' : 'int64',
+    'leg_number' : 'int64',
+    'departure_time' : 'timestamp',
+    'arrival_time' : 'timestamp',
+    'departure_airport' : 'string',
+    'arrival_airport' : 'string',
+    'duration' : 'int64',
+    'n_stops' : 'int64',
+    'stopover_airports' : 'string',
+    'distance_nominal' : 'int64',
+    'distance_absolute' : 'int64'
+}
+
+############
+# FUNCTIONS
+############
+# helpers
+def batched(rows: Iterable,
+            batch_size: int = BATCH_SIZE):
+    '''
+    yields lists of up to batch_size
+    items from rows.
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def format_from_path(path: str) -> str:
+    '''
+    the export format for a file name,
+    by its extension.
+    '''
+    fmt = os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in FORMATS:
+        raise ValueError(f'can\'t tell the format of {path}, pick from {FORMATS}')
+
+    return fmt
+
+
+# writing
+def write_csv(rows: Iterable[dict],
+              path: str,
+              columns: list[str],
+              batch_size: int = BATCH_SIZE) -> int:
+    '''
+    writes rows (dicts) to a csv file with
+    a header, batch by batch. returns the
+    number of rows written.
+    '''
+    n_rows = 0
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for batch in batched(rows, batch_size):
+            writer.writerows([[row[c] for c in columns] for row in batch])
+            n_rows += len(batch)
+            logging.debug(f'wrote {n_rows} rows to {path}')
+
+    return n_rows
+
+
+def write_parquet(rows: Iterable[dict],
+                  path: str,
+                  columns: list[str],
+                  batch_size: int = BATCH_SIZE) -> int:
+    '''
+    writes rows (dicts) to a parquet file,
+    one row group per batch, with the types
+    in COLUMN_TYPES. returns the number of
+    rows written.
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError('writing parquet needs pyarrow, run `pip install pyarrow`') from e
+
+    types = {
+        'string' : pa.string(),
+        'float64' : pa.float64(),
+        'int64' : pa.int64(),
+        'timestamp' : pa.timestamp('us')
+    }
+    schema = pa.schema([(c, types[COLUMN_TYPES[c]]) for c in columns])
+    timestamp_columns = {c for c in columns if COLUMN_TYPES[c] == 'timestamp'}
+
+    def column(batch: list[dict], c: str) -> list:
+        # we store timestamps as iso strings
+        if c in timestamp_columns:
+            return [None if row[c] is None else dt.datetime.fromisoformat(row[c]) for row in batch]
+        return [row[c] for row in batch]
+
+    n_rows = 0
+
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in batched(rows, batch_size):
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column(batch, c), type=schema.field(c).type) for c in columns],
+                schema=schema))
+            n_rows += len(batch)
+            logging.debug(f'wrote {n_rows} rows to {path}')
+
+    return n_rows
+
+
+def write_rows(rows: Iterable[dict],
+               path: str,
+               columns: list[str],
+               fmt: str | None = None,
+               batch_size: int = BATCH_SIZE) -> int:
+    '''
+    writes rows to a csv or parquet file
+    (by default going by its extension).
+
+    the rows go to a temporary file next
+    to path first, which is only renamed
+    to path once it's complete.
+    '''
+    fmt = fmt or format_from_path(path)
+    if fmt not in FORMATS:
+        raise ValueError(f'{fmt} not an export format, pick from {FORMATS}')
+
+    writers = {
+        'csv' : write_csv,
+        'parquet' : write_parquet
+    }
+
+    partial_path = f'{path}.part'
+    try:
+        n_rows = writers[fmt](rows, partial_path, columns, batch_size=batch_size)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, path)
+
+    logging.info(f'exported {n_rows} rows to {path}')
+
+    return n_rows
+
+
+# exports
+def export_price_history(path: str,
+                         view: Literal['journeys', 'legs'] = 'journeys',
+                         search_id: str | list[str] | None = None,
+                         search_date_from: str | None = None,
+                         search_date_to: str | None = None,
+                         fmt: str | None = None,
+                         batch_size: int = BATCH_SIZE,
+                         conn = None) -> int:
+    '''
+    streams every price observed in the db
+    (see db.get_price_history), a journey or
+    a leg per row, optionally only for some
+    searches and between two dates (YYYY-MM-DD,
+    inclusive), into a csv or parquet file.
+
+    returns the number of rows written.
+    '''
+    columns = db.HISTORY_LEG_COLUMNS if view == 'legs' else db.HISTORY_JOURNEY_COLUMNS
+    rows = db.get_price_history(
+        view=view,
+        search_id=search_id,
+        search_date_from=search_date_from,
+        search_date_to=search_date_to,
+        conn=conn,
+        batch_size=min(batch_size, db.FETCH_SIZE))
+
+    return write_rows(rows, path, columns, fmt=fmt, batch_size=batch_size)
+
+
+def journey_option_rows(journey_options: list[dict],
+                        search_id: str,
+                        view: Literal['journeys', 'legs'] = 'legs',
+                        batch_size: int = BATCH_SIZE):
+    '''
+    yields the rows get_price_history would
+    give us for journey_options, once they're
+    in the db: ids, distances and all (and
+    numbers cast the way sqlite would).
+
+    the options are ingested batch_size at
+    a time, so we never hold more than one
+    batch of rows.
+    '''
+    if view not in ['journeys', 'legs']:
+        raise ValueError(f'{view} not a view, pick from journeys or legs')
+
+    casts = {'int64' : int, 'float64' : float}
+    def cast(row: dict) -> dict:
+        for c, value in row.items():
+            if value is not None and COLUMN_TYPES[c] in casts:
+                row[c] = casts[COLUMN_TYPES[c]](value)
+        return row
+
+    for batch in batched(journey_options, batch_size):
+        journeys, legs, prices = db.ingest_journey_options(data=batch, search_id=search_id)
+
+        journey_rows = {row[0] : dict(zip(db.INSERT_MAP['journeys'], row)) for row in journeys}
+        leg_rows = {}
+        for row in legs:
+            leg = dict(zip(db.INSERT_MAP['legs'], row))
+            leg_rows.setdefault(leg['journey_id'], []).append(leg)
+
+        for price in prices:
+            price = dict(zip(db.INSERT_MAP['prices'], price))
+            row = {**journey_rows[price['journey_id']], **price}
+            if view == 'journeys':
+                yield cast({c : row[c] for c in db.HISTORY_JOURNEY_COLUMNS})
+                continue
+            for leg in leg_rows.get(price['journey_id'], []):
+                yield cast({c : row[c] if c in db.HISTORY_JOURNEY_COLUMNS else leg[c] for c in db.HISTORY_LEG_COLUMNS})
+
+
+def export_journey_options(journey_options: list[dict],
+                           search_id: str,
+                           path: str,
+                           view: Literal['journeys', 'legs'] = 'legs',
+                           fmt: str | None = None,
+                           batch_size: int = BATCH_SIZE) -> int:
+    '''
+    writes journey options we've just
+    scraped (e.g. a scraper's
+    journey_options) to a csv or parquet
+    file, with the same columns as
+    export_price_history.
+
+    returns the number of rows written.
+    '''
+    columns = db.HISTORY_LEG_COLUMNS if view == 'legs' else db.HISTORY_JOURNEY_COLUMNS
+    rows = journey_option_rows(journey_options, search_id, view=view, batch_size=batch_size)
+
+    return write_rows(rows, path, columns, fmt=fmt, batch_size=batch_size)
@@ -20,11 +20,12 @@
 ############
 import logging
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from typing import List, Optional
 from datetime import datetime, timedelta
 
 import hashlib
+import threading
 
 ############
 # INIT
@@ -80,20 +81,82 @@ class Journey(BaseModel):
         should encompass only the components 
         of the journey not subject to change
         '''
-        journey_dict = self.model_dump()
-
+        # reading the fields straight off the model
+        # gives the same strings as going via
+        # model_dump(), without copying everything
         journey_string = ''
-        for leg in journey_dict['legs']:
-            journey_string += '-'.join([str(leg[x]) for x in JOURNEY_ID['legs']])
-        journey_string += '-'.join([str(journey_dict['meta'][x]) for x in JOURNEY_ID['meta']])
-        logging.info(f'compiled unique journey string: {journey_string}')
+        for leg in self.legs:
+            journey_string += '-'.join([str(getattr(leg, x)) for x in JOURNEY_ID['legs']])
+        journey_string += '-'.join([str(getattr(self.meta, x)) for x in JOURNEY_ID['meta']])
+        logging.debug(f'compiled unique journey string: {journey_string}')
 
         journey_id = hashlib.sha256(journey_string.encode()).hexdigest()
-        logging.info(f'created journey_id: {journey_id}')
+        logging.debug(f'created journey_id: {journey_id}')
 
         return journey_id
 
 
+# de-duplicating journeys
+def journey_fingerprint(record: dict) -> tuple:
+    '''
+    a cheap stand-in for the journey_id
+    of a raw journey_option dict: the same
+    fields, as the same strings, but without
+    validating or hashing anything. two records
+    with the same fingerprint get the same
+    journey_id.
+    '''
+    legs = tuple(
+        tuple(str(leg[x]) for x in JOURNEY_ID['legs'])
+        for leg in record['legs'])
+    meta = tuple(str(record['meta'][x]) for x in JOURNEY_ID['meta'])
+
+    return legs + (meta,)
+
+
+class JourneyIndex:
+    '''
+    keeps track of the journeys seen during
+    a run, keyed on journey fingerprint plus
+    price and currency, so that the same option
+    showing up on several pages (city_options,
+    flex dates) is only kept once.
+    '''
+    def __init__(self):
+        self._seen = set()
+        self._lock = threading.Lock()
+        self.n_duplicates = 0
+
+
+    def add(self,
+            record: dict) -> bool:
+        '''
+        adds a journey_option to the index.
+        returns False if we've already 
+        seen it during this run.
+        '''
+        key = (
+            journey_fingerprint(record), 
+            record['meta']['price'], 
+            record['meta']['currency'])
+
+        with self._lock:
+            if key in self._seen:
+                self.n_duplicates += 1
+                return False
+            self._seen.add(key)
+            return True
+
+
+    def __len__(self):
+        return len(self._seen)
+
+
+# validates a whole batch of journey
+# options in one go
+JourneyList = TypeAdapter(List[Journey])
+
+
 # flight search
 class FlightSearch(BaseModel):
     journey_type: str
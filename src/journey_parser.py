@@ -0,0 +1,172 @@
+# journey_parser.py
+# flight_prices_trends
+
+# single-pass parser for the chunks of a
+# scraped journey. rather than scanning the
+# chunk list once per thing we're looking for
+# (timings, durations, penalties, stops,
+# airports), we tag every chunk once with
+# precompiled patterns, and then build the
+# legs from those tags.
+
+# gives the same output as the helpers in
+# scraper.py (find_timing_chunks,
+# find_last_duration_chunk, chunk_is_penalty,
+# find_parse_stops, is_airport_chunk,
+# parse_timings), which are kept around for
+# comparison - see `benchmark.py parse`.
+
+############
+# IMPORTS
+############
+import logging
+import re
+import datetime as dt
+from bisect import bisect_left
+
+############
+# INIT
+############
+logging.getLogger('journey_parser')
+
+############
+# PATHS & CONSTANTS
+############
+TIMING_PATTERN = re.compile(r'(\d{2}):(\d{2}) – (\d{2}):(\d{2})')
+DURATION_PATTERN = re.compile(r'\d+h \d+m')
+PENALTY_PATTERN = re.compile(r'\+(\d+)')
+STOPS_PATTERN = re.compile(r'(\d+) stop|direct')
+AIRPORT_PATTERN = re.compile(r'[A-Z]{4}')
+
+############
+# FUNCTIONS
+############
+def split_chunks(scraped_journey: str) -> list[str]:
+    '''
+    discards everything before the first
+    timing (ads etc.) and splits a scraped
+    journey into its chunks. the result can
+    be shared between the validity check and
+    the parser, so we only do this once per
+    result block.
+    '''
+    match = TIMING_PATTERN.search(scraped_journey)
+    if match:
+        scraped_journey = scraped_journey[match.start():]
+    return scraped_journey.split('\n')
+
+
+def tag_chunks(chunks: list[str]) -> dict:
+    '''
+    goes over the chunks once, and records
+    the indexes of every kind of chunk we
+    care about, plus the values of the
+    penalty and stops chunks.
+
+    the cheap substring checks in front of
+    each pattern skip the regex for most
+    chunks.
+    '''
+    tags = {
+        'timing' : [],
+        'duration' : [],
+        'penalty' : [],
+        'stops' : [],
+        'airport' : [],
+        'penalty_values' : {},
+        'stops_values' : {}
+    }
+
+    for i, chunk in enumerate(chunks):
+        if ':' in chunk and TIMING_PATTERN.search(chunk):
+            tags['timing'].append(i)
+        if 'h ' in chunk and DURATION_PATTERN.search(chunk):
+            tags['duration'].append(i)
+        if '+' in chunk:
+            match = PENALTY_PATTERN.search(chunk)
+            if match:
+                tags['penalty'].append(i)
+                tags['penalty_values'][i] = int(match.group(1))
+        if 'stop' in chunk or 'direct' in chunk:
+            match = STOPS_PATTERN.search(chunk)
+            if match:
+                tags['stops'].append(i)
+                tags['stops_values'][i] = 0 if match.group(1) is None else int(match.group(1))
+        if AIRPORT_PATTERN.search(chunk):
+            tags['airport'].append(i)
+
+    return tags
+
+
+def _in_range(indexes: list[int],
+              start: int,
+              end: int) -> list[int]:
+    '''
+    the (sorted) indexes falling
+    within [start, end).
+    '''
+    return indexes[bisect_left(indexes, start):bisect_left(indexes, end)]
+
+
+def parse_legs(chunks: list[str],
+               dates: list[str]) -> tuple[list[dict], list[str]]:
+    '''
+    takes the chunks of a journey (see
+    `split_chunks`) and the departure date
+    of every leg, and returns the parsed legs
+    plus the remaining price/meta chunks.
+    '''
+    tags = tag_chunks(chunks)
+    timings = tags['timing']
+
+    if len(dates) != len(timings):
+        raise ValueError(
+            f'Number of dates ({len(dates)}) does not match number of legs ({len(timings)})')
+
+    # the last leg ends at the last duration
+    # chunk, after which comes the price/meta chunk
+    last_duration = tags['duration'][-1]
+    bounds = [(start, timings[i+1]) for i, start in enumerate(timings[:-1])]
+    bounds.append((timings[-1], last_duration+1))
+
+    legs_out = []
+
+    for i, (start, end) in enumerate(bounds):
+        # the first non-zero penalty in the leg, if any
+        penalty = None
+        for index in _in_range(tags['penalty'], start, end):
+            penalty = tags['penalty_values'][index]
+            if penalty:
+                break
+
+        # index 0 of the leg is the timings
+        hh0, mm0, hh1, mm1 = TIMING_PATTERN.search(chunks[start]).groups()
+        departure_date = dt.date.fromisoformat(dates[i])
+        arrival_date = departure_date + dt.timedelta(days=penalty) if penalty else departure_date
+        dep = dt.datetime(departure_date.year, departure_date.month, departure_date.day, int(hh0), int(mm0))
+        arr = dt.datetime(arrival_date.year, arrival_date.month, arrival_date.day, int(hh1), int(mm1))
+
+        airports = [chunks[index][:3] for index in _in_range(tags['airport'], start, end)]
+
+        # the stopover airports come right
+        # after the number of stops
+        stops_indexes = _in_range(tags['stops'], start, end)
+        if not stops_indexes:
+            raise ValueError(f'no stops chunk found in leg: {chunks[start:end]}')
+        stops = tags['stops_values'][stops_indexes[0]]
+        stopovers = chunks[stops_indexes[0]+1].split(', ') if stops > 0 else None
+
+        hours, minutes = chunks[_in_range(tags['duration'], start, end)[-1]].split('h')
+        duration = dt.timedelta(hours=int(hours), minutes=int(minutes[:-1]))
+
+        legs_out.append({
+            'departure_timestamp': dep,
+            'arrival_timestamp': arr,
+            'departure_airport': airports[0],
+            'arrival_airport': airports[1],
+            'duration': duration,
+            'n_stops': stops,
+            'stopover_airports': stopovers
+        })
+
+    return legs_out, chunks[last_duration+1:]
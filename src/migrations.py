@@ -0,0 +1,235 @@
+# migrations.py
+# flight_prices_trends
+
+# module for upgrading an existing db
+# in place. every change to the schema
+# after schema.sql lives in a numbered
+# file in migrations/, e.g.
+#   migrations/0001_hot_query_indexes.sql
+# and the version a db is at is kept in
+# sqlite's `PRAGMA user_version`.
+
+# NOTE: to upgrade a db, run
+# python manage.py migrate
+
+############
+# IMPORTS
+############
+import os
+import logging
+import re
+
+import sqlite3
+import src.db_utils as db
+from src.settings import get_settings, REPO_ROOT
+
+############
+# INIT
+############
+logging.getLogger('migrations')
+
+############
+# PATHS & CONSTANTS
+############
+DB_PATH = get_settings().db_path
+MIGRATIONS_DIR = os.path.join(REPO_ROOT, 'migrations')
+MIGRATION_FILE_PATTERN = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+# the queries our indexes are meant for, built
+# with the same functions (and constants) as the
+# db_utils queries that run them, with example
+# params and the indexes each should be searching
+# (a SEARCH step, not a full SCAN)
+HOT_QUERIES = {
+    'prices_for_journey' : (
+        *db.prices_for_journey_query('journey', '2024-01-01', '2024-12-31'),
+        ['idx_prices_journey_created', 'idx_price_runs_journey', 'PRIMARY KEY']),
+    'prices_for_search' : (
+        *db.prices_for_search_query('search', '2024-01-01', '2024-12-31'),
+        ['idx_journeys_search', 'idx_prices_journey_created', 'idx_price_runs_journey', 'PRIMARY KEY']),
+    'price_history_for_searches' : (
+        *db.price_history_query('legs', ['search', 'other_search'], '2024-01-01', '2024-12-31'),
+        ['idx_journeys_search', 'idx_prices_journey_created', 'idx_price_runs_journey', 'idx_legs_journey']),
+    # NOTE: without a search, the runs half reads
+    # every run (there's no index on last_seen by
+    # itself), only the prices half can search
+    'price_history_since' : (
+        *db.price_history_query('journeys', None, '2024-01-01', None),
+        ['idx_prices_created']),
+    'journey' : (
+        *db.journey_query('journey'),
+        ['idx_legs_journey', 'idx_prices_journey_created', 'idx_price_runs_journey']),
+    'search_id_by_params' : (
+        *db.search_id_query('LHR', 'LAX', '2024-02-08'),
+        ['idx_flight_searches_params']),
+    'journeys_for_search' : (
+        *db.find_journeys_query(search_id='search'),
+        ['idx_journeys_search']),
+    'journeys_by_params' : (
+        *db.find_journeys_query(origin='LHR', destination='LAX', leave_date='2024-02-08'),
+        ['idx_flight_searches_params', 'idx_journeys_search']),
+    'unfinished_run' : (
+        db.UNFINISHED_RUN_QUERY,
+        ('search', '2024-01-01'),
+        ['idx_scrape_runs_search']),
+    'open_price_runs' : (
+        db.OPEN_PRICE_RUNS_QUERY,
+        (1, '2024-01-01'),
+        ['idx_price_runs_open']),
+    'daily_route_prices' : (
+        *db.daily_prices_query('route', '2024-01-01', '2024-12-31', origin='LHR', destination='LAX'),
+        ['PRIMARY KEY']),
+    'price_runs_for_search' : (
+        *db.price_runs_for_search_query('search', '2024-01-01', '2024-12-31'),
+        ['idx_journeys_search', 'idx_price_runs_journey', 'idx_prices_journey_created']),
+    'observations_for_search' : (
+        *db.search_observations_query('search', '2024-01-01', '2024-12-31'),
+        ['PRIMARY KEY', 'idx_journeys_search', 'idx_price_runs_journey']),
+    'search_watermark' : (
+        db.SEARCH_WATERMARK_QUERY,
+        ('search', 'search'),
+        ['idx_journeys_search', 'idx_prices_journey_created', 'idx_price_runs_journey'])
+}
+
+############
+# FUNCTIONS
+############
+def list_migrations(migrations_dir: str = MIGRATIONS_DIR) -> list[tuple[int, str, str]]:
+    '''
+    returns (version, name, path) for every
+    migration file, in order.
+    '''
+    migrations = []
+    for filename in os.listdir(migrations_dir):
+        match = MIGRATION_FILE_PATTERN.match(filename)
+        if match:
+            migrations.append((
+                int(match.group(1)),
+                match.group(2),
+                os.path.join(migrations_dir, filename)))
+
+    migrations.sort()
+
+    versions = [m[0] for m in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f'duplicate migration versions in {migrations_dir}')
+
+    return migrations
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    '''
+    the schema version a db is at.
+    '''
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db_path: str = DB_PATH,
+            target_version: int | None = None,
+            migrations_dir: str = MIGRATIONS_DIR) -> int:
+    '''
+    applies every migration newer than the
+    db's current version (up to target_version,
+    if given). each migration runs in its own
+    transaction together with the version bump,
+    so a failed migration leaves the db at the
+    previous version.
+
+    returns the version the db ends up at.
+    '''
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        current = get_version(conn)
+        logging.info(f'db at {db_path} is at version {current}')
+
+        for version, name, path in list_migrations(migrations_dir):
+            if version <= current:
+                continue
+            if target_version is not None and version > target_version:
+                break
+
+            logging.info(f'applying migration {version:04d}_{name}')
+            with open(path) as f:
+                sql = f.read()
+
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                # executescript would commit our transaction,
+                # so run the statements one by one
+                for statement in split_statements(sql):
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                logging.error(f'migration {version:04d}_{name} failed, db left at version {current}')
+                raise
+
+            current = version
+
+        logging.info(f'db at {db_path} is now at version {current}')
+        return current
+    finally:
+        conn.close()
+
+
+def split_statements(sql: str) -> list[str]:
+    '''
+    splits a sql script into complete
+    statements (so that semicolons inside
+    e.g. triggers or strings don't trip
+    us up).
+    '''
+    statements = []
+    buffer = ''
+    for line in sql.splitlines(keepends=True):
+        if not buffer and line.strip().startswith('--'):
+            continue
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ''
+
+    if buffer.strip():
+        raise ValueError(f'incomplete statement in migration: {buffer}')
+
+    return statements
+
+
+def check_query_plans(db_path: str = DB_PATH,
+                      queries: dict = HOT_QUERIES,
+                      migrations_dir: str = MIGRATIONS_DIR) -> dict:
+    '''
+    runs EXPLAIN QUERY PLAN for each of our
+    hot queries, and checks every index it's
+    meant for is actually searched. returns a
+    dict of query name -> (ok, plan).
+
+    the queries need every migration, so the
+    db has to be at the latest version.
+    '''
+    results = {}
+
+    conn = sqlite3.connect(db_path)
+    try:
+        version = get_version(conn)
+        latest = max((m[0] for m in list_migrations(migrations_dir)), default=0)
+        if version < latest:
+            raise ValueError(f'db at {db_path} is at version {version}, the hot queries need version {latest} '
+                             f'- run `python manage.py migrate` first')
+
+        for name, (q, params, expected_indexes) in queries.items():
+            plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {q}', params)]
+            missing = [
+                index for index in expected_indexes
+                if not any(step.startswith('SEARCH') and index in step for step in plan)]
+            results[name] = (not missing, plan)
+
+            if missing:
+                logging.warning(f'{name} does not search {missing}: {plan}')
+            else:
+                logging.info(f'{name} searches {expected_indexes}')
+    finally:
+        conn.close()
+
+    return results
@@ -0,0 +1,280 @@
+# page_ready.py
+# flight_prices_trends
+
+# module for working out when a results
+# page has finished loading, so we can
+# scrape it as soon as it's stable rather
+# than sleeping for a fixed amount of time.
+# also keeps track of how long pages have
+# taken to load, per country, so timeouts
+# follow what the site is actually doing.
+
+############
+# IMPORTS
+############
+import os
+import json
+import logging
+import re
+import threading
+from collections import deque
+from time import monotonic, sleep
+
+############
+# INIT
+############
+logging.getLogger('page_ready')
+
+############
+# PATHS & CONSTANTS
+############
+# one round trip per poll: clicks the cookie
+# button if it's there, and reports whether the
+# progress bar is there (and shown), its style
+# and the current number of results
+POLL_SCRIPT = '''
+const [barSelector, resultSelector, cookieXpath] = arguments;
+let cookieClicked = false;
+if (cookieXpath) {
+    const button = document.evaluate(
+        cookieXpath, document, null,
+        XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    if (button) {
+        button.click();
+        cookieClicked = true;
+    }
+}
+const bar = document.querySelector(barSelector);
+let barHidden = false;
+if (bar) {
+    const style = window.getComputedStyle(bar);
+    barHidden = bar.hidden || style.display === 'none' || style.visibility === 'hidden';
+}
+return {
+    bar_present: bar !== null,
+    bar_hidden: barHidden,
+    bar_style: bar ? bar.getAttribute('style') : null,
+    n_results: document.querySelectorAll(resultSelector).length,
+    cookie_clicked: cookieClicked
+};
+'''
+
+# every backend (and so every browser, and
+# every search the scheduler runs) shares
+# the load time history file
+_history_write_lock = threading.Lock()
+
+WIDTH_PATTERN = re.compile(r'width:\s*([\d.]+)%')
+SCALE_PATTERN = re.compile(r'scaleX\(([\d.]+)\)')
+
+############
+# FUNCTIONS
+############
+def parse_progress(style: str | None) -> float | None:
+    '''
+    the progress bar reports how far along
+    it is in its style attribute, either as
+    'width: 45%' or as 'transform: scaleX(0.45)'.
+    returns the progress as a fraction
+    between 0 and 1, or None if we can't
+    tell.
+    '''
+    if not style:
+        return None
+
+    match = WIDTH_PATTERN.search(style)
+    if match:
+        return float(match.group(1)) / 100
+
+    match = SCALE_PATTERN.search(style)
+    if match:
+        return float(match.group(1))
+
+    return None
+
+
+def percentile(values: list[float],
+               q: float) -> float:
+    '''
+    nearest-rank percentile, q in [0, 100].
+    '''
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered)-1, round(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+############
+# CLASSES
+############
+class LoadTimeHistory:
+    '''
+    keeps the most recent page load times
+    per country, and derives timeouts from
+    them. the history is written to a small
+    json file, so it carries over between
+    our (cron) runs.
+    '''
+    def __init__(self,
+                 path: str | None,
+                 history_size: int = 50,
+                 min_samples: int = 5,
+                 timeout_percentile: float = 95,
+                 timeout_margin: float = 1.5,
+                 min_timeout: float = 5,
+                 max_timeout: float = 30):
+        self.path = path
+        self.history_size = history_size
+        self.min_samples = min_samples
+        self.timeout_percentile = timeout_percentile
+        self.timeout_margin = timeout_margin
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+        self._lock = threading.Lock()
+        self.load_times = {}
+
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    stored = json.load(f)
+                for country, times in stored.items():
+                    self.load_times[country] = deque(times, maxlen=self.history_size)
+                logging.info(f'loaded page load history from {self.path}')
+            except (OSError, ValueError) as e:
+                logging.warning(f'could not read page load history at {self.path}: {e}')
+
+
+    def timeout(self,
+                country: str) -> float:
+        '''
+        the timeout for a country is a percentile
+        of its recent load times plus a margin,
+        kept between min_timeout and max_timeout.
+        until we've seen enough pages, we
+        use max_timeout.
+        '''
+        with self._lock:
+            times = list(self.load_times.get(country, []))
+
+        if len(times) < self.min_samples:
+            return self.max_timeout
+
+        learned = percentile(times, self.timeout_percentile) * self.timeout_margin
+        return max(self.min_timeout, min(self.max_timeout, learned))
+
+
+    def record(self,
+               country: str,
+               load_time: float,
+               timeout: float | None = None):
+        '''
+        adds a load time to the history
+        and writes it to disk.
+
+        for a page which wasn't ready in time,
+        pass the timeout: it took at least that
+        long, and leaving it out would teach us
+        timeouts that are too short.
+        '''
+        if timeout is not None:
+            load_time = max(load_time, timeout)
+
+        with self._lock:
+            if country not in self.load_times:
+                self.load_times[country] = deque(maxlen=self.history_size)
+            self.load_times[country].append(round(load_time, 3))
+
+            if self.path:
+                self._write({k : list(v) for k, v in self.load_times.items()})
+
+
+    def _write(self,
+               stored: dict):
+        '''
+        writes the history to a temporary file
+        next to path, and swaps it in, so
+        readers never see half a file.
+        '''
+        partial_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with _history_write_lock:
+            try:
+                with open(partial_path, 'w') as f:
+                    json.dump(stored, f)
+                os.replace(partial_path, self.path)
+            except OSError as e:
+                logging.warning(f'could not write page load history to {self.path}: {e}')
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+
+def wait_for_page_ready(driver,
+                        progress_bar_selector: str,
+                        result_selector: str,
+                        timeout: float,
+                        cookie_button_xpath: str | None = None,
+                        poll_interval: float = 0.25,
+                        settle_polls: int = 4) -> tuple[bool, float]:
+    '''
+    polls the page until it's ready, which is
+    the case as soon as either
+
+    a) the progress bar reports completion, or
+       is removed (or hidden) after we've seen
+       it, or
+    b) there are results, and their count hasn't
+       changed for `settle_polls` polls in a row.
+
+    the cookie button gets dismissed along the
+    way, if it shows up. returns whether the page
+    became ready before the timeout, and how long
+    we waited.
+    '''
+    start = monotonic()
+    seen_bar = False
+    last_count = None
+    stable_polls = 0
+    cookie_xpath = cookie_button_xpath
+
+    while True:
+        elapsed = monotonic() - start
+
+        state = driver.execute_script(
+            POLL_SCRIPT,
+            progress_bar_selector,
+            result_selector,
+            cookie_xpath)
+
+        if state['cookie_clicked']:
+            logging.info('cookie decline button clicked')
+            cookie_xpath = None
+
+        progress = parse_progress(state['bar_style'])
+        # a bar without a style attribute is
+        # still there, it just isn't saying much
+        bar_gone = not state['bar_present'] or state['bar_hidden']
+        if not bar_gone:
+            seen_bar = True
+        logging.debug(f'progress: {progress}, results: {state["n_results"]}')
+
+        if progress is not None and progress >= 1:
+            logging.info(f'progress bar complete after {elapsed:.2f}s')
+            return True, elapsed
+
+        if seen_bar and bar_gone and state['n_results'] > 0:
+            logging.info(f'progress bar gone after {elapsed:.2f}s')
+            return True, elapsed
+
+        if state['n_results'] > 0 and state['n_results'] == last_count:
+            stable_polls += 1
+            if stable_polls >= settle_polls:
+                logging.info(f'result count settled at {last_count} after {elapsed:.2f}s')
+                return True, elapsed
+        else:
+            stable_polls = 0
+        last_count = state['n_results']
+
+        if elapsed >= timeout:
+            logging.warning(f'page not ready after {timeout:.2f}s, scraping what we have')
+            return False, elapsed
+
+        sleep(poll_interval)
@@ -0,0 +1,422 @@
+# pipeline.py
+# flight_prices_trends
+
+# runs a journey search as three stages at
+# once, rather than one after the other:
+
+#   fetch (one thread per backend session)
+#     -> pages queue ->
+#   parse + ids (one thread)
+#     -> batches queue ->
+#   write (one thread, one transaction per page)
+
+# the queues are bounded, so if the db falls
+# behind, parsing waits, and if parsing falls
+# behind, the browsers wait - nothing piles up
+# in memory. meanwhile the browsers load the
+# next url while the last page is being
+# parsed and written.
+
+# every url is checked off in the db (see the
+# scrape_runs and run_urls tables) in the same
+# transaction as its results. if a run falls
+# over, the next run of the same search picks
+# it up and only does the urls that are left.
+
+############
+# IMPORTS
+############
+import logging
+import threading
+import datetime as dt
+from queue import Queue, Empty, Full
+from time import perf_counter
+
+from src.settings import get_settings
+from src.errors import PageError, fetch_with_retry
+
+############
+# INIT
+############
+logging.getLogger('pipeline')
+
+############
+# PATHS & CONSTANTS
+############
+PAGE_QUEUE_SIZE = 4
+BATCH_QUEUE_SIZE = 4
+RETRY = get_settings().retry
+RESUME_WITHIN = dt.timedelta(hours=get_settings().resume_within_hours)
+
+# marks the end of a queue
+_DONE = object()
+
+############
+# CLASSES
+############
+class PipelineError(Exception):
+    '''
+    a stage of the pipeline failed, and
+    the run was stopped. pages written
+    before that stay in the db.
+    '''
+    pass
+
+
+class ScrapePipeline:
+    '''
+    scrapes, parses and writes all urls of
+    the scraper's current journey search
+    (see FlightsScaper.new_journey_search),
+    with one transaction per page.
+
+    pipeline = ScrapePipeline(my_flight, writer)
+    summary = pipeline.run()
+
+    an unfinished run of the same search that
+    started less than resume_within ago is
+    resumed (None to always start afresh).
+
+    options are only counted, not kept,
+    unless keep_options=True, in which case
+    they end up in scraper.journey_options
+    (in the order the pages came in).
+    '''
+    def __init__(self,
+                 scraper,
+                 writer,
+                 page_queue_size: int = PAGE_QUEUE_SIZE,
+                 batch_queue_size: int = BATCH_QUEUE_SIZE,
+                 retry_count: int = RETRY['count'],
+                 keep_options: bool = False,
+                 resume_within: dt.timedelta | None = RESUME_WITHIN):
+        self.scraper = scraper
+        self.writer = writer
+        self.page_queue_size = page_queue_size
+        self.batch_queue_size = batch_queue_size
+        self.retry_count = retry_count
+        self.keep_options = keep_options
+        self.resume_within = resume_within
+
+
+    def _put(self,
+             queue: Queue,
+             item,
+             consumer_done: threading.Event) -> bool:
+        '''
+        puts an item on a bounded queue, waiting
+        for space (the backpressure), unless the
+        stage taking items off the queue has
+        stopped in the meantime.
+        '''
+        while not (consumer_done.is_set() or self._stop.is_set()):
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+
+    def _get(self,
+             queue: Queue,
+             producer_done: threading.Event):
+        '''
+        takes the next item off a queue, or
+        returns _DONE once the stage putting
+        items on it is done and it's empty.
+        '''
+        while not self._stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                if producer_done.is_set() and queue.empty():
+                    return _DONE
+        return _DONE
+
+
+    def _fail(self,
+              stage: str,
+              e: Exception):
+        '''
+        records the first error of the run, and
+        stops fetching. pages that are already
+        fetched still get parsed and written,
+        unless it's the writer that failed.
+        '''
+        with self._lock:
+            if self._error is None:
+                self._error = (stage, e)
+        logging.error(f'{stage} stage failed, stopping pipeline: {e}')
+        self._stop_fetching.set()
+        if stage == 'write':
+            self._stop.set()
+
+
+    def _fetch_worker(self,
+                      session,
+                      urls: Queue,
+                      pages: Queue):
+        '''
+        fetches urls with one backend session
+        until there are none left. transient
+        errors are retried with backoff (cut
+        short if the run is stopped); urls we
+        give up on are counted and skipped.
+        '''
+        backend = self.scraper.backend
+
+        try:
+            while not self._stop_fetching.is_set():
+                try:
+                    i, url = urls.get_nowait()
+                except Empty:
+                    return
+
+                logging.info(f'fetching url {i+1} of {self.summary["n_urls"]}')
+                start = perf_counter()
+                try:
+                    page, n_retries = fetch_with_retry(
+                        backend,
+                        url,
+                        session,
+                        retry_count=self.retry_count,
+                        base_delay=RETRY['base_delay'],
+                        max_delay=RETRY['max_delay'],
+                        wait=self._stop_fetching.wait)
+                except PageError as e:
+                    logging.error(f'skipping url {url}: {e}')
+                    with self._lock:
+                        self.summary['n_failed_urls'] += 1
+                    continue
+
+                with self._lock:
+                    self.summary['fetch_seconds'] += perf_counter() - start
+                    self.summary['n_retries'] += n_retries
+
+                if not self._put(pages, page, self._parse_done):
+                    return
+        except Exception as e:
+            self._fail('fetch', e)
+
+
+    def _parse_worker(self,
+                      pages: Queue,
+                      batches: Queue):
+        '''
+        archives and parses every page, drops
+        options we've already seen on an earlier
+        page, and turns the rest into db rows.
+
+        when the writer stores prices as runs,
+        every page keeps all of its own options
+        (bar duplicates on the page itself):
+        runs are per page, and which page got
+        an option first depends on the order
+        the fetches happened to finish in.
+        '''
+        import src.db_utils as db
+        from src.id_factory import JourneyIndex
+
+        scraper = self.scraper
+        search_id = self.flight_search[0]
+
+        try:
+            while True:
+                page = self._get(pages, self._fetch_done)
+                if page is _DONE:
+                    break
+
+                start = perf_counter()
+                scraper.archive_page(page)
+                failed_blocks = []
+                try:
+                    journey_options = scraper.parse_page(page, failed_blocks=failed_blocks)
+                except ValueError as e:
+                    logging.error(f'failed to parse {page.url}: {e}')
+                    self.summary['n_failed_pages'] += 1
+                    continue
+                self.summary['n_skipped_blocks'] += len(failed_blocks)
+
+                new_options = [
+                    option for option in journey_options
+                    if scraper.journey_index.add(option)]
+                if self.keep_options:
+                    scraper.journey_options.extend(new_options)
+
+                if self.writer.price_storage == 'runs':
+                    page_index = JourneyIndex()
+                    page_options = [option for option in journey_options if page_index.add(option)]
+                else:
+                    page_options = new_options
+
+                journeys, legs, prices = db.ingest_journey_options(data=page_options, search_id=search_id)
+                self.summary['parse_seconds'] += perf_counter() - start
+
+                self.summary['n_options'] += len(new_options)
+                for option in new_options:
+                    price = option['meta']['price']
+                    if self.summary['min_price'] is None or price < self.summary['min_price']:
+                        self.summary['min_price'] = price
+
+                if not self._put(batches, (page, journeys, legs, prices), self._write_done):
+                    break
+        except Exception as e:
+            self._fail('parse', e)
+        finally:
+            self._parse_done.set()
+
+
+    def _write_worker(self,
+                      batches: Queue):
+        '''
+        writes each page's rows in
+        its own transaction.
+        '''
+        try:
+            while True:
+                batch = self._get(batches, self._parse_done)
+                if batch is _DONE:
+                    break
+
+                page, journeys, legs, prices = batch
+                start = perf_counter()
+                self.write_page(page, journeys, legs, prices)
+                self.summary['write_seconds'] += perf_counter() - start
+                self.summary['n_pages'] += 1
+                self.summary['n_prices'] += len(prices)
+        except Exception as e:
+            self._fail('write', e)
+        finally:
+            self._write_done.set()
+
+
+    def write_page(self,
+                   page,
+                   journeys: list[tuple],
+                   legs: list[tuple],
+                   prices: list[tuple]):
+        '''
+        commits the rows from one page,
+        and checks its url off.
+        '''
+        self.writer.write_url(self.run_id, page.url, self.flight_search, journeys, legs, prices)
+
+
+    def run(self) -> dict:
+        '''
+        runs the pipeline over all urls and
+        returns a summary: counts and the
+        time spent in each stage (summed over
+        threads, so fetch_seconds can be more
+        than the wall clock `seconds`).
+
+        raises PipelineError if a stage failed.
+        '''
+        import src.db_utils as db
+
+        scraper = self.scraper
+        # _stop_fetching: no more urls, after any
+        # failure. _stop: drop everything, after the
+        # writer failed. the *_done events say a
+        # stage has finished (or given up).
+        self._stop_fetching = threading.Event()
+        self._stop = threading.Event()
+        self._fetch_done = threading.Event()
+        self._parse_done = threading.Event()
+        self._write_done = threading.Event()
+        self._lock = threading.Lock()
+        self._error = None
+
+        self.flight_search = db.parse_flight_search(scraper.get_journey_search())
+        self.summary = {
+            'search_id' : self.flight_search[0],
+            'n_urls' : len(scraper.urls),
+            'n_resumed_urls' : 0,
+            'n_pages' : 0,
+            'n_failed_urls' : 0,
+            'n_failed_pages' : 0,
+            'n_retries' : 0,
+            'n_skipped_blocks' : 0,
+            'n_options' : 0,
+            'n_prices' : 0,
+            'min_price' : None,
+            'fetch_seconds' : 0.0,
+            'parse_seconds' : 0.0,
+            'write_seconds' : 0.0,
+            'seconds' : 0.0
+        }
+        start = perf_counter()
+
+        # the search itself goes in first, so
+        # it's there even if no page has results
+        self.writer.write_run(self.flight_search, [], [], [])
+        self.run_id, self.completed_urls = self.writer.start_run(
+            self.flight_search[0], len(scraper.urls), resume_within=self.resume_within)
+        self.summary['run_id'] = self.run_id
+
+        urls = self.pending_urls()
+        if urls.empty():
+            logging.warning('no urls to scrape')
+
+        pages = Queue(maxsize=self.page_queue_size)
+        batches = Queue(maxsize=self.batch_queue_size)
+
+        n_sessions = max(1, min(scraper.pool_size, urls.qsize()))
+        fetchers = [
+            threading.Thread(target=self._fetch_worker, args=(session, urls, pages), name=f'fetch-{i}')
+            for i, session in enumerate(scraper.backend.sessions(n_sessions))]
+        parser = threading.Thread(target=self._parse_worker, args=(pages, batches), name='parse')
+        writer = threading.Thread(target=self._write_worker, args=(batches,), name='write')
+
+        logging.info(f'running pipeline over {urls.qsize()} urls with {n_sessions} {scraper.backend.name} sessions')
+        for thread in fetchers + [parser, writer]:
+            thread.start()
+
+        for thread in fetchers:
+            thread.join()
+        self._fetch_done.set()
+        parser.join()
+        writer.join()
+
+        self.summary['n_duplicates'] = scraper.journey_index.n_duplicates
+        self.summary['seconds'] = perf_counter() - start
+
+        # the run is over either way, so the next
+        # one starts afresh rather than resuming it
+        # for the urls that failed
+        n_failed = self.summary['n_failed_urls'] + self.summary['n_failed_pages']
+        status = 'failed' if self._error else 'partial' if n_failed else 'done'
+        try:
+            self.writer.finish_run(self.run_id, status)
+        except Exception as e:
+            logging.error(f'could not record the end of run {self.run_id}: {e}')
+
+        if self._error is not None:
+            stage, e = self._error
+            raise PipelineError(f'{stage} stage failed: {e}') from e
+
+        logging.info(
+            f'pipeline done in {self.summary["seconds"]:.2f}s: {self.summary["n_pages"]} pages, '
+            f'{self.summary["n_options"]} options, {self.summary["n_failed_urls"]} failed urls, '
+            f'{self.summary["n_skipped_blocks"]} skipped blocks')
+
+        return self.summary
+
+
+    def pending_urls(self) -> Queue:
+        '''
+        the (index, url) pairs to fetch: all urls
+        the run hasn't already completed.
+        '''
+        urls = Queue()
+        for i, url in enumerate(self.scraper.urls):
+            if url in self.completed_urls:
+                self.summary['n_resumed_urls'] += 1
+                continue
+            urls.put((i, url))
+
+        if self.summary['n_resumed_urls']:
+            logging.info(f'skipping {self.summary["n_resumed_urls"]} urls done earlier in run {self.run_id}')
+
+        return urls
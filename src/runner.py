@@ -0,0 +1,136 @@
+# runner.py
+# flight_prices_trends
+
+# the steps of one run of a flight search
+# (scrape -> parse -> write to the db), for
+# anything that runs many searches with the
+# same browsers and db connection, e.g. the
+# scheduler. also reads saved searches from
+# a yaml or jsonl file.
+
+# a saved search looks like the args of
+# get_flights.py, e.g. (in yaml):
+#   - name: lhr-lax
+#     journey_type: round_trip
+#     origin: LHR
+#     destination: LAX
+#     leave_date: '2024-02-08'
+#     return_date: '2024-02-25'
+#     country: uk
+# see searches_example.yaml
+
+############
+# IMPORTS
+############
+import os
+import json
+import logging
+from time import perf_counter
+
+import yaml
+
+############
+# INIT
+############
+logging.getLogger('runner')
+
+############
+# PATHS & CONSTANTS
+############
+# the keys of a saved search that are
+# passed on to new_journey_search
+SEARCH_KEYS = ['journey_type', 'origin', 'destination', 'leave_date', 'return_date', 'flex']
+REQUIRED_SEARCH_KEYS = ['journey_type', 'origin', 'destination', 'leave_date']
+
+############
+# FUNCTIONS
+############
+def search_name(search: dict) -> str:
+    '''
+    a readable name for a saved search,
+    if it doesn't come with one.
+    '''
+    def fmt(value):
+        return ','.join(value) if isinstance(value, list) else str(value)
+
+    name = f'{fmt(search["origin"])}-{fmt(search["destination"])} {fmt(search["leave_date"])}'
+    if search.get('return_date'):
+        name += f'/{search["return_date"]}'
+
+    return name
+
+
+def load_searches(path: str) -> list[dict]:
+    '''
+    reads saved searches from a yaml file
+    (a list of searches, or a dict with a
+    `searches` list) or a jsonl file (one
+    search per line). every search gets a
+    name and a country (default 'uk').
+    '''
+    with open(path) as f:
+        if os.path.splitext(path)[1] == '.jsonl':
+            searches = [json.loads(line) for line in f if line.strip()]
+        else:
+            searches = yaml.load(f, Loader=yaml.FullLoader)
+            if isinstance(searches, dict):
+                searches = searches.get('searches')
+
+    if not isinstance(searches, list):
+        raise ValueError(f'no list of searches found in {path}')
+
+    out = []
+    for i, search in enumerate(searches):
+        missing = [key for key in REQUIRED_SEARCH_KEYS if key not in search]
+        if missing:
+            raise ValueError(f'search {i+1} in {path} is missing {missing}')
+
+        search = dict(search)
+        # yaml reads unquoted dates as dates
+        for key in ['leave_date', 'return_date']:
+            if isinstance(search.get(key), list):
+                search[key] = [str(x) for x in search[key]]
+            elif search.get(key) is not None:
+                search[key] = str(search[key])
+        if search.get('flex') is not None:
+            search['flex'] = str(search['flex'])
+
+        search.setdefault('name', search_name(search))
+        search.setdefault('country', 'uk')
+        out.append(search)
+
+    names = [search['name'] for search in out]
+    if len(set(names)) != len(names):
+        raise ValueError(f'duplicate search names in {path}')
+
+    logging.info(f'loaded {len(out)} searches from {path}')
+    return out
+
+
+def run_search(scraper,
+               writer,
+               search: dict,
+               resume: bool = True) -> dict:
+    '''
+    runs one saved search with an existing
+    scraper (so its browsers stay open for
+    the next search) and DBWriter, through
+    the staged pipeline (see pipeline.py),
+    committing each page as it's done. an
+    unfinished recent run of the search is
+    resumed, unless resume=False.
+
+    returns a summary of the run.
+    '''
+    from src.pipeline import ScrapePipeline, RESUME_WITHIN
+
+    start = perf_counter()
+
+    scraper.new_journey_search(**{key : search.get(key) for key in SEARCH_KEYS})
+    summary = ScrapePipeline(scraper, writer, resume_within=RESUME_WITHIN if resume else None).run()
+
+    return {
+        'name' : search['name'],
+        **summary,
+        'seconds' : perf_counter() - start
+    }
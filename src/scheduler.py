@@ -0,0 +1,416 @@
+# scheduler.py
+# flight_prices_trends
+
+# module for running a set of saved searches
+# over and over from one long-running process,
+# instead of one cron job per search. the
+# browsers (one scraper per country) and the
+# db connection stay open between runs.
+
+# every search gets its own interval: searches
+# whose cheapest price has been jumping around
+# are run more often, and so are searches whose
+# departure is close. stable searches are run
+# less often. on top of that, a budget of page
+# loads per hour caps how hard we hit the site
+# overall.
+
+# NOTE: to start the daemon, run
+# python scheduler.py -s searches.yaml
+
+############
+# IMPORTS
+############
+import os
+import json
+import logging
+import threading
+import datetime as dt
+from collections import deque
+from time import time
+
+from src.runner import run_search
+
+############
+# INIT
+############
+logging.getLogger('scheduler')
+
+############
+# FUNCTIONS
+############
+def n_search_urls(search: dict) -> int:
+    '''
+    how many pages a run of a search
+    loads: one per origin/destination pair
+    for city_options, otherwise one.
+    '''
+    if 'city_options' not in search['journey_type']:
+        return 1
+
+    n_origins = len(search['origin']) if isinstance(search['origin'], list) else 1
+    n_destinations = len(search['destination']) if isinstance(search['destination'], list) else 1
+
+    return n_origins * n_destinations
+
+
+def first_departure(search: dict) -> dt.date:
+    '''
+    the date of the first leg of a search.
+    '''
+    leave_date = search['leave_date']
+    if isinstance(leave_date, list):
+        leave_date = leave_date[0]
+
+    return dt.date.fromisoformat(leave_date)
+
+
+def price_volatility(min_prices: list[float]) -> float | None:
+    '''
+    the mean relative change of the cheapest
+    price from one run to the next, e.g. 0.05
+    if it typically moves by 5%. None if
+    there are fewer than two runs.
+    '''
+    if len(min_prices) < 2:
+        return None
+
+    changes = [abs(b - a) / a for a, b in zip(min_prices, min_prices[1:]) if a]
+    if not changes:
+        return None
+
+    return sum(changes) / len(changes)
+
+
+############
+# CLASSES
+############
+class SearchSchedule:
+    '''
+    works out when each search is due, from
+    its recent cheapest prices and how close
+    its departure is, and keeps track of the
+    page load budget.
+
+    the last run and recent cheapest prices of
+    every search are written to a small json
+    file, so a restarted daemon carries on
+    where it left off.
+    '''
+    def __init__(self,
+                 searches: list[dict],
+                 base_interval: float = 360,
+                 min_interval: float = 60,
+                 max_interval: float = 1440,
+                 hourly_budget: int = 30,
+                 target_volatility: float = 0.05,
+                 proximity_days: int = 14,
+                 history_size: int = 20,
+                 min_samples: int = 3,
+                 state_path: str | None = None):
+        self.searches = {search['name'] : search for search in searches}
+        # intervals are in minutes
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.hourly_budget = hourly_budget
+        self.target_volatility = target_volatility
+        self.proximity_days = proximity_days
+        self.history_size = history_size
+        self.min_samples = min_samples
+        self.state_path = state_path
+
+        for name, search in self.searches.items():
+            if n_search_urls(search) > hourly_budget:
+                raise ValueError(
+                    f'search {name} loads {n_search_urls(search)} pages, '
+                    f'more than the hourly budget of {hourly_budget}')
+
+        # name -> unix time of the last run
+        self.last_run = {}
+        # name -> cheapest price of recent runs
+        self.min_prices = {}
+        # unix times of recent page loads
+        self.page_loads = deque()
+
+        if self.state_path and os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    stored = json.load(f)
+                for name, state in stored.items():
+                    if name in self.searches:
+                        self.last_run[name] = state['last_run']
+                        self.min_prices[name] = deque(state['min_prices'], maxlen=self.history_size)
+                logging.info(f'loaded scheduler state from {self.state_path}')
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f'could not read scheduler state at {self.state_path}: {e}')
+
+
+    def interval(self,
+                 name: str,
+                 today: dt.date | None = None) -> float:
+        '''
+        the minutes between two runs of a
+        search: base_interval, scaled down for
+        volatile prices and close departures,
+        and up for stable prices, kept between
+        min_interval and max_interval.
+
+        a search whose cheapest price moves by
+        target_volatility per run keeps
+        base_interval; one that doesn't move
+        at all is run half as often, and one
+        moving three times as much twice as
+        often. within proximity_days of
+        departure, the interval shrinks with
+        the days left.
+        '''
+        today = today or dt.date.today()
+        interval = self.base_interval
+
+        min_prices = list(self.min_prices.get(name, []))
+        volatility = price_volatility(min_prices)
+        if volatility is not None and len(min_prices) >= self.min_samples:
+            interval /= (volatility + self.target_volatility) / (2 * self.target_volatility)
+
+        days_left = (first_departure(self.searches[name]) - today).days
+        if days_left < self.proximity_days:
+            interval *= max(days_left, 1) / self.proximity_days
+
+        return max(self.min_interval, min(self.max_interval, interval))
+
+
+    def next_due(self,
+                 name: str) -> float:
+        '''
+        unix time a search is next due,
+        which is now if it's never been run.
+        '''
+        if name not in self.last_run:
+            return 0
+        return self.last_run[name] + self.interval(name) * 60
+
+
+    def active(self,
+               today: dt.date | None = None) -> list[str]:
+        '''
+        the searches that haven't departed yet.
+        '''
+        today = today or dt.date.today()
+        return [
+            name for name, search in self.searches.items()
+            if first_departure(search) >= today]
+
+
+    def next_search(self) -> tuple[str | None, float]:
+        '''
+        the search to run next (the most
+        overdue one), and the unix time at
+        which to run it, allowing for the
+        page load budget.
+        '''
+        active = self.active()
+        if not active:
+            return None, float('inf')
+
+        name = min(active, key=self.next_due)
+        return name, max(self.next_due(name), self.budget_available_at(n_search_urls(self.searches[name])))
+
+
+    def budget_available_at(self,
+                            n_pages: int) -> float:
+        '''
+        the unix time at which we can load
+        another n_pages without going over
+        the hourly budget.
+        '''
+        now = time()
+        while self.page_loads and self.page_loads[0] <= now - 3600:
+            self.page_loads.popleft()
+
+        n_over = len(self.page_loads) + n_pages - self.hourly_budget
+        if n_over <= 0:
+            return now
+
+        # wait for enough of the oldest loads
+        # to fall out of the last hour
+        return self.page_loads[n_over-1] + 3600
+
+
+    def record(self,
+               name: str,
+               n_pages: int,
+               min_price: float | None):
+        '''
+        records a run of a search and writes
+        the state to disk.
+        '''
+        now = time()
+        self.last_run[name] = now
+        self.page_loads.extend([now] * n_pages)
+
+        if min_price is not None:
+            if name not in self.min_prices:
+                self.min_prices[name] = deque(maxlen=self.history_size)
+            self.min_prices[name].append(min_price)
+
+        if self.state_path:
+            try:
+                with open(self.state_path, 'w') as f:
+                    json.dump({
+                        name : {
+                            'last_run' : last_run,
+                            'min_prices' : list(self.min_prices.get(name, []))}
+                        for name, last_run in self.last_run.items()}, f)
+            except OSError as e:
+                logging.warning(f'could not write scheduler state to {self.state_path}: {e}')
+
+
+class Scheduler:
+    '''
+    the daemon: keeps one scraper per country
+    and one DBWriter open, and runs whichever
+    search the SearchSchedule says is next,
+    until stopped.
+    '''
+    def __init__(self,
+                 schedule: SearchSchedule,
+                 recycle_after: int = 50,
+                 db_path: str | None = None):
+        self.schedule = schedule
+        self.recycle_after = recycle_after
+        self.db_path = db_path
+
+        self.scrapers = {}
+        self.n_runs = {}
+        self.writer = None
+        self._stop = threading.Event()
+
+
+    def stop(self):
+        '''
+        asks the loop to finish after the
+        current run (e.g. from a signal handler).
+        '''
+        self._stop.set()
+
+
+    def _scraper(self,
+                 country: str):
+        '''
+        the warm scraper for a country,
+        starting one if need be. browsers
+        are restarted every recycle_after
+        runs, so they don't slowly eat
+        up memory.
+        '''
+        from src.scraper import FlightsScaper
+
+        if self.n_runs.get(country, 0) >= self.recycle_after:
+            logging.info(f'restarting browsers for {country} after {self.n_runs[country]} runs')
+            self._quit_scraper(country)
+
+        if country not in self.scrapers:
+            self.scrapers[country] = FlightsScaper(country=country)
+            self.n_runs[country] = 0
+
+        return self.scrapers[country]
+
+
+    def _quit_scraper(self,
+                      country: str):
+        scraper = self.scrapers.pop(country, None)
+        self.n_runs.pop(country, None)
+        if scraper is not None:
+            try:
+                scraper.quit()
+            except Exception as e:
+                logging.warning(f'could not shut down browsers for {country}: {e}')
+
+
+    def run_next(self) -> dict | None:
+        '''
+        runs the next due search, if any.
+        returns its summary, or None if the
+        run failed.
+        '''
+        from selenium.common.exceptions import WebDriverException
+        import src.db_utils as db
+
+        name, due = self.schedule.next_search()
+        if name is None or due > time():
+            return None
+
+        search = self.schedule.searches[name]
+        country = search['country']
+        n_pages = n_search_urls(search)
+
+        if self.writer is None:
+            self.writer = db.DBWriter(self.db_path) if self.db_path else db.DBWriter()
+
+        logging.info(f'running search {name}')
+        try:
+            summary = run_search(self._scraper(country), self.writer, search)
+        except Exception as e:
+            if isinstance(e, WebDriverException) or isinstance(e.__cause__, WebDriverException):
+                # a crashed browser takes the others in
+                # the pool with it, so start afresh
+                logging.error(f'browser error running {name}, restarting browsers: {e}')
+                self._quit_scraper(country)
+            else:
+                logging.exception(f'error running {name}: {e}')
+            self.schedule.record(name, n_pages, None)
+            return None
+
+        self.n_runs[country] += 1
+        # only the pages this run loaded count against
+        # the budget, and the cheapest price only counts
+        # if it's from every page of the search (not a
+        # resumed run, whose earlier pages we didn't see)
+        n_loaded = summary['n_pages'] + summary['n_failed_pages'] + summary['n_failed_urls']
+        min_price = summary['min_price'] if not summary['n_resumed_urls'] else None
+        self.schedule.record(name, n_loaded, min_price)
+        logging.info(
+            f'ran {name} in {summary["seconds"]:.1f}s: {summary["n_options"]} options, '
+            f'cheapest {summary["min_price"]}, next in {self.schedule.interval(name):.0f} min')
+
+        return summary
+
+
+    def run_forever(self,
+                    max_sleep: float = 60):
+        '''
+        runs searches as they come due, until
+        stop() is called or every search has
+        departed. sleeps in steps of at most
+        max_sleep seconds, so a stop request
+        doesn't have to wait for the next run.
+        '''
+        try:
+            while not self._stop.is_set():
+                name, due = self.schedule.next_search()
+                if name is None:
+                    logging.info('all searches have departed, stopping')
+                    break
+
+                wait = due - time()
+                if wait > 0:
+                    logging.debug(f'next search {name} in {wait:.0f}s')
+                    self._stop.wait(min(wait, max_sleep))
+                    continue
+
+                self.run_next()
+        finally:
+            self.close()
+
+
+    def close(self):
+        '''
+        shuts down all browsers and
+        the db connection.
+        '''
+        for country in list(self.scrapers):
+            self._quit_scraper(country)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
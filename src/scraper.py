@@ -15,35 +15,37 @@
 ############
 # IMPORTS 
 ############
-from dotenv import load_dotenv
-import os
-import yaml
 import logging
 
 import datetime as dt 
 import re
 import fnmatch
-from time import sleep
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import (
-    NoSuchElementException, 
-    TimeoutException,
-    StaleElementReferenceException
-)
+# NOTE: selenium is imported where it's needed
+# (see backends.py), so that parsing (e.g. of
+# archived pages) doesn't have to load it.
 
-load_dotenv()
+from src.settings import get_settings
+from src.backends import FetchBackend, FetchedPage, SeleniumBackend
+from src.archive import save_snapshot
+from src.errors import BlockError, PageError, fetch_with_retry
+from src.journey_parser import split_chunks, parse_legs
+from src.id_factory import JourneyIndex
 
 ############
 # PATHS & CONSTANTS 
 ############
-CHROMEDRIVER = os.getenv('CHROMEDRIVER')
-CONFIG = yaml.load(open('config.yaml'), Loader=yaml.FullLoader)
+SETTINGS = get_settings()
+CHROMEDRIVER = SETTINGS.chromedriver
+CONFIG = SETTINGS.config
 COUNTRY = 'uk' # just a lazy default
+POOL_SIZE = SETTINGS.driver_pool_size
+RETRY = SETTINGS.retry
+ARCHIVE_SNAPSHOTS = SETTINGS.archive_snapshots
+BROWSER = SETTINGS.browser
+NON_DIGIT_PATTERN = re.compile(r'\D')
 
 ############
 # INIT 
@@ -258,9 +260,9 @@ def find_parse_stop_airports(leg: list[str]) -> list:
     return leg[index].split(', ')
 
 
-def find_full_results(tmp_results: list,
+def find_full_results(tmp_results: list[str],
                       n_legs: int = 2,
-                      currency_symbol: str = '£') -> list:
+                      currency_symbol: str = '£') -> list[str]:
     '''
     having changed the element retrieval method
     from xpath to css selectors, we get too many
@@ -273,22 +275,35 @@ def find_full_results(tmp_results: list,
     a journey has, but really it's the number of
     dashes we're looking for in the result 
     substrings.
+
+    takes the plain text of the result blocks
+    (rather than the web elements), so nothing
+    here goes back to the browser.
     '''
     actual_results = []
 
     for result in tmp_results:
-        scraped_journey = discard_before_time_substring(result.text)
-        raw_chunks = scraped_journey.split('\n')
-
-        dash_count = raw_chunks.count('-')
-        curr_count = sum(currency_symbol in chunk for chunk in raw_chunks)
-
-        if dash_count == n_legs and curr_count == 1:
+        raw_chunks = split_chunks(result)
+        if chunks_are_full_result(raw_chunks, n_legs, currency_symbol):
             actual_results.append(result)
         
     return actual_results
 
 
+def chunks_are_full_result(raw_chunks: list[str],
+                           n_legs: int = 2,
+                           currency_symbol: str = '£') -> bool:
+    '''
+    the check behind `find_full_results`, 
+    for a result which has already been 
+    split into chunks.
+    '''
+    dash_count = raw_chunks.count('-')
+    curr_count = sum(currency_symbol in chunk for chunk in raw_chunks)
+
+    return dash_count == n_legs and curr_count == 1
+
+
 # prices/meta helpers
 def parse_prices_meta(raw_chunks: list[str],
                       currency_symbol: str,
@@ -332,7 +347,7 @@ def parse_prices_meta(raw_chunks: list[str],
     
     # parse the price to int
     raw_price = chunks[raw_price_idx]
-    raw_price = re.sub(r'\D', '', raw_price)
+    raw_price = NON_DIGIT_PATTERN.sub('', raw_price)
     price = int(raw_price)
     
     return {
@@ -352,20 +367,46 @@ class FlightsScaper:
     a class that contains and manages all relevant
     data and tasks pertaining to retrieving flight
     data from kayak. 
+
+    pages are fetched by a backend (see
+    backends.py), a pool of chrome browsers
+    unless another one is passed in, e.g.
+    FlightsScaper(backend=ArchiveBackend('uk')).
     '''
     def __init__(self, 
                  country: str = COUNTRY,
-                 browser_driver: str = CHROMEDRIVER): 
-        self.driver = webdriver.Chrome(service=Service(executable_path=browser_driver)) 
+                 browser_driver: str = CHROMEDRIVER,
+                 pool_size: int = POOL_SIZE,
+                 browser_config: dict = BROWSER,
+                 backend: FetchBackend | None = None): 
         if country in CONFIG['permitted_countries']:
             self.country = country
         else:
             raise ValueError(f'{country} not in list of permitted countries')
 
+        if pool_size < 1:
+            raise ValueError(f'pool_size must be at least 1, got {pool_size}')
+        self.pool_size = pool_size
+
+        if backend is None:
+            backend = SeleniumBackend(country, browser_driver=browser_driver, browser_config=browser_config)
+        elif backend.country != country:
+            raise ValueError(f'backend is for {backend.country}, not {country}')
+        self.backend = backend
+
         self.base_url = CONFIG['country'][self.country]['base_url']
-        logging.info(f'FlightsScraper initialised with country {self.country} base url {self.base_url}')
+        logging.info(f'FlightsScraper initialised with country {self.country} base url {self.base_url}, '
+                     f'{self.backend.name} backend')
         
 
+    def quit(self):
+        '''
+        shuts down the backend, e.g.
+        all browsers in the pool.
+        '''
+        self.backend.close()
+
+
     def new_journey_search(self,
                            journey_type: str,
                            origin: str | list[str],
@@ -458,6 +499,11 @@ class FlightsScaper:
             
         self.urls = urls
         self.journey_options = []
+        self.journey_index = JourneyIndex()
+        # urls we gave up on, and blocks we
+        # couldn't parse, see errors.py
+        self.failed_urls = []
+        self.failed_blocks = []
 
     
     def get_journey_search(self,
@@ -466,157 +512,150 @@ class FlightsScaper:
         returns the journey search
         params as a dict.
         '''
-        leave_date = self.leave_date
-        return_date = self.return_date
-
-        if convert_datetimes:
-            if isinstance(self.leave_date, list):
-                leave_date = [dt.datetime.strptime(x, '%Y-%m-%d') for x in self.leave_date]
-            else:
-                leave_date = dt.datetime.strptime(self.leave_date, '%Y-%m-%d')
-            if self.return_date is not None:
-                return_date = dt.datetime.strptime(self.return_date, '%Y-%m-%d')
-
         journey_search = {
             'journey_type': self.journey_type,
             'origin': self.origin,
             'destination': self.destination,
-            'leave_date': leave_date,
+            'leave_date': self.leave_date,
         }
 
         if self.return_date is not None:
-            journey_search['return_date'] = return_date
+            journey_search['return_date'] = self.return_date
 
         if self.flex is not None:
             journey_search['flex'] = self.flex
 
+        if convert_datetimes:
+            journey_search = self.journey_search_datetimes(journey_search)
+
         return journey_search
     
 
     def get_flight_options(self,
-                           url: str) -> list:
+                           url: str,
+                           session = None) -> list:
         '''
-        loads the url, scrapes the options,
-        returns a list of dict with prices.
+        fetches the url with our backend,
+        archives the page and returns the
+        parsed options, as a list of dicts.
+
+        all state for a given url is kept
+        local, so several urls can be scraped
+        at the same time, each with their own
+        backend session (e.g. browser).
         '''
-        # load url
-        logging.info(f'loading url: {url}')
-        self.driver.get(url)
+        page = self.backend.fetch(url, session)
+        self.archive_page(page)
 
-        # wait for the cookie button
-        logging.info('waiting for cookie button to load')
-        try:
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located(
-                    (By.XPATH,
-                    CONFIG['country'][self.country]['xpaths']['cookie_decline_button'])))
-
-            button = self.driver.find_element(
-                By.XPATH, 
-                CONFIG['country'][self.country]['xpaths']['cookie_decline_button'])
-            button.click()
-            logging.info(f'cookie decline button clicked')
-        except (NoSuchElementException, TimeoutException):
-            # no button - no problem
-            logging.info(f'no cookie decline button found')
-            pass
-        
-        # wait for results to load
-        # first, we wait for the progress bar to complete
-        logging.info(f'waiting for progress bar to complete...')
-        try:
-            WebDriverWait(self.driver, 20).until(
-                EC.presence_of_element_located(
-                    (By.CSS_SELECTOR,
-                    CONFIG['country'][self.country]['css_selectors']['progress_bar'])))
-            
-            progress_bar = self.driver.find_element(
-                By.CSS_SELECTOR,
-                CONFIG['country'][self.country]['css_selectors']['progress_bar'])
-    
-            done = 0
-            while done < 20:
-                done += 0.5
-                sleep(0.5)
-                logging.info(progress_bar.get_attribute('style'))
-        
-        except TimeoutException:
-            logging.info(f'progress bar wasnt cought...')
-            pass
+        return self.parse_page(page)
 
-        # now, wait for more_results button to be avail
-        logging.info(f'waiting for page to load...')
-        try:
-            WebDriverWait(self.driver, 20).until(
-                EC.presence_of_element_located(
-                    (By.CSS_SELECTOR,
-                    CONFIG['country'][self.country]['css_selectors']['show_more_button'])))
-
-            # append more results
-            more_results_button = self.driver.find_element(
-                By.CSS_SELECTOR,
-                CONFIG['country'][self.country]['css_selectors']['show_more_button'])
-            more_results_button.click()
-        except TimeoutException:
-            logging.warning(f'unable to find more_results button. continuing.')
-            pass
-
-        # append results
-        logging.info(f'attempting to find results using css selector:') 
-        logging.info(f'{CONFIG["country"][self.country]["css_selectors"]["result_blocks"]}')
-        self.tmp_results = self.driver.find_elements(
-            By.CSS_SELECTOR,
-            CONFIG['country'][self.country]['css_selectors']['result_blocks'])
-        logging.info(f'retrieved {len(self.tmp_results)} results')
-        
-        # parse results
+
+    def archive_page(self,
+                     page: FetchedPage):
+        '''
+        saves a fetched page to the archive,
+        if archiving is on and the page didn't
+        come from there in the first place.
+        '''
+        if ARCHIVE_SNAPSHOTS and self.backend.archive_pages:
+            save_snapshot(
+                url=page.url,
+                country=self.country,
+                journey_search=self.get_journey_search(convert_datetimes=False),
+                blocks=page.blocks,
+                html=page.html,
+                captured_at=page.captured_at)
+
+
+    def parse_page(self,
+                   page: FetchedPage,
+                   failed_blocks: list | None = None) -> list:
+        '''
+        parses the result blocks of a fetched
+        page for the current journey search.
+        blocks that won't parse are skipped,
+        and added to failed_blocks if given.
+        '''
         logging.info(f'attempting to parse results...')
-        dates = self.leave_date.copy()
-        if 'round_trip' in self.journey_type:
-            dates.append(self.return_date)
+        dates = self.journey_dates(self.leave_date, self.return_date, self.journey_type)
         
-        # logging.info(f'dates dtype: {type(dates)}')
-        # logging.info(f'dates: {dates}') 
-        
-        # find results that are full, 
-        # responses where the reponse matches 
-        # the number of legs we're looking for
-        self.valid_results = find_full_results(
-            tmp_results=self.tmp_results,
-            n_legs=len(dates),
-            currency_symbol=CONFIG['country'][self.country]['currency_symbol']
-        )   
-        logging.info(f'found {len(self.valid_results)} valid results')
-
-        for result in self.valid_results:
-            journey_option = self._parse_journey_info(
-                result.text,
-                dates,
-                self.journey_type,
-                self.country)
-            if journey_option is not None:
-                self.journey_options.append(journey_option)
+        return self.parse_result_blocks(
+            page.blocks,
+            dates,
+            self.journey_type,
+            self.country,
+            created_at=page.captured_at,
+            failed_blocks=failed_blocks)
         
 
     def get_all_flight_options(self,
-                               retry_count: int = 3):
+                               retry_count: int = RETRY['count']):
         '''
         this wraps around the get_flight_options
         function, and iterates over all urls
         stored in self.urls, appending the
         results to self.journey_options.
+
+        urls are handed out to a pool of up to
+        self.pool_size backend sessions (e.g.
+        browsers). every worker
+        returns its own list of options, and we
+        merge them in url order once all urls
+        are done, so the output doesn't depend
+        on which browser finished first.
+
+        the same journey (at the same price) often
+        turns up on several pages, e.g. for city_options
+        and flex dates. those duplicates are dropped
+        as we merge, and counted in self.journey_index.
+
+        transient errors are retried with backoff
+        (see errors.fetch_with_retry). urls we
+        give up on end up in self.failed_urls,
+        unparseable blocks in self.failed_blocks.
         '''
-        WAIT_TIME = 10
-
-        for i, url in enumerate(self.urls):
-            for attempt in range(retry_count):
-                try:
-                    logging.info(f'on url {i+1} of {len(self.urls)}')
-                    self.get_flight_options(url)
-                    break  
-                except StaleElementReferenceException:
-                    logging.warning(f'StaleElementReferenceException caught. Retrying in {WAIT_TIME} seconds...')
-                    sleep(WAIT_TIME) 
+
+        if not self.urls:
+            logging.warning('no urls to scrape')
+            return
+
+        n_sessions = min(self.pool_size, len(self.urls))
+
+        idle_sessions = Queue()
+        for session in self.backend.sessions(n_sessions):
+            idle_sessions.put(session)
+
+        def scrape_url(i: int, url: str) -> list:
+            session = idle_sessions.get()
+            try:
+                logging.info(f'on url {i+1} of {len(self.urls)}')
+                page, _ = fetch_with_retry(
+                    self.backend,
+                    url,
+                    session,
+                    retry_count=retry_count,
+                    base_delay=RETRY['base_delay'],
+                    max_delay=RETRY['max_delay'])
+            except PageError as e:
+                logging.error(f'skipping url {url}: {e}')
+                self.failed_urls.append(url)
+                return []
+            finally:
+                idle_sessions.put(session)
+
+            self.archive_page(page)
+            return self.parse_page(page, failed_blocks=self.failed_blocks)
+
+        logging.info(f'scraping {len(self.urls)} urls with {n_sessions} {self.backend.name} sessions')
+        with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+            futures = [executor.submit(scrape_url, i, url) for i, url in enumerate(self.urls)]
+            for future in futures:
+                for journey_option in future.result():
+                    if self.journey_index.add(journey_option):
+                        self.journey_options.append(journey_option)
+
+        logging.info(f'kept {len(self.journey_options)} journey options, '
+                     f'dropped {self.journey_index.n_duplicates} duplicates')
         
 
     def sort_journey_options(self,
@@ -645,15 +684,32 @@ class FlightsScaper:
             raise ValueError(f'{write_mode} not a permitted write_mode parameter')
 
 
-    def journey_options_to_csv(filepath: str):
+    def journey_options_to_csv(self,
+                               filepath: str,
+                               view: str = 'legs') -> int:
         '''
         writes our journey options to a csv
         file. every leg of a journey is a row,
         and has the meta info attached (meaning)
         we're duplicating some info, but it's
         easier to work with this way.
+
+        with view='journeys', it's a row per
+        journey instead. the columns are the
+        same as for `manage.py export`, see
+        export.py. returns the number of rows.
         '''
-        pass
+        import src.db_utils as db
+        from src.export import export_journey_options
+
+        search_id = db.parse_flight_search(self.get_journey_search())[0]
+
+        return export_journey_options(
+            self.journey_options,
+            search_id,
+            filepath,
+            view=view,
+            fmt='csv')
     
 
     @staticmethod
@@ -754,11 +810,99 @@ class FlightsScaper:
             raise ValueError(f'{code} needs to be len==3, only letters.')
         
     
+    @staticmethod
+    def journey_search_datetimes(journey_search: dict) -> dict:
+        '''
+        takes a journey search with dates
+        as YYYY-MM-DD strings, and returns
+        a copy with the dates as datetimes,
+        as our db functions expect.
+        '''
+        journey_search = journey_search.copy()
+
+        if isinstance(journey_search['leave_date'], list):
+            journey_search['leave_date'] = [dt.datetime.strptime(x, '%Y-%m-%d') for x in journey_search['leave_date']]
+        else:
+            journey_search['leave_date'] = dt.datetime.strptime(journey_search['leave_date'], '%Y-%m-%d')
+        if journey_search.get('return_date') is not None:
+            journey_search['return_date'] = dt.datetime.strptime(journey_search['return_date'], '%Y-%m-%d')
+
+        return journey_search
+
+
+    @staticmethod
+    def journey_dates(leave_date: list[str],
+                      return_date: str | None,
+                      journey_type: str) -> list[str]:
+        '''
+        the departure date of every leg 
+        of a journey, in order.
+        '''
+        dates = leave_date.copy()
+        if 'round_trip' in journey_type:
+            dates.append(return_date)
+        return dates
+
+
+    @staticmethod
+    def parse_result_blocks(result_blocks: list[str],
+                            dates: list[str],
+                            journey_type: str,
+                            country: str,
+                            created_at: dt.datetime | None = None,
+                            failed_blocks: list | None = None) -> list[dict]:
+        '''
+        takes the raw text of all result blocks
+        on a page, keeps the full results and
+        parses them into journey options.
+
+        a block that looks like a full result
+        but won't parse is logged and skipped
+        (as a BlockError in failed_blocks, if
+        given), rather than losing the page.
+
+        this doesn't need a browser, so we can
+        also run it over archived snapshots.
+        '''
+        currency_symbol = CONFIG['country'][country]['currency_symbol']
+
+        journey_options = []
+        n_valid = 0
+        for i, result in enumerate(result_blocks):
+            # split every block once, and use the
+            # same chunks to check it's a full
+            # result and to parse it
+            raw_chunks = split_chunks(result)
+            if not chunks_are_full_result(raw_chunks, len(dates), currency_symbol):
+                continue
+            n_valid += 1
+
+            try:
+                journey_option = FlightsScaper._parse_journey_chunks(
+                    raw_chunks,
+                    dates,
+                    journey_type,
+                    country,
+                    created_at=created_at)
+            except (ValueError, IndexError, KeyError) as e:
+                logging.warning(f'skipping result block {i}: {type(e).__name__}: {e}')
+                if failed_blocks is not None:
+                    failed_blocks.append(BlockError(i, f'{type(e).__name__}: {e}'))
+                continue
+            if journey_option is not None:
+                journey_options.append(journey_option)
+        
+        logging.info(f'found {n_valid} valid results')
+
+        return journey_options
+
+
     @staticmethod
     def _parse_journey_info(scraped_journey: str,
                             dates: list[str],
                             journey_type: str,
-                            country: str) -> dict:
+                            country: str,
+                            created_at: dt.datetime | None = None) -> dict:
         '''
         takes a scraped string containing flight 
         info for one flight and parses it into a 
@@ -769,86 +913,42 @@ class FlightsScaper:
         is what we think it is as a function of
         a) where it is in the sequence of chunks, and
         b) its contents.
+
+        created_at is when the page was scraped,
+        which defaults to now.
         '''
-        timestamp = dt.datetime.now()
+        # remove random ad stuff before flight info, and split
+        raw_chunks = split_chunks(scraped_journey)
 
-        # remove random ad stuff before flight info
-        scraped_journey = discard_before_time_substring(scraped_journey)
+        return FlightsScaper._parse_journey_chunks(
+            raw_chunks,
+            dates,
+            journey_type,
+            country,
+            created_at=created_at)
 
-        # split
-        raw_chunks = scraped_journey.split('\n')
+
+    @staticmethod
+    def _parse_journey_chunks(raw_chunks: list[str],
+                              dates: list[str],
+                              journey_type: str,
+                              country: str,
+                              created_at: dt.datetime | None = None) -> dict:
+        '''
+        does the actual parsing for
+        `_parse_journey_info`, given the
+        journey already split into chunks.
+        '''
+        timestamp = created_at if created_at is not None else dt.datetime.now()
 
         # drop if ad
         if journey_is_ad(raw_chunks):
             return None
         
-        # identify number of legs by
-        # finding chunks with timings.
-        indexes = find_timing_chunks(raw_chunks)
-        legs = []
-        for i, index in enumerate(indexes):
-            if i+1 < len(indexes):
-                legs.append(raw_chunks[index:indexes[i+1]])
-            else:
-                # last leg - find the duration chunk
-                duration_index = find_last_duration_chunk(raw_chunks)
-                legs.append(raw_chunks[index:duration_index+1])
-
-                # now, append the price/meta chunk
-                prices_meta = raw_chunks[duration_index+1:]
-
-        # ensure that we have the same number of
-        # dates as legs
-        if len(dates) != len(legs):
-            raise ValueError(
-                f'Number of dates ({len(dates)}) does not match number of legs ({len(legs)})')
-
-        # iterate over legs, compiling our out dict
-        legs_out = []
-
-        for i, leg in enumerate(legs):
-            # check if we have a penalty
-            for chunk in leg:
-                penalty = chunk_is_penalty(chunk)
-                if penalty:
-                    break
-        
-            # we know that index 0 is the timings
-            dep, arr = parse_timings(leg[0], dates[i], penalty)
-
-            # find the airport chunks
-            airports = []
-            for chunk in leg:
-                if is_airport_chunk(chunk):
-                    airports.append(chunk[:3])
-
-            # find number of stops
-            for chunk in leg:
-                stops = find_parse_stops(chunk)
-                if stops is not None:
-                    break
-
-            # find stop airports, if any
-            if stops > 0:
-                stopovers = find_parse_stop_airports(leg)
-            else:
-                stopovers = None
-
-            # find & parse duration
-            duration = leg[find_last_duration_chunk(leg)]
-            duration = parse_duration(duration)
-
-            # append to legs_out
-            legs_out.append({
-                'departure_timestamp': dep,
-                'arrival_timestamp': arr,
-                'departure_airport': airports[0],
-                'arrival_airport': airports[1],
-                'duration': duration,
-                'n_stops': stops,
-                'stopover_airports': stopovers
-            })
-            
+        # tag all chunks in one go, and build
+        # the legs from those tags
+        legs_out, prices_meta = parse_legs(raw_chunks, dates)
+
         # parse price/meta chunk
         try:
             meta_out = parse_prices_meta(
@@ -0,0 +1,114 @@
+# settings.py
+# flight_prices_trends
+
+# one place for all our settings: the
+# contents of config.yaml plus the paths
+# from .env, parsed once per process and
+# shared by every module.
+
+# config.yaml is found next to this repo's
+# code rather than in the working directory,
+# so scripts can be run from anywhere (point
+# FLIGHTS_CONFIG at a different file to
+# override it). the same goes for the files
+# and directories we create as we go (the
+# archive, the airport table cache, load
+# times, scheduler state): relative paths
+# are relative to the repo, not the working
+# directory.
+
+############
+# IMPORTS
+############
+import os
+from dotenv import load_dotenv
+from dataclasses import dataclass
+from functools import lru_cache
+
+import yaml
+
+load_dotenv()
+
+############
+# PATHS & CONSTANTS
+############
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.getenv('FLIGHTS_CONFIG', os.path.join(REPO_ROOT, 'config.yaml'))
+
+############
+# CLASSES
+############
+@dataclass(frozen=True)
+class Settings:
+    '''
+    the parsed config.yaml (`config`, as
+    the raw dict, plus the keys we use all
+    over the place as typed fields) and the
+    paths from the environment.
+    '''
+    config: dict
+    permitted_countries: list[str]
+    permitted_flex: dict[str, str]
+    permitted_journey_types: list[str]
+    insert_map: dict[str, list[str]]
+    driver_pool_size: int
+    page_ready: dict
+    scheduler: dict
+    browser: dict
+    retry: dict
+    archive_snapshots: bool
+    resume_within_hours: float
+    price_storage: str
+    daily_rollups: bool
+
+    chromedriver: str | None
+    db_path: str | None
+    archive_path: str
+    cache_path: str
+    log_file_path: str | None
+    log_format: str | None
+
+
+############
+# FUNCTIONS
+############
+def repo_path(path: str | None) -> str | None:
+    '''
+    a path from the config or environment,
+    with relative paths taken from REPO_ROOT.
+    '''
+    if path is None:
+        return None
+    return os.path.join(REPO_ROOT, os.path.expanduser(path))
+
+
+@lru_cache(maxsize=None)
+def get_settings(config_path: str = CONFIG_PATH) -> Settings:
+    '''
+    reads config.yaml and the environment,
+    once per process.
+    '''
+    with open(config_path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    return Settings(
+        config=config,
+        permitted_countries=config['permitted_countries'],
+        permitted_flex=config['permitted_flex'],
+        permitted_journey_types=config['permitted_journey_types'],
+        insert_map=config['insert_map'],
+        driver_pool_size=config['driver_pool_size'],
+        page_ready={**config['page_ready'], 'history_path' : repo_path(config['page_ready']['history_path'])},
+        scheduler={**config['scheduler'], 'state_path' : repo_path(config['scheduler']['state_path'])},
+        browser=config['browser'],
+        retry=config['retry'],
+        archive_snapshots=config['archive_snapshots'],
+        resume_within_hours=config['resume_within_hours'],
+        price_storage=config['price_storage'],
+        daily_rollups=config['daily_rollups'],
+        chromedriver=os.getenv('CHROMEDRIVER'),
+        db_path=os.getenv('DB_PATH'),
+        archive_path=repo_path(os.getenv('ARCHIVE_PATH', 'archive/')),
+        cache_path=repo_path(os.getenv('CACHE_PATH', 'cache/')),
+        log_file_path=os.getenv('LOG_FILE_PATH'),
+        log_format=os.getenv('LOG_FORMAT'))